@@ -28,6 +28,7 @@ argParser = argparse.ArgumentParser(description = "Argument parser")
 argParser.add_argument('--logLevel',           action='store',      default='INFO',          nargs='?', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'TRACE', 'NOTSET'], help="Log level for logging" )
 argParser.add_argument('--era',                action='store',      default='Run2016',       nargs='?', choices=['Run2016', 'Run2016BCD', 'Run2016EFearly', 'Run2016FlateG', 'Run2016H'], help="era" )
 argParser.add_argument('--small',                                   action='store_true',     help='Run only on a small subset of the data?')#, default = True)
+argParser.add_argument('--workers',                                 action='store',      default=1, type=int, help='Number of processes filling (sample, file) pairs in parallel' )
 #argParser.add_argument('--overwrite',                               action='store_true',     help='Overwrite?')
 argParser.add_argument('--plot_directory',     action='store',      default='JEC/L1res',     help="subdirectory for plots")
 args = argParser.parse_args()
@@ -149,13 +150,22 @@ from JetMET.JEC.L1res.thresholds import offset_eta_thresholds
 # rather awkward way to use TTree Draw
 
 binning_int = [ len(offset_eta_thresholds) - 1, 0, len(offset_eta_thresholds) - 1 ]
+
+# fill all offsets in one parallel pass over the files
+from JetMET.tools.histoFiller    import makeHisto
+from JetMET.tools.parallelFiller import ParallelFiller
+filler = ParallelFiller( workers = args.workers )
+h_offset = {}
+for offset in ["Offset_e_ch", "Offset_e_nh", "Offset_e_ph"]:
+    logger.info( "Draw: Book offset histo %s for sample %s", offset, mc.name )
+    # make histo with x-axis being the fixed-size vector index Iteration$ that counts from 0 to size-1
+    h_offset[offset] = filler.book( mc, makeHisto( binning_int ), "Iteration$", weightString = offset )
+filler.fill()
+
 histos = []
 for i_offset, offset in enumerate(["Offset_e_ch", "Offset_e_nh", "Offset_e_ph"]):
 
-    logger.info( "Draw: Obtain offset histo %s for sample %s", offset, mc.name )
-
-    # make histo with x-axis being the fixed-size vector index Iteration$ that counts from 0 to size-1
-    h       = mc.get1DHistoFromDraw("Iteration$", binning = binning_int, weightString = offset)
+    h       = h_offset[offset]
 
     # make new histogram with same number of bins but proper eta thresholds
     h_eta   = ROOT.TH1D(h.GetName()+'_eta', h.GetTitle(), len(offset_eta_thresholds)-1, array.array('d', offset_eta_thresholds) )
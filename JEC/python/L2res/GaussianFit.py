@@ -1,5 +1,6 @@
 # Standard importts
 import os
+import numpy as np
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
@@ -21,15 +22,6 @@ def GaussianFit( shape, isData, var_name, fit_plot_directory, fit_filename = Non
     # declare the observable mean, and import the histogram to a RooDataHist
     asymmetry   = ROOT.RooRealVar(var_name, var_name,-10,10) ;
     dh          = ROOT.RooDataHist("datahistshape","datahistshape",ROOT.RooArgList(asymmetry),ROOT.RooFit.Import(shape)) ;
-    
-    # plot the data hist with error from sum of weighted events
-    frame       = asymmetry.frame(ROOT.RooFit.Title(var_name))
-    if isData:
-        logger.debug( "Settings for data with Poisson error bars" )
-        dh.plotOn(frame,ROOT.RooFit.DataError(ROOT.RooAbsData.Poisson))
-    else:
-        logger.debug( "Settings for mc with SumW2 error bars" )
-        dh.plotOn(frame,ROOT.RooFit.DataError(ROOT.RooAbsData.SumW2)) ;
 
     # create a simple gaussian pdf
     gauss_mean  = ROOT.RooRealVar("mean","mean",0,-1.2,1.2)
@@ -42,23 +34,32 @@ def GaussianFit( shape, isData, var_name, fit_plot_directory, fit_filename = Non
     else:
         gauss.fitTo(dh,ROOT.RooFit.Save(),ROOT.RooFit.SumW2Error(True),ROOT.RooFit.Range(dh.mean(asymmetry)-2*dh.sigma(asymmetry),dh.mean(asymmetry)+2*dh.sigma(asymmetry)))
 
-    gauss.plotOn(frame)
+    # diagnostic plot only if asked for
+    if fit_filename is not None:
+        frame       = asymmetry.frame(ROOT.RooFit.Title(var_name))
+        # plot the data hist with error from sum of weighted events
+        if isData:
+            logger.debug( "Settings for data with Poisson error bars" )
+            dh.plotOn(frame,ROOT.RooFit.DataError(ROOT.RooAbsData.Poisson))
+        else:
+            logger.debug( "Settings for mc with SumW2 error bars" )
+            dh.plotOn(frame,ROOT.RooFit.DataError(ROOT.RooAbsData.SumW2)) ;
 
-    argset_fit = ROOT.RooArgSet(gauss_mean,gauss_sigma)
-    gauss.paramOn(frame,ROOT.RooFit.Format("NELU",ROOT.RooFit.AutoPrecision(1)),ROOT.RooFit.Layout(0.55)) 
-    frame.SetMaximum(frame.GetMaximum()*1.2)
+        gauss.plotOn(frame)
 
-    # add chi2 info
-    chi2_text = ROOT.TPaveText(0.3,0.8,0.4,0.9,"BRNDC")
-    chi2_text.AddText("#chi^{2} fit = %s" %round(frame.chiSquare(6),2))
-    chi2_text.SetTextSize(0.04)
-    chi2_text.SetTextColor(2)
-    chi2_text.SetShadowColor(0)
-    chi2_text.SetFillColor(0)
-    chi2_text.SetLineColor(0)
-    frame.addObject(chi2_text)
+        gauss.paramOn(frame,ROOT.RooFit.Format("NELU",ROOT.RooFit.AutoPrecision(1)),ROOT.RooFit.Layout(0.55)) 
+        frame.SetMaximum(frame.GetMaximum()*1.2)
+
+        # add chi2 info
+        chi2_text = ROOT.TPaveText(0.3,0.8,0.4,0.9,"BRNDC")
+        chi2_text.AddText("#chi^{2} fit = %s" %round(frame.chiSquare(6),2))
+        chi2_text.SetTextSize(0.04)
+        chi2_text.SetTextColor(2)
+        chi2_text.SetShadowColor(0)
+        chi2_text.SetFillColor(0)
+        chi2_text.SetLineColor(0)
+        frame.addObject(chi2_text)
 
-    if fit_filename is not None:
         c = ROOT.TCanvas()
         frame.Draw()
         if not os.path.exists(fit_plot_directory): os.makedirs(fit_plot_directory)
@@ -70,3 +71,86 @@ def GaussianFit( shape, isData, var_name, fit_plot_directory, fit_filename = Non
     mean_asymmetry_error  = gauss_mean.getError()
 
     return mean_asymmetry, mean_asymmetry_error
+
+def _GaussianFit_job( kwargs ):
+    return GaussianFit( **kwargs )
+
+def GaussianFit_pool( jobs, workers = 1 ):
+    ''' RooFit fits of many histograms in a process pool. jobs is a list of GaussianFit keyword dictionaries,
+        returns [ ( mean, mean_error ), ... ] in the same order.
+    '''
+    logger.info( "Performing %i gaussian fits with %i workers", len(jobs), workers )
+    if workers > 1:
+        from multiprocessing import Pool
+        pool = Pool( processes = workers )
+        results = pool.map( _GaussianFit_job, jobs )
+        pool.close()
+        pool.join()
+    else:
+        results = map( _GaussianFit_job, jobs )
+    return results
+
+def GaussianFit_batch( contents, sumw2, centers, nSigma = 2., iterations = 3 ):
+    ''' Vectorized Gaussian fits of a stack of histograms. contents and sumw2 have the bins along the first axis
+        and any number of cells along the others (e.g. [x, eta, pt]), centers are the bin centers.
+        The first fit range is mean +/- nSigma*RMS of the histogram (as in GaussianFit), then the range is iterated
+        with the fitted mean and sigma. Each fit is a weighted linear least squares fit of a parabola to the log
+        of the bin contents. Cells where the parabola fit fails fall back to the truncated mean.
+        Returns arrays ( mean, mean_error, sigma, fitted ) of the cell shape.
+    '''
+    contents = np.asarray( contents, dtype = 'float64' )
+    sumw2    = np.asarray( sumw2, dtype = 'float64' )
+    cell_shape = contents.shape[1:]
+    nBins    = contents.shape[0]
+    y        = contents.reshape( nBins, -1 ).T
+    w2       = sumw2.reshape( nBins, -1 ).T
+    x        = np.asarray( centers, dtype = 'float64' )[np.newaxis, :]
+
+    def truncated_moments( window ):
+        yw    = np.where( window, y, 0. )
+        sumw  = yw.sum( axis = 1 )
+        safe  = np.where( sumw != 0, sumw, 1. )
+        mean  = ( yw*x ).sum( axis = 1 )/safe
+        rms   = np.sqrt( np.maximum( ( yw*x**2 ).sum( axis = 1 )/safe - mean**2, 0. ) )
+        sw2   = np.where( window, w2, 0. ).sum( axis = 1 )
+        neff  = np.where( sw2 > 0, sumw**2/np.where( sw2 > 0, sw2, 1. ), 0. )
+        error = np.where( neff > 0, rms/np.sqrt( np.where( neff > 0, neff, 1. ) ), 0. )
+        return mean, rms, error
+
+    # starting point: full range moments
+    mean, sigma, error = truncated_moments( np.ones_like( y, dtype = 'bool' ) )
+    fitted = np.zeros( y.shape[0], dtype = 'bool' )
+
+    for iteration in range( iterations ):
+        window = ( np.abs( x - mean[:, np.newaxis] ) <= nSigma*sigma[:, np.newaxis] ) & ( y > 0 ) & ( w2 > 0 )
+
+        # log(y) = a + b*dx + c*dx^2 with dx = x - mean, weights 1/var(log y) = y^2/sumw2
+        dx    = x - mean[:, np.newaxis]
+        wgt   = np.where( window, y**2/np.where( window, w2, 1. ), 0. )
+        logy  = np.log( np.where( window, y, 1. ) )
+        basis = np.stack( [ np.ones_like( dx ), dx, dx**2 ], axis = 2 )               # (cells, bins, 3)
+        A     = np.einsum( 'nk,nki,nkj->nij', wgt, basis, basis )
+        rhs   = np.einsum( 'nk,nki,nk->ni', wgt, basis, logy )
+
+        ok    = ( window.sum( axis = 1 ) >= 3 ) & ( np.abs( np.linalg.det( A ) ) > 1e-300 )
+        cov   = np.linalg.inv( np.where( ok[:, np.newaxis, np.newaxis], A, np.eye( 3 ) ) )
+        par   = np.einsum( 'nij,nj->ni', cov, rhs )
+        b, c  = par[:, 1], par[:, 2]
+        ok   &= c < 0
+
+        c_    = np.where( ok, c, -1. )
+        new_mean  = mean - b/( 2*c_ )
+        new_sigma = np.sqrt( -1./( 2*c_ ) )
+        # error propagation of mean = -b/(2c)
+        J     = np.stack( [ np.zeros_like( b ), -1./( 2*c_ ), b/( 2*c_**2 ) ], axis = 1 )
+        new_error = np.sqrt( np.maximum( np.einsum( 'ni,nij,nj->n', J, cov, J ), 0. ) )
+
+        # fall back to the truncated moments where the fit failed or ran away
+        t_mean, t_rms, t_error = truncated_moments( window )
+        ok &= np.abs( new_mean - mean ) <= nSigma*sigma
+        mean   = np.where( ok, new_mean,  t_mean )
+        error  = np.where( ok, new_error, t_error )
+        sigma  = np.where( ok, new_sigma, np.where( t_rms > 0, t_rms, sigma ) )
+        fitted = ok
+
+    return mean.reshape( cell_shape ), error.reshape( cell_shape ), sigma.reshape( cell_shape ), fitted.reshape( cell_shape )
@@ -5,9 +5,10 @@ import ROOT
 import sys
 import os
 import copy
+import itertools
 import subprocess
 import shutil
-import random
+import numpy as np
 
 from operator import mul
 from math import sqrt, atan2, sin, cos
@@ -20,6 +21,9 @@ import JetMET.tools.user as user
 
 # JetMET
 import JetMET.tools.helpers as helpers
+import JetMET.tools.counterRandom as counterRandom
+import JetMET.tools.skimManifest as skimManifest
+from JetMET.tools.lumiMask import LumiMask, LumiAccumulator
 from JetMET.tools.objectSelection        import getFilterCut, getJets, jetVars
 
 # Hot jet veto
@@ -47,11 +51,15 @@ def get_parser():
     argParser.add_argument('--eventsPerJob', action='store', nargs='?', type=int, default=300000, help="Maximum number of events per job (Approximate!)." )
     argParser.add_argument('--nJobs', action='store', nargs='?', type=int, default=1, help="Maximum number of simultaneous jobs." )    
     argParser.add_argument('--job', action='store', nargs='*', type=int, default=[], help="Run only jobs i" )
+    argParser.add_argument('--workers', action='store', nargs='?', type=int, default=1, help="Number of local processes for the event ranges." )
     argParser.add_argument('--minNJobs', action='store', nargs='?', type=int, default=1, help="Minimum number of simultaneous jobs." )
     argParser.add_argument('--targetDir', action='store', nargs='?', type=str, default=user.skim_ntuple_directory, help="Name of the directory the post-processed files will be saved" ) #user.data_output_directory
     #argParser.add_argument('--version', action='store', nargs='?', type=str, default='V1', help="JEC version" )
     argParser.add_argument('--processingEra', action='store', nargs='?', type=str, default='v11', help="Name of the processing era" )
     argParser.add_argument('--skim', action='store', nargs='?', type=str, default='default', help="Skim conditions to be applied for post-processing" )
+    argParser.add_argument('--prefilter', action='store_true', help="Apply skim cuts and golden JSON before cloning and report the cut efficiencies", default = False)
+    argParser.add_argument('--profileIO', action='store_true', help="Write a branch level I/O profile of the kept and read branches", default = False)
+    argParser.add_argument('--columnar', action='store_true', help="Compute the observables with numpy for a whole event range (needs root_numpy)", default = False)
     argParser.add_argument('--small', action='store_true', help="Run the file on a small sample (for test purpose), bool flag set to True if used", default = False)
     return argParser
 
@@ -82,11 +90,9 @@ Summer16_03Feb2017_MC = [(1, 'Summer16_03Feb2017_V1_MC') ]
 correction_levels_data  = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
 correction_levels_mc    = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
 
-jetCorrector_data    = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = correction_levels_data )
-jetCorrector_mc      = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = correction_levels_mc )
-
-jetCorrector_RC_data = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = [ 'L1RC'] )
-jetCorrector_RC_mc   = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = [ 'L1RC'] )
+# One corrector per data/MC: all levels and L1RC are obtained from a single evaluation of the chain
+jetCorrector_data    = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = correction_levels_data, L1RC = True )
+jetCorrector_mc      = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = correction_levels_mc,   L1RC = True )
 
 # Flags 
 defSkim = options.skim.lower().startswith('default')
@@ -109,8 +115,9 @@ isMC   =  not isData
 ## JER smearing (don't forget to call delete() )
 ## https://twiki.cern.ch/twiki/bin/view/CMS/JetResolution
 
-#smearer_mc = JetSmearer("Spring16_25nsV10_MC", "AK4PFchs") if isMC else None # Run-II biased by EcalEE
-smearer_mc = JetSmearer("Spring16_25nsV6_MC", "AK4PFchs") if isMC else None # ICHEP version
+#jer_era = "Spring16_25nsV10_MC" # Run-II biased by EcalEE
+jer_era = "Spring16_25nsV6_MC" # ICHEP version
+smearer_mc = JetSmearer(jer_era, "AK4PFchs") if isMC else None
 
 if isMC:
     from JetMET.tools.puReweighting import getReweightingFunction
@@ -167,10 +174,9 @@ else:
 if isData:
     lumiScaleFactor=None
     branchKeepStrings = branchKeepStrings_DATAMC + branchKeepStrings_DATA
-    from FWCore.PythonUtilities.LumiList import LumiList
     # Apply golden JSON
     json = '$CMSSW_BASE/src/CMGTools/TTHAnalysis/data/json/Cert_271036-284044_13TeV_PromptReco_Collisions16_JSON_NoL1T.txt'
-    lumiList = LumiList(os.path.expandvars(json))
+    lumiList = LumiMask(os.path.expandvars(json))
     logger.info( "Loaded json %s", json )
 else:
     lumiScaleFactor = targetLumi/float(sample.normalization) 
@@ -210,12 +216,67 @@ for jer in ['', 'jer', 'jer_up', 'jer_down']:
 if isData: new_variables.extend( ['jsonPassed/I'] )
 
 
+def prefilter( chain, cuts, lumiMask = None, chunk = 1000000 ):
+    ''' Event list of the entries passing all cuts and the lumi mask. Reads only the branches of the cuts, 
+        in one Draw per chunk of entries, and reports the efficiency of each cut.
+    '''
+    bitmask  = "+".join( "(%s)*%i" % ( cut, 2**i_cut ) for i_cut, cut in enumerate( cuts ) )
+    all_cuts = 2**len(cuts) - 1
+    nEntries = chain.GetEntries()
+    chain.SetEstimate( min( chunk, nEntries ) + 1 )
+
+    eventList  = ROOT.TEventList( "prefilter_%s" % sample.name )
+    nPassed    = np.zeros( len(cuts), dtype = 'int64' ) # each cut individually
+    nCumulated = np.zeros( len(cuts), dtype = 'int64' ) # cuts 0..i
+    nJSON      = 0
+    for first in xrange( 0, nEntries, chunk ):
+        n = chain.Draw( "run:lumi:Entry$:%s" % bitmask, "", "goff", chunk, first )
+        if n <= 0: continue
+        values = []
+        for buf in [ chain.GetV1(), chain.GetV2(), chain.GetV3(), chain.GetV4() ]:
+            buf.SetSize( n )
+            values.append( np.frombuffer( buf, dtype = 'float64', count = n ).copy() )
+        runs, lumis, entries, bits = values
+        bits = bits.astype( 'int64' )
+
+        for i_cut in range( len(cuts) ):
+            nPassed[i_cut]    += np.count_nonzero( bits & 2**i_cut )
+            nCumulated[i_cut] += np.count_nonzero( ( bits & ( 2**(i_cut+1) - 1 ) ) == 2**(i_cut+1) - 1 )
+
+        passed = ( bits == all_cuts )
+        if lumiMask is not None:
+            passed &= lumiMask.contains_batch( runs.astype( 'int64' ), lumis.astype( 'int64' ) )
+        nJSON += np.count_nonzero( passed )
+
+        for entry in entries[passed].astype( 'int64' ).tolist():
+            eventList.Enter( entry )
+
+    logger.info( "Prefilter of %i events:", nEntries )
+    for i_cut, cut in enumerate( cuts ):
+        logger.info( "  cut %i: efficiency %5.4f, cumulative %5.4f: %s", i_cut, nPassed[i_cut]/float(max(nEntries,1)), nCumulated[i_cut]/float(max(nEntries,1)), cut )
+    if lumiMask is not None:
+        logger.info( "  golden JSON: efficiency %5.4f after cuts, cumulative %5.4f", nJSON/float(max(nCumulated[-1] if len(cuts)>0 else nEntries,1)), nJSON/float(max(nEntries,1)) )
+
+    return eventList
+
+if options.prefilter:
+    # The event list of the chain is respected by the Draw of the reader's selection and by the cloning. 
+    # Events outside the JSON are not written.
+    sample.chain.SetEventList( prefilter( sample.chain, skimConds, lumiMask = lumiList if isData else None ) )
+
 # Define a reader
 reader = sample.treeReader( \
     variables = read_variables ,
     selectionString = "&&".join(skimConds)
     )
 
+if options.profileIO:
+    from JetMET.tools.branchProfiler import profileChain, variableBranches
+    profileChain( sample.chain, os.path.join( output_directory, 'io_profile.txt' ), 
+        patterns         = branchKeepStrings + sorted( variableBranches( read_variables ) ),
+        used_variables   = read_variables, 
+        used_expressions = skimConds )
+
 null_jet = {key:float('nan') for key in jetVars}
 null_jet['pt']         = 0
 null_jet['pt_corr']    = 0
@@ -248,14 +309,25 @@ def filler( event ):
     jets = getJets( r, jetColl="Jet", jetVars = jetVarNames)
 
     event.nJetGood = len(jets) 
+
+    # 'Corr' correction level: L1L2L3 L2res, evaluated for all jets of the event at once
+    rawPts = [ j['rawPt'] for j in jets ]
+    etas   = [ j['eta']   for j in jets ]
+    areas  = [ j['area']  for j in jets ]
+    jetCorrector = jetCorrector_data if isData else jetCorrector_mc
+    sub_corrections     = jetCorrector.subCorrections_batch( rawPts, etas, areas, r.rho, r.run )
+    jet_corr_factors    = sub_corrections[jetCorrector.levels[-1]]
+    jet_corr_factors_RC = sub_corrections['L1RC']
+
+    # JER factors ( nominal, up, down ) for all jets of the event at once
+    if not isData:
+        # reproducible smearing: random numbers from ( run, lumi, evt, jet index ), independent of the event ranges
+        jet_corr_factors_jer = smearer_mc.hybrid_correction_batch( pt = jet_corr_factors*np.array( rawPts ), mcPt = [ j['mcPt'] for j in jets ], eta = etas, rho = r.rho,
+            counters = ( r.run, r.lumi, r.evt, np.arange( len(jets) ) ) )
+
     for iJet, j in enumerate(jets):
-        # 'Corr' correction level: L1L2L3 L2res
-        if isData:
-            jet_corr_factor    =  jetCorrector_data.   correction( j['rawPt'], j['eta'], j['area'], r.rho, r.run )
-            jet_corr_factor_RC =  jetCorrector_RC_data.correction( j['rawPt'], j['eta'], j['area'], r.rho, r.run )
-        else:
-            jet_corr_factor    =  jetCorrector_mc.     correction( j['rawPt'], j['eta'], j['area'], r.rho, r.run )  
-            jet_corr_factor_RC =  jetCorrector_RC_mc.  correction( j['rawPt'], j['eta'], j['area'], r.rho, r.run )  
+        jet_corr_factor    = jet_corr_factors[iJet]
+        jet_corr_factor_RC = jet_corr_factors_RC[iJet]
 
         # corrected jet
         j['pt_corr']    =  jet_corr_factor * j['rawPt'] 
@@ -268,7 +340,7 @@ def filler( event ):
         if isData:
             jet_corr_factor_jer, jet_corr_factor_jer_up, jet_corr_factor_jer_down = (1., 1., 1.)
         else:
-            jet_corr_factor_jer, jet_corr_factor_jer_up, jet_corr_factor_jer_down = smearer_mc.hybrid_correction( pt = j['pt_corr'], mcPt = j['mcPt'], eta = j['eta'], rho = r.rho ) 
+            jet_corr_factor_jer, jet_corr_factor_jer_up, jet_corr_factor_jer_down = jet_corr_factors_jer[iJet]
 
         j['pt_corr_jer']        =  jet_corr_factor_jer      * j['pt_corr'] 
         j['pt_corr_jer_up']     =  jet_corr_factor_jer_up   * j['pt_corr'] 
@@ -286,7 +358,8 @@ def filler( event ):
         #j['corr_jer_up']     =  jet_corr_factor_jer_up    
         #j['corr_jer_down']   =  jet_corr_factor_jer_down  
 
-    randomSwap = ( random.random()>0.5 )
+    # index -1 -> independent of the jet smearing
+    randomSwap = ( counterRandom.uniform( r.run, r.lumi, r.evt, -1 )[0]>0.5 )
 
     for jer in ['', 'jer', 'jer_up', 'jer_down']:
 
@@ -345,9 +418,166 @@ def filler( event ):
                  ( chs_MEx_corr*tag_jet[pt_corr]*cos(tag_jet['phi'])  + chs_MEy_corr*tag_jet[pt_corr]*sin(tag_jet['phi']) ) / tag_jet[pt_corr] / (tag_jet[pt_corr] + probe_jet[pt_corr])
             )
 
+# Columnar filler: the observables of a whole event range are computed with numpy on flat jet arrays 
+# and copied to the output branches event by event. Same output as filler.
+columnar_branches = [ 'run', 'lumi', 'evt', 'rho', 'met_chsPt', 'met_chsPhi', 'nJet', 'Jet_rawPt', 'Jet_eta', 'Jet_phi', 'Jet_area', 'Jet_eEF', 'Jet_phEF' ]
+if isMC:
+    columnar_branches += [ 'xsec', 'genWeight', 'nTrueInt', 'Jet_mcPt' ]
+
+columns = {}
+
+def readColumns( eventRange ):
+    ''' Read the selected events of the event range as ( jagged ) arrays
+    '''
+    from root_numpy import tree2array
+    # entries of the chain that correspond to the first and last event in the event list of the reader
+    start = reader.eventList.GetEntry( eventRange[0] )
+    stop  = reader.eventList.GetEntry( eventRange[1]-1 ) + 1
+    arrays = tree2array( sample.chain, branches = columnar_branches, selection = "&&".join(skimConds), start = start, stop = stop )
+    # tree2array ignores the event list of the prefilter
+    if options.prefilter and isData:
+        arrays = arrays[ lumiList.contains_batch( arrays['run'], arrays['lumi'] ) ]
+    return arrays
+
+def computeColumns( eventRange ):
+    ''' Vectorized version of the filler for all events in eventRange
+    '''
+    arrays  = readColumns( eventRange )
+    nEvents = len( arrays )
+    nJet    = arrays['nJet'].astype( 'int64' )
+    offsets = np.concatenate( [ [0], np.cumsum( nJet ) ] )
+    i_event = np.repeat( np.arange( nEvents ), nJet )
+    # index of the jet in its event
+    i_jet   = np.arange( offsets[-1] ) - offsets[i_event]
+
+    def flat( branch ):
+        return np.concatenate( list( arrays[branch] ) + [ np.zeros( 0 ) ] ).astype( 'float64' )
+
+    run, lumi, evt = arrays['run'], arrays['lumi'], arrays['evt']
+    rho, met_chsPt, met_chsPhi = [ arrays[branch].astype( 'float64' ) for branch in [ 'rho', 'met_chsPt', 'met_chsPhi' ] ]
+    rawPt, eta, phi, area, eEF, phEF = [ flat( 'Jet_'+var ) for var in [ 'rawPt', 'eta', 'phi', 'area', 'eEF', 'phEF' ] ]
+
+    result = { 'nEvents':nEvents, 'offsets':offsets, 'run':run, 'lumi':lumi, 'evt':evt }
+
+    if isData:
+        result['jsonPassed'] = lumiList.contains_batch( run, lumi ).astype( 'int64' )
+
+    if isMC:
+        result['weight'] = arrays['xsec'].astype( 'float64' )*lumiScaleFactor*arrays['genWeight'] if lumiScaleFactor is not None else np.ones( nEvents )
+    else:
+        result['weight'] = np.ones( nEvents )
+
+    # 'Corr' correction level: L1L2L3 L2res and L1RC
+    jetCorrector = jetCorrector_data if isData else jetCorrector_mc
+    sub_corrections = jetCorrector.subCorrections_batch( rawPt, eta, area, rho[i_event], run[i_event] )
+    pt_corr    = sub_corrections[jetCorrector.levels[-1]]*rawPt
+    pt_corr_RC = sub_corrections['L1RC']*rawPt
+
+    # JER ( nominal, up, down )
+    if isData:
+        jer_factors = np.ones( ( len(rawPt), 3 ) )
+    else:
+        jer_factors = smearer_mc.hybrid_correction_batch( pt = pt_corr, mcPt = flat( 'Jet_mcPt' ), eta = eta, rho = rho[i_event],
+            counters = ( run[i_event], lumi[i_event], evt[i_event], i_jet ) )
+
+    jet_pt = { '':pt_corr, 'jer':jer_factors[:,0]*pt_corr, 'jer_up':jer_factors[:,1]*pt_corr, 'jer_down':jer_factors[:,2]*pt_corr }
+
+    result['Jet_pt_corr']          = pt_corr
+    result['Jet_pt_corr_jer']      = jet_pt['jer']
+    result['Jet_pt_corr_jer_up']   = jet_pt['jer']
+    result['Jet_pt_corr_jer_down'] = jet_pt['jer']
+    result['Jet_isHot']            = ( ~default_hotJetVeto.passVeto_batch( eta, phi ) ).astype( 'int64' )
+
+    randomSwap = ( counterRandom.uniform( run, lumi, evt, -1 )>0.5 )
+
+    # chs MET
+    met_x = met_chsPt*np.cos( met_chsPhi )
+    met_y = met_chsPt*np.sin( met_chsPhi )
+
+    def jet_value( values, sorted_index, position, default ):
+        ''' value of the jet at 'position' in the sorted order of each event, 'default' if there are not enough jets
+        '''
+        exists = ( nJet > position )
+        result = np.full( nEvents, default, dtype = values.dtype )
+        result[exists] = values[ sorted_index[ offsets[:-1][exists] + position ] ]
+        return result
+
+    for jer in ['', 'jer', 'jer_up', 'jer_down']:
+
+        postfix = '' if jer == '' else '_'+jer
+        pt = jet_pt[jer]
+
+        # sorting after JER within each event (stable, as list.sort)
+        sorted_index = np.lexsort( ( -pt, i_event ) )
+
+        tag_index,   probe_index = jet_value( i_jet, sorted_index, 0, -1 ), jet_value( i_jet, sorted_index, 1, -1 )
+        tag_pt,      probe_pt    = jet_value( pt,    sorted_index, 0, 0. ), jet_value( pt,    sorted_index, 1, 0. )
+        tag_eta,     probe_eta   = jet_value( eta,   sorted_index, 0, float('nan') ), jet_value( eta, sorted_index, 1, float('nan') )
+        tag_phi,     probe_phi   = jet_value( phi,   sorted_index, 0, float('nan') ), jet_value( phi, sorted_index, 1, float('nan') )
+
+        # randomize if both are in barrel, tag jet in barrel
+        with np.errstate( invalid = 'ignore' ):
+            swap = ( ( np.abs( tag_eta )<1.3 ) & ( np.abs( probe_eta )<1.3 ) & randomSwap ) | ( ( np.abs( tag_eta )>1.3 ) & ( np.abs( probe_eta )<1.3 ) )
+        tag_index, probe_index = np.where( swap, probe_index, tag_index ), np.where( swap, tag_index, probe_index )
+        tag_pt,    probe_pt    = np.where( swap, probe_pt, tag_pt ),       np.where( swap, tag_pt, probe_pt )
+        tag_phi                = np.where( swap, probe_phi, tag_phi )
+
+        third_index = jet_value( i_jet, sorted_index, 2, -1 )
+        third_pt    = jet_value( pt,    sorted_index, 2, 0. )
+
+        result["tag_jet_index"+postfix]   = tag_index
+        result["probe_jet_index"+postfix] = probe_index
+        result["third_jet_index"+postfix] = third_index
+
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            pt_avg = 0.5*( tag_pt + probe_pt )
+            result["pt_avg"+postfix] = pt_avg
+            result['alpha'+postfix]  = third_pt/pt_avg
+            result['A'+postfix]      = ( probe_pt - tag_pt )/( probe_pt + tag_pt )
+
+            # type-1 MET shifts for chs met L1L2L3 - L1RC 
+            type1 = ( pt > 15 ) & ( ( eEF + phEF ) < 0.9 )
+            chs_MEx_corr = met_x + np.bincount( i_event[type1], weights = ( ( pt_corr_RC - pt )*np.cos( phi ) )[type1], minlength = nEvents )
+            chs_MEy_corr = met_y + np.bincount( i_event[type1], weights = ( ( pt_corr_RC - pt )*np.sin( phi ) )[type1], minlength = nEvents )
+            result["chs_MEx_corr"+postfix]   = chs_MEx_corr
+            result["chs_MEy_corr"+postfix]   = chs_MEy_corr
+            result["chs_MEt_corr"+postfix]   = np.sqrt( chs_MEx_corr**2 + chs_MEy_corr**2 )
+            result["chs_MEphi_corr"+postfix] = np.arctan2( chs_MEy_corr, chs_MEx_corr )
+
+            # R(MPF)
+            result['B'+postfix] = ( chs_MEx_corr*tag_pt*np.cos( tag_phi ) + chs_MEy_corr*tag_pt*np.sin( tag_phi ) )/tag_pt/( tag_pt + probe_pt )
+
+    return result
+
+columnar_event_variables = [ x.split('/')[0] for x in new_variables if not x.startswith('Jet[') ]
+columnar_jet_variables   = [ 'Jet_pt_corr', 'Jet_pt_corr_jer', 'Jet_pt_corr_jer_up', 'Jet_pt_corr_jer_down', 'Jet_isHot' ]
+
+def columnar_filler( event ):
+    # shortcut
+    r = reader.event
+    i = columns['position']
+    columns['position'] += 1
+
+    if ( columns['run'][i], columns['lumi'][i], columns['evt'][i] ) != ( r.run, r.lumi, r.evt ):
+        raise RuntimeError( "Columnar arrays out of sync with the reader at position %i: %r vs. %r" % ( i, ( columns['run'][i], columns['lumi'][i], columns['evt'][i] ), ( r.run, r.lumi, r.evt ) ) )
+
+    # lumi lists and vetos
+    if isData:
+        # store decision to use after filler has been executed
+        event.jsonPassed_ = columns['jsonPassed'][i].item()
+
+    for var in columnar_event_variables:
+        setattr( event, var, columns[var][i].item() )
+
+    first, last = columns['offsets'][i], columns['offsets'][i+1]
+    for var in columnar_jet_variables:
+        branch = getattr( event, var )
+        for iJet, value in enumerate( columns[var][first:last].tolist() ):
+            branch[iJet] = value
+
 # Create a maker. Maker class will be compiled. 
 treeMaker_parent = TreeMaker(
-    sequence  = [ filler ],
+    sequence  = [ columnar_filler if options.columnar else filler ],
     variables = [ TreeVariable.fromString(x) for x in new_variables ],
     treeName = "Events"
     )
@@ -365,26 +595,58 @@ jobs = [(i, eventRanges[i]) for i in range(len(eventRanges))]
 
 filename, ext = os.path.splitext( os.path.join(output_directory, sample.name + '.root') )
 
-clonedEvents = 0
-convertedEvents = 0
-outputLumiList = {}
-for ievtRange, eventRange in enumerate( eventRanges ):
+# Everything that changes the output of a range. Ranges in the manifest with a different hash are reprocessed.
+skim_config = {
+    'jec_data':         Summer16_03Feb2017_DATA,
+    'jec_mc':           Summer16_03Feb2017_MC,
+    'levels_data':      correction_levels_data,
+    'levels_mc':        correction_levels_mc,
+    'jer_era':          jer_era,
+    'jer_seed':         JetSmearer.random_seed,
+    'json':             json if isData else None,
+    'skimConds':        skimConds,
+    'branchKeepStrings':branchKeepStrings,
+    'new_variables':    new_variables,
+    'small':            options.small,
+    'prefilter':        options.prefilter,
+}
+config_hash = skimManifest.configHash( skim_config )
+manifest    = skimManifest.load( output_directory )
+
+def rangeFiles( eventRange ):
+    ''' Input files spanned by the event range
+    '''
+    i_files = []
+    for i_event in [ eventRange[0], eventRange[1]-1 ]:
+        sample.chain.LoadTree( reader.eventList.GetEntry( i_event ) )
+        i_files.append( sample.chain.GetTreeNumber() )
+    return sample.files[ i_files[0]:i_files[1]+1 ]
+
+def processRange( job ):
+    ''' Skim one event range into its own output file. Returns the number of cloned & converted events and the processed lumis.
+    '''
+    ievtRange, eventRange, files = job
+    job_eventRange = eventRange
 
-    if len(options.job)>0 and not ievtRange in options.job: continue
+    clonedEvents    = 0
+    convertedEvents = 0
+    outputLumiList  = LumiAccumulator()
 
     logger.info( "Processing range %i/%i from %i to %i which are %i events.",  ievtRange, len(eventRanges), eventRange[0], eventRange[1], eventRange[1]-eventRange[0] )
 
-    # Check whether file exists
+    # Check the manifest whether the output is up to date
     outfilename = filename+'_'+str(ievtRange)+ext
-    if os.path.isfile(outfilename):
-        logger.info( "Output file %s found.", outfilename)
-        if not helpers.checkRootFile(outfilename, checkForObjects=["Events"]):
-            logger.info( "File %s is broken. Overwriting.", outfilename)
-        elif not options.overwrite:
-            logger.info( "Skipping.")
-            continue
+    record = manifest.get( str(ievtRange) )
+    if skimManifest.isUpToDate( record, outfilename, files, eventRange, config_hash ):
+        if not options.overwrite:
+            logger.info( "Output file %s is up to date. Skipping.", outfilename)
+            # lumis of the range from the previous processing
+            outputLumiList.update( record.get( 'lumis', {} ) )
+            return clonedEvents, convertedEvents, outputLumiList, None
         else:
-            logger.info( "Overwriting.")
+            logger.info( "Output file %s is up to date. Overwriting.", outfilename)
+    elif os.path.isfile(outfilename):
+        logger.info( "Output file %s is stale or not in the manifest. Overwriting.", outfilename)
 
     tmp_directory = ROOT.gDirectory
     outputfile = ROOT.TFile.Open(outfilename, 'recreate')
@@ -398,6 +660,12 @@ for ievtRange, eventRange in enumerate( eventRanges ):
     # Set the reader to the event range
     reader.setEventRange( eventRange )
 
+    if options.columnar:
+        columns.clear()
+        columns.update( computeColumns( eventRange ) )
+        columns['position'] = 0
+        logger.info( "Computed columns for %i events.", columns['nEvents'] )
+
     clonedTree = reader.cloneTree( branchKeepStrings, newTreename = "Events", rootfile = outputfile )
     clonedEvents += clonedTree.GetEntries()
     # Clone the empty maker in order to avoid recompilation at every loop iteration
@@ -411,11 +679,7 @@ for ievtRange, eventRange in enumerate( eventRanges ):
         maker.run()
         if isData:
             if maker.event.jsonPassed_:
-                if reader.event.run not in outputLumiList.keys():
-                    outputLumiList[reader.event.run] = set([reader.event.lumi])
-                else:
-                    if reader.event.lumi not in outputLumiList[reader.event.run]:
-                        outputLumiList[reader.event.run].add(reader.event.lumi)
+                outputLumiList.add( reader.event.run, reader.event.lumi )
 
     convertedEvents += maker.tree.GetEntries()
     maker.tree.Write()
@@ -425,15 +689,75 @@ for ievtRange, eventRange in enumerate( eventRanges ):
   # Destroy the TTree
     maker.clear()
 
-logger.info( "Converted %i events of %i, cloned %i",  convertedEvents, reader.nEvents , clonedEvents )
+    record = skimManifest.makeRecord( outfilename, files, job_eventRange, config_hash, 
+        lumis = { str(run):sorted(lumis) for run, lumis in outputLumiList.runsAndLumis.iteritems() } )
+
+    return clonedEvents, convertedEvents, outputLumiList, record
+
+def processJob( job ):
+    ''' ( range index, result of processRange ), such that the parent can checkpoint the range when it is done
+    '''
+    return job[0], processRange( job )
+
+if len(options.job)>0:
+    jobs = [ job for job in jobs if job[0] in options.job ]
 
-# Avoid segfault
-if not isData: smearer_mc.delete()
+jobs = [ ( i, eventRange, rangeFiles( eventRange ) ) for i, eventRange in jobs ]
+
+def initWorker( files, treeName, entries ):
+    ''' Pool initializer: the worker opens the input files with its own chain and reader, such that no file
+        (and read offset) of the parent is shared. The event list of the parent is restored from its entry numbers, 
+        hence the event ranges refer to the same events. The entries passed the selection already, the reader is made 
+        without selection string (no Draw of the selection in the worker) and gets the restored event list.
+    '''
+    global sample, reader
+    sample = Sample.fromFiles( sample.name, files = files, treeName = treeName )
+    eventList = ROOT.TEventList( "worker_%s" % sample.name )
+    for entry in entries:
+        eventList.Enter( entry )
+    sample.chain.SetEventList( eventList )
+    reader = sample.treeReader( \
+        variables = read_variables ,
+        )
+    reader.eventList = eventList
+    reader.nEvents   = eventList.GetN()
+
+if options.workers > 1:
+    # Each worker is a fork with its own chain, reader and maker and writes its own output file. 
+    # Only the file list and the entry numbers are passed, no ROOT object.
+    from multiprocessing import Pool
+    entries = [ reader.eventList.GetEntry( i ) for i in xrange( reader.eventList.GetN() ) ]
+    pool = Pool( processes = options.workers, initializer = initWorker, initargs = ( sample.files, sample.treeName, entries ) )
+    finished = pool.imap_unordered( processJob, jobs )
+else:
+    pool = None
+    finished = itertools.imap( processJob, jobs )
+
+# Checkpoint every range in the manifest as soon as it is done, an interrupted skim resumes from there
+results = []
+for ievtRange, result in finished:
+    results.append( result )
+    if result[3] is not None:
+        skimManifest.update( output_directory, { str(ievtRange):result[3] } )
+        logger.info( "Updated range %i in manifest of %s", ievtRange, output_directory )
+
+if pool is not None:
+    pool.close()
+    pool.join()
+
+# Merge the results of all ranges
+clonedEvents    = sum( r[0] for r in results )
+convertedEvents = sum( r[1] for r in results )
+outputLumiList  = LumiAccumulator()
+for r in results:
+    outputLumiList.update( r[2] )
+
+logger.info( "Converted %i events of %i, cloned %i",  convertedEvents, reader.nEvents , clonedEvents )
 
 # Storing JSON file of processed events
 if isData:
     jsonFile = filename+'.json'
-    LumiList( runsAndLumis = outputLumiList ).writeJSON(jsonFile)
+    outputLumiList.writeJSON(jsonFile)
     logger.info( "Written JSON file %s",  jsonFile )
 
 logger.info("Copying log file to %s", output_directory )
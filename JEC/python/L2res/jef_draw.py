@@ -29,6 +29,7 @@ argParser.add_argument('--ptBin',              action='store',      default=(163
 argParser.add_argument('--etaBin',             action='store',      default=(2.853, 2.964),    type = float,  nargs=2,  help="probe jet eta bin" )
 argParser.add_argument('--etaSign',            action='store',      default=0             ,    type = int,    choices = [-1,0,+1], help="sign of probe jet eta." )
 argParser.add_argument('--small',                                   action='store_true',       help='Run only on a small subset of the data?')#, default = True)
+argParser.add_argument('--workers',                                 action='store',      default=1, type=int, help='Number of processes filling (sample, file) pairs in parallel' )
 argParser.add_argument('--cleaned',                                 action='store_true',       help='Apply jet cleaning in data')#, default = True)
 argParser.add_argument('--bad',                                     action='store_true',       help='Cut on phEF*pT>300')#, default = True)
 argParser.add_argument('--fraction',                                action='store_true',       help='plot energy fraction.')#, default = True)
@@ -226,7 +227,12 @@ elif args.observable == 'phi':
 #h_MC =      mc.get1DHistoFromDraw(variableString = drawString, binning = binning, weightString = weightString )
 #normHisto(h_MC)
 
-h_data    = {s.name:s.get1DHistoFromDraw(variableString = drawString, binning = binning, weightString=weightString) for s in data }
+# all eras in one parallel pass over their files
+from JetMET.tools.histoFiller    import makeHisto
+from JetMET.tools.parallelFiller import ParallelFiller
+filler    = ParallelFiller( workers = args.workers )
+h_data    = {s.name:filler.book( s, makeHisto( binning ), drawString, weightString=weightString) for s in data }
+filler.fill()
 
 #h_MC.style = styles.lineStyle( ROOT.kBlack ) 
 #h_MC.legendText = "QCD Pt binned"
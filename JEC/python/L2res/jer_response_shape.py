@@ -119,15 +119,17 @@ plots = [
 
 h = {p[0]:{} for p in plots}
 
+# Book all JER variations and variables and read the chain once
+from JetMET.tools.histoFiller import HistoFiller, makeHisto
+mc.setSelectionString( "(1)" )
+filler = HistoFiller( mc.chain )
+
 for i_jer, jer in enumerate( ['', 'jer', 'jer_up', 'jer_down'] ):
 
     postfix = '' if jer=='' else '_'+jer
 
-    mc.setSelectionString( "(1)" )
     selectionString =  "&&".join(c[1] for c in selection)
     selectionString = selectionString.replace('pt_avg', 'pt_avg%s'%postfix)
-    
-    mc.addSelectionString( selectionString )
      
     weightString   = "weight"
     if args.ptHatExp is not None:
@@ -137,7 +139,12 @@ for i_jer, jer in enumerate( ['', 'jer', 'jer_up', 'jer_down'] ):
 
         logger.info( "Sample %s jer '%s' var '%s' weightString '%s'", mc.name, jer, var, weightString )
         var_string = "%s%s"%( var, postfix) if var in ['A', 'B', 'pt_avg'] else var
-        h[var][jer] = mc.get1DHistoFromDraw(variableString = var_string, binning = binning, weightString=weightString )
+        h[var][jer] = filler.bookSample( mc, makeHisto( binning ), var_string, weightString = weightString, selectionString = selectionString )
+
+filler.fill()
+
+for i_jer, jer in enumerate( ['', 'jer', 'jer_up', 'jer_down'] ):
+    for var, binning in plots:
         h[var][jer].legendText =  'nominal' if jer=='' else jer
         h[var][jer].legendText += " (%3.2f#pm%3.2f)"%( h[var][jer].GetMean(), h[var][jer].GetMeanError() ) 
         h[var][jer].style = styles.lineStyle( colors[ i_jer ] ) 
@@ -0,0 +1,89 @@
+''' Linear extrapolation of the response to alpha -> 0 for the kFSR correction.
+    kFSRLinearFit_batch solves the weighted least squares problems of all (eta, pt, var, sample) cells at once,
+    kFSRLinearFit makes the ROOT objects (graph with fitted line, 1 sigma band) for the plots.
+'''
+# Standard imports
+import ROOT
+import array
+import uuid
+import numpy as np
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+def kFSRLinearFit_batch( alpha, response, response_error ):
+    ''' Fit response = d0 + k*alpha for arrays of shape (cells, alpha points). Points with NaN or non-positive
+        errors are ignored. Returns a dictionary of arrays d0, d0_error, k, k_error, cov (cells, 2, 2), chi2, ndof.
+        Cells with less than two points give NaN.
+    '''
+    alpha    = np.asarray( alpha, dtype = 'float64' )
+    response = np.asarray( response, dtype = 'float64' )
+    error    = np.asarray( response_error, dtype = 'float64' )
+    alpha, response, error = np.broadcast_arrays( alpha, response, error )
+
+    valid = np.isfinite( response ) & np.isfinite( error ) & ( error > 0 )
+    w     = np.where( valid, 1./np.where( valid, error, 1. )**2, 0. )
+    x     = np.where( valid, alpha, 0. )
+    y     = np.where( valid, response, 0. )
+
+    # normal equations S (d0, k) = b with S = [[sum w, sum wx], [sum wx, sum wx^2]]
+    s0, s1, s2 = w.sum( axis = 1 ), ( w*x ).sum( axis = 1 ), ( w*x*x ).sum( axis = 1 )
+    b0, b1     = ( w*y ).sum( axis = 1 ), ( w*x*y ).sum( axis = 1 )
+    det        = s0*s2 - s1**2
+    ok         = ( valid.sum( axis = 1 ) >= 2 ) & ( det > 0 )
+    det_       = np.where( ok, det, 1. )
+
+    cov        = np.empty( ( len( s0 ), 2, 2 ) )
+    cov[:,0,0], cov[:,0,1], cov[:,1,0], cov[:,1,1] = s2/det_, -s1/det_, -s1/det_, s0/det_
+    d0         = ( s2*b0 - s1*b1 )/det_
+    k          = ( s0*b1 - s1*b0 )/det_
+
+    chi2       = ( w*( y - d0[:, np.newaxis] - k[:, np.newaxis]*x )**2 ).sum( axis = 1 )
+    ndof       = valid.sum( axis = 1 ) - 2
+
+    nan = np.full( len( s0 ), np.nan )
+    cov[~ok] = np.nan
+    return {
+        'd0':       np.where( ok, d0, nan ),
+        'd0_error': np.where( ok, np.sqrt( np.abs( cov[:,0,0] ) ), nan ),
+        'k':        np.where( ok, k, nan ),
+        'k_error':  np.where( ok, np.sqrt( np.abs( cov[:,1,1] ) ), nan ),
+        'cov':      cov,
+        'chi2':     np.where( ok, chi2, nan ),
+        'ndof':     ndof,
+    }
+
+def kFSRLinearFit( data, fit = None ):
+    ''' data is a list of {'alpha', 'response', 'response_error'}. 'fit' is the result of kFSRLinearFit_batch for
+        this cell (a dictionary of scalars and a 2x2 'cov'); if None, the fit is done here.
+        Returns the fit results together with a TGraphErrors (fitted line attached) and the 1 sigma band as
+        'quantile_functions' { 0.16: lower, 0.84: upper }.
+    '''
+    if fit is None:
+        batch = kFSRLinearFit_batch(
+            [ [ d['alpha'] for d in data ] ], [ [ d['response'] for d in data ] ], [ [ d['response_error'] for d in data ] ] )
+        fit   = { key: value[0] for key, value in batch.iteritems() }
+
+    result = { key: fit[key] for key in [ 'd0', 'd0_error', 'k', 'k_error', 'chi2', 'ndof' ] }
+    result['cov'] = fit['cov']
+
+    tgraph = ROOT.TGraphErrors( len( data ),
+        array.array('d', [ d['alpha'] for d in data ] ), array.array('d', [ d['response'] for d in data ] ),
+        array.array('d', [ 0. for d in data ] ),         array.array('d', [ d['response_error'] for d in data ] ) )
+    line = ROOT.TF1( str(uuid.uuid1()), "[0]+[1]*x", 0, 1 )
+    line.SetParameters( fit['d0'], fit['k'] )
+    line.SetParErrors( array.array('d', [ fit['d0_error'], fit['k_error'] ] ) )
+    tgraph.GetListOfFunctions().Add( line )
+
+    # 1 sigma band of the line: sqrt( var(d0) + x^2 var(k) + 2x cov(d0,k) )
+    quantile_functions = {}
+    for quantile, sign in [ ( 0.16, -1 ), ( 0.84, +1 ) ]:
+        f = ROOT.TF1( str(uuid.uuid1()), "[0]+[1]*x+[2]*sqrt(abs([3]+x*x*[4]+2*x*[5]))", 0, 1 )
+        for i_par, par in enumerate( [ fit['d0'], fit['k'], sign, fit['cov'][0][0], fit['cov'][1][1], fit['cov'][0][1] ] ):
+            f.SetParameter( i_par, par )
+        quantile_functions[quantile] = f
+
+    result['tgraph']             = tgraph
+    result['quantile_functions'] = quantile_functions
+    return result
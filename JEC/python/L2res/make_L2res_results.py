@@ -11,6 +11,7 @@ import itertools
 import os
 import array
 import pickle
+import numpy as np
 
 from math                                import sqrt, cos, sin, pi, atan2
 from RootTools.core.standard             import *
@@ -18,7 +19,7 @@ from JetMET.tools.user                   import plot_directory as user_plot_dire
 from JetMET.tools.helpers                import deltaPhi, deltaR
 
 # Gaussian (Roo-)Fit
-from JetMET.JEC.L2res.GaussianFit        import GaussianFit
+from JetMET.JEC.L2res.GaussianFit        import GaussianFit_batch, GaussianFit_pool
 
 # Object selection
 from JetMET.tools.objectSelection        import getFilterCut, getJets, jetVars
@@ -38,8 +39,15 @@ argParser.add_argument('--small',                                   action='stor
 argParser.add_argument('--cleaned',                                 action='store_true',     help='Apply jet cleaning in data', default = True)
 argParser.add_argument('--jer',                action='store',      default='',              nargs='?', choices=['', 'jer', 'jer_up', 'jer_down'], help="JER variation" )
 argParser.add_argument('--makeResponsePlots',                       action='store_true',     help='Make A/B plots?')#, default = True)
-argParser.add_argument('--overwrite',                               action='store_true',     help='Overwrite results.pkl?')
+argParser.add_argument('--overwrite',                               action='store_true',     help='Overwrite results.pkl? (ignore the result cache)')
+argParser.add_argument('--cacheDirectory',     action='store',      default=None,            help='Directory of the result cache. Default: <cache_directory>/L2res_results' )
+argParser.add_argument('--cacheSize',          action='store',      default=2.,              type=float, help='Maximum size of the result cache in GB' )
 argParser.add_argument('--useFit',                                  action='store_true',     help='Use a fit to determine the response')#, default= True
+argParser.add_argument('--fitBackend',         action='store',      default='roofit',        nargs='?', choices=['roofit', 'numpy'], help="RooFit fits in a process pool (--workers) or vectorized least squares fits of all cells" )
+argParser.add_argument('--fitPlots',                                action='store_true',     help='Write a diagnostic png for every RooFit fit')
+argParser.add_argument('--alphaScan',                             action='store_true',     help='Also fill the TH3Ds for all kFSR alpha points, independent of --alpha (alpha_scan_results.pkl for make_kFSR.py)')
+argParser.add_argument('--workers',            action='store',      default=1,               type=int, help='Number of processes filling (sample, file) pairs in parallel' )
+argParser.add_argument('--profileIO',                               action='store_true',     help='Write a branch level I/O profile for each sample')
 argParser.add_argument('--metOverSumET',                            action='store_true',     help='add MET/sumET<0.2 cut')#, default= True
 argParser.add_argument('--plot_directory',     action='store',      default='JEC/L2res_v11_03FebV6', help="subdirectory for plots")
 args = argParser.parse_args()
@@ -220,10 +228,16 @@ samples = [ mc, data ]
 selection = [
    ("tgb",                      "abs(Jet_eta[tag_jet_index%s])<1.3"%jer_postfix),
    ("btb",                      "cos(Jet_phi[tag_jet_index%s] - Jet_phi[probe_jet_index%s]) < cos(2.7)"%(jer_postfix,jer_postfix)),
-   ("a%i"% ( 100*args.alpha ),  "alpha%s<%f" % ( jer_postfix, args.alpha) ), 
    ("failIdVeto",               "Sum$(JetFailId_pt*(JetFailId_pt>30))<30"), 
 ]
 
+# alpha cut: part of the sample selection, or with --alphaScan applied per histogram such that the scan is not limited by --alpha
+def alphaCut( alpha ):
+    return "alpha%s<%f" % ( jer_postfix, alpha )
+if not args.alphaScan:
+    selection.insert( 2, ("a%i"% ( 100*args.alpha ), alphaCut( args.alpha ) ) )
+nominal_alpha_cut = alphaCut( args.alpha ) if args.alphaScan else None
+
 if args.cleaned:
     from JetMET.JEC.L2res.jet_cleaning import jet_cleaning
     selection.append( ("jet_cleaning", jet_cleaning ) )
@@ -241,48 +255,129 @@ for s in samples:
 data.addSelectionString( ("("+"||".join(triggers)+")").replace("pt_avg", "pt_avg%s"%jer_postfix ) )
 colors = [ j+1 for j in range(0,9) ] + [ j+31 for j in range(9,18) ]
 
-from JetMET.JEC.L2res.thresholds import pt_avg_thresholds, pt_avg_bins, eta_thresholds, abs_eta_thresholds
+from JetMET.JEC.L2res.thresholds import pt_avg_thresholds, pt_avg_bins, eta_thresholds, abs_eta_thresholds, kFSR_alpha_values
 
 thresholds = [-1.2+x*2.4/96. for x in range(97)]
 
 weightString  = "weight"
 
 results_file  = os.path.join( plot_directory, 'results.pkl' )
+# the alpha scan doesn't depend on --alpha and is written one level above the a<alpha> directory
+alpha_scan_file = os.path.join( os.path.dirname( plot_directory ), 'alpha_scan_results.pkl' )
+# alpha points for the kFSR extrapolation, filled in the same pass
+scan_alpha_values = list( kFSR_alpha_values ) if args.alphaScan else []
 
 h = {}
 p = {}
-
-if os.path.exists( results_file ) and not args.overwrite:
-    h, p = pickle.load( file (results_file ) )
-    logger.info( "Loaded %s", results_file )
+h_alpha = {} # alpha -> var -> sample -> TH3D
+
+# Results are cached under the hash of everything they depend on
+import JetMET.tools.histoFiller, JetMET.tools.parallelFiller
+from JetMET.tools.resultCache import ResultCache, makeKey, fileStamps, codeVersion
+if args.cacheDirectory is None:
+    try:
+        from JetMET.tools.user import cache_directory
+    except ImportError:
+        cache_directory = os.path.join( user_plot_directory, 'cache' )
+    args.cacheDirectory = os.path.join( cache_directory, 'L2res_results' )
+cache = ResultCache( args.cacheDirectory, maxSize = int( args.cacheSize*1024**3 ) )
+
+results_key = makeKey( 
+    files     = { s.name:fileStamps( s.files ) for s in samples },
+    selection = { s.name:s.selectionString for s in samples },
+    alphaCut  = nominal_alpha_cut,
+    weight    = { s.name:s.combineWithSampleWeight( weightString ) for s in samples },
+    variables = [ pt_binning_variable, "Jet_eta[probe_jet_index%s]"%jer_postfix, "A"+jer_postfix, "B"+jer_postfix ],
+    binning   = [ thresholds, eta_thresholds, pt_avg_thresholds ],
+    alphaScan = scan_alpha_values,
+    code      = codeVersion( __file__, JetMET.tools.histoFiller.__file__, JetMET.tools.parallelFiller.__file__ ),
+    )
+
+cached = cache.get( results_key ) if not args.overwrite else None
+if cached is not None:
+    h, p, h_alpha = cached
+    logger.info( "Loaded results %s from cache", results_key )
 else: 
+    from JetMET.tools.parallelFiller import ParallelFiller
+    filler = ParallelFiller( workers = args.workers )
+    draw_expressions = { s.name:[] for s in samples }
     for var in [ "A", "B" ]:
         h[var] = {}
         p[var] = {}
         for s in samples:
-            logger.info( "Make TH3D for sample %s and variable %s", s.name, var )
+            logger.info( "Book TH3D for sample %s and variable %s", s.name, var )
             h[var][s.name] = ROOT.TH3D( "h_%s_%s"%( var, s.name), "h_%s_%s"%(var, s.name),\
                     len(thresholds) - 1, array.array('d', thresholds), 
                     len(eta_thresholds)-1, array.array('d', eta_thresholds), 
                     len(pt_avg_thresholds) - 1, array.array('d', pt_avg_thresholds)  
                 )
 
-            weight_ = "("+s.selectionString+")*("+s.combineWithSampleWeight(weightString)+")"
-            varString_ = pt_binning_variable+":Jet_eta[probe_jet_index%s]:%s>>h_%s_%s"%( jer_postfix, var+jer_postfix, var, s.name )
+            varString_ = pt_binning_variable+":Jet_eta[probe_jet_index%s]:%s"%( jer_postfix, var+jer_postfix )
+
+            logger.info("Using %s %s", varString_, weightString ) 
+            filler.book( s, h[var][s.name], varString_, weightString = weightString, selectionString = nominal_alpha_cut )
+            draw_expressions[s.name] += [ varString_, s.selectionString, s.combineWithSampleWeight(weightString) ] + ( [ nominal_alpha_cut ] if nominal_alpha_cut else [] )
 
-            logger.info("Using %s %s", varString_, weight_ ) 
-            s.chain.Draw( varString_, weight_, 'goff')
+            # one TH3D per alpha point of the kFSR extrapolation, alpha is a branch of the skim
+            for alpha in scan_alpha_values:
+                if not h_alpha.has_key( alpha ): h_alpha[alpha] = {}
+                if not h_alpha[alpha].has_key( var ): h_alpha[alpha][var] = {}
+                h_alpha[alpha][var][s.name] = h[var][s.name].Clone( "h_%s_%s_a%i"%( var, s.name, 100*alpha ) )
+                filler.book( s, h_alpha[alpha][var][s.name], varString_, weightString = weightString, selectionString = alphaCut( alpha ) )
 
-    if not os.path.exists(os.path.dirname( results_file )): os.makedirs( os.path.dirname( results_file ) ) 
-    pickle.dump( ( h, p ), file( results_file, 'w' ) )
-    logger.info( "Written %s", results_file )
+    # A and B of all samples, one pass over each file
+    filler.fill()
 
-# Make all the projections
+    if args.profileIO:
+        from JetMET.tools.branchProfiler import profileChain
+        for s in samples:
+            profileChain( s.chain, os.path.join( plot_directory, 'io_profile_%s.txt' % s.name ), used_expressions = draw_expressions[s.name] )
+
+    cache.put( results_key, ( h, p, h_alpha ) )
+
+# results.pkl is read by make_kFSR.py
+if not os.path.exists(os.path.dirname( results_file )): os.makedirs( os.path.dirname( results_file ) ) 
+pickle.dump( ( h, p ), file( results_file, 'w' ) )
+logger.info( "Written %s", results_file )
+
+# alpha_scan_results.pkl replaces the results.pkl of the individual alpha runs in make_kFSR.py --alphaScan
+if args.alphaScan:
+    pickle.dump( h_alpha, file( alpha_scan_file, 'w' ) )
+    logger.info( "Written %s", alpha_scan_file )
+
+# Moments of the A/B distributions in all (eta, pt_avg) cells at once from the TH3D content,
+# folded into negative, positive and absolute eta
+from JetMET.tools.histoArrays import th3ToArrays, axisEdges, findBins, moments
+abs_eta_centers = 0.5*( np.array( abs_eta_thresholds[:-1] ) + np.array( abs_eta_thresholds[1:] ) )
+pt_avg_centers  = np.array( [ 0.5*sum(pt_avg_bin) for pt_avg_bin in pt_avg_bins ] )
+asymmetry_moments = {} # var -> sample -> sign -> ( mean, rms, error ) arrays indexed [i_aeta, i_pt_avg_bin]
+asymmetry_cells   = {} # var -> sample -> sign -> ( content, sumw2 ) arrays indexed [i_x, i_aeta, i_pt_avg_bin]
+for var in [ "A", "B" ]:
+    asymmetry_moments[var] = {}
+    asymmetry_cells[var]   = {}
+    for s in samples:
+        content, sumw2 = th3ToArrays( h[var][s.name] )
+        x_axis = h[var][s.name].GetXaxis()
+        x_centers = [ x_axis.GetBinCenter( i ) for i in range( 1, x_axis.GetNbins() + 1 ) ]
+        eta_edges = axisEdges( h[var][s.name].GetYaxis() )
+        bin_y     = findBins( eta_edges,  abs_eta_centers )
+        neg_bin_y = findBins( eta_edges, -abs_eta_centers )
+        bin_z     = findBins( axisEdges( h[var][s.name].GetZaxis() ), pt_avg_centers )
+
+        # x under- and overflow are not used in the mean (as in TH1::GetMean)
+        content, sumw2 = content[1:-1], sumw2[1:-1]
+        pos    = ( content[:, bin_y][:, :, bin_z],     sumw2[:, bin_y][:, :, bin_z] )
+        neg    = ( content[:, neg_bin_y][:, :, bin_z], sumw2[:, neg_bin_y][:, :, bin_z] )
+        cells  = { 'pos_eta':pos, 'neg_eta':neg, 'abs_eta':( pos[0] + neg[0], pos[1] + neg[1] ) }
+        asymmetry_moments[var][s.name] = { sign:moments( c, w2, x_centers ) for sign, ( c, w2 ) in cells.iteritems() }
+        asymmetry_cells[var][s.name]   = cells
+
+# Make all the projections (only needed for the fits and the response shape plots)
 # x ... A,B
 # y ... eta
 # z ... pt_avg
 projections          = {} # Used to store projections of TH3D
-for var in [ "A", "B" ]:
+for var in [ "A", "B" ] if ( ( args.useFit and args.fitBackend == 'roofit' ) or args.makeResponsePlots ) else []:
     projections[var]          = {}
     for s in samples:
         projections[var][s.name] = {'neg_eta':{}, 'pos_eta':{}, 'abs_eta':{}}
@@ -306,15 +401,52 @@ for var in [ "A", "B" ]:
 
 
 response_results_file    = os.path.join( plot_directory, 'response_%s_results.pkl'%( 'fit' if args.useFit else 'mean' ) )
-if os.path.exists( response_results_file ):
-    response, response_plots_pt, response_plots_eta = pickle.load(file( response_results_file ))
-    logger.info( 'Loaded response results from %s', response_results_file )
+import JetMET.JEC.L2res.GaussianFit
+response_key = makeKey( 
+    results   = results_key,
+    useFit    = args.useFit,
+    backend   = args.fitBackend if args.useFit else None,
+    binning   = [ abs_eta_thresholds, pt_avg_bins ],
+    code      = codeVersion( __file__, JetMET.JEC.L2res.GaussianFit.__file__ ),
+    )
+cached = cache.get( response_key ) if not args.overwrite else None
+if cached is not None:
+    response, response_plots_pt, response_plots_eta = cached
+    logger.info( 'Loaded response results %s from cache', response_key )
 else:
 
     response = {} # result dictionary
     response_plots_pt = {} # plots vs. pt
     response_plots_eta = {} # plots vs eta
 
+    # Gaussian fits of all cells, either vectorized or with RooFit in a process pool
+    asymmetry_fits = {} # var -> sample -> sign -> ( mean, error ) arrays indexed [i_aeta, i_pt_avg_bin]
+    if args.useFit and args.fitBackend == 'numpy':
+        for var in [ "A", "B" ]:
+            asymmetry_fits[var] = { s.name:{ sign:GaussianFit_batch( c, w2, x_centers )[:2] for sign, ( c, w2 ) in asymmetry_cells[var][s.name].iteritems() } for s in samples }
+    elif args.useFit:
+        jobs, fit_cells = [], []
+        for var in [ "A", "B" ]:
+            asymmetry_fits[var] = {}
+            for s in samples:
+                asymmetry_fits[var][s.name] = {}
+                for sign in [ 'neg_eta', 'pos_eta', 'abs_eta' ]:
+                    asymmetry_fits[var][s.name][sign] = ( np.zeros( ( len(abs_eta_thresholds)-1, len(pt_avg_bins) ) ), np.zeros( ( len(abs_eta_thresholds)-1, len(pt_avg_bins) ) ) )
+                    for i_aeta in range(len(abs_eta_thresholds)-1):
+                        eta_bin = tuple(abs_eta_thresholds[i_aeta:i_aeta+2])
+                        for i_pt_avg_bin, pt_avg_bin in enumerate(pt_avg_bins):
+                            jobs.append( { 
+                                'shape'               : projections[var][s.name][sign][eta_bin][pt_avg_bin],
+                                'isData'              : s.name == data.name,
+                                'var_name'            : "%s-symmetry" % var, 
+                                'fit_plot_directory'  : os.path.join( plot_directory, 'fit'), 
+                                'fit_filename'        : "fitresult_%s_%s_%i_%i_pt_%i_%i_%s" % ( var, sign, 1000*eta_bin[0], 1000*eta_bin[1], pt_avg_bin[0], pt_avg_bin[1], s.name ) if args.fitPlots else None,
+                                } )
+                            fit_cells.append( ( var, s.name, sign, i_aeta, i_pt_avg_bin ) )
+        for ( var, name, sign, i_aeta, i_pt_avg_bin ), ( mean, error ) in zip( fit_cells, GaussianFit_pool( jobs, workers = args.workers ) ):
+            asymmetry_fits[var][name][sign][0][i_aeta, i_pt_avg_bin] = mean
+            asymmetry_fits[var][name][sign][1][i_aeta, i_pt_avg_bin] = error
+
     for var in [ "A", "B" ]:
 
         response[var]           = {}
@@ -350,21 +482,17 @@ else:
                     for i_pt_avg_bin, pt_avg_bin in enumerate(pt_avg_bins):
 
                         # make life easy
-                        shape = projections[var][s.name][sign][eta_bin][pt_avg_bin]
                         h_pt  = response_plots_pt[var][s.name][sign][eta_bin]
                         h_eta = response_plots_eta[var][s.name][pt_avg_bin]
 
                         if (args.useFit):
-                            mean_asymmetry, mean_asymmetry_error = GaussianFit( 
-                                shape               = shape,
-                                isData              = s.name == data.name,
-                                var_name            = "%s-symmetry" % var, 
-                                fit_plot_directory  = os.path.join( plot_directory, 'fit'), 
-                                fit_filename        = "fitresult_%s_%s_%i_%i_pt_%i_%i_%s" % ( var, sign, 1000*eta_bin[0], 1000*eta_bin[1], pt_avg_bin[0], pt_avg_bin[1], s.name ) 
-                                )
+                            mean, error           = asymmetry_fits[var][s.name][sign]
+                            mean_asymmetry        = mean[i_aeta, i_pt_avg_bin]
+                            mean_asymmetry_error  = error[i_aeta, i_pt_avg_bin]
                         else:
-                            mean_asymmetry        = shape.GetMean()           
-                            mean_asymmetry_error  = shape.GetMeanError() 
+                            mean, rms, error      = asymmetry_moments[var][s.name][sign]
+                            mean_asymmetry        = mean[i_aeta, i_pt_avg_bin]
+                            mean_asymmetry_error  = error[i_aeta, i_pt_avg_bin]
 
                         mean_response = (1 + mean_asymmetry)/(1 - mean_asymmetry)
                         mean_response_error = 2.*mean_asymmetry_error/(1 - mean_asymmetry)**2 # f(x) = (1+x)/(1-x) -> f'(x) = 2/(x-1)**2
@@ -386,8 +514,11 @@ else:
                                 h_eta.SetBinError  ( h_eta.FindBin( sign_*0.5*sum(eta_bin) ), mean_response_error )
 
 
-    pickle.dump( ( response, response_plots_pt, response_plots_eta ), file(response_results_file, 'w') ) 
-    logger.info( 'Written response results to %s', response_results_file )
+    cache.put( response_key, ( response, response_plots_pt, response_plots_eta ) )
+
+# response_*_results.pkl is read by make_kFSR.py
+pickle.dump( ( response, response_plots_pt, response_plots_eta ), file(response_results_file, 'w') ) 
+logger.info( 'Written response results to %s', response_results_file )
 
 # response shapes
 if args.makeResponsePlots:
@@ -12,7 +12,9 @@ ROOT.gStyle.SetOptFit(0)
 
 
 import os
+import itertools
 import array
+import numpy as np
 import pickle
 import uuid
 from math import sqrt
@@ -21,8 +23,8 @@ from RootTools.core.standard             import *
 from JetMET.tools.user                   import plot_directory as user_plot_directory
 
 # Gaussian (Roo-)Fit
-from JetMET.JEC.L2res.GaussianFit        import GaussianFit
-from JetMET.JEC.L2res.kFSRLinearFit      import kFSRLinearFit
+from JetMET.JEC.L2res.GaussianFit        import GaussianFit_pool
+from JetMET.JEC.L2res.kFSRLinearFit      import kFSRLinearFit, kFSRLinearFit_batch
 
 #
 # Arguments
@@ -36,6 +38,9 @@ argParser.add_argument('--overwrite',                               action='stor
 argParser.add_argument('--input_directory',    action='store',      default='JEC/L2res_v10_jer_cleaned',  help="subdirectory for results.pkl")
 argParser.add_argument('--plot_directory',     action='store',      default='JEC/L2res_v10_jer_cleaned',  help="subdirectory for plots")
 argParser.add_argument('--useFit',                                  action='store_true',     help='Use a fit to determine the response', default= True )
+argParser.add_argument('--alphaScan',                             action='store_true',     help='Read all alpha points from alpha_scan_results.pkl of a single make_L2res_results.py --alphaScan run')
+argParser.add_argument('--fitPlots',                                action='store_true',     help='Write a diagnostic png for every fit')
+argParser.add_argument('--workers',            action='store',      default=1,               type=int, help='Number of processes for the fits' )
 args = argParser.parse_args()
 
 plot_directory  = os.path.join( user_plot_directory, args.plot_directory, args.triggers, args.era, 'kFSR')
@@ -82,15 +87,19 @@ logger_rt = logger_rt.get_logger(args.logLevel, logFile = None)
 
 #colors = [ j+1 for j in range(0,9) ] + [ j+31 for j in range(9,18) ]
 
-from JetMET.JEC.L2res.thresholds import pt_avg_thresholds, pt_avg_bins, eta_thresholds
+from JetMET.JEC.L2res.thresholds import pt_avg_thresholds, pt_avg_bins, eta_thresholds, kFSR_alpha_values
 pt_avg_bins       = [(pt_avg_thresholds[i], pt_avg_thresholds[i+1]) for i in range( len( pt_avg_thresholds ) -1 ) ]
 
-alpha_values      = [0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]
+alpha_values      = kFSR_alpha_values
 alpha_ref_value   = 0.3
 
 response = {}
 shape    = {}
-for alpha in alpha_values:
+if args.alphaScan:
+    filename = os.path.join( user_plot_directory, args.input_directory, args.triggers, args.era, 'alpha_scan_results.pkl' )
+    shape    = pickle.load( file( filename ))
+    logger.info( "Loaded file %s with alpha values %r", filename, sorted( shape.keys() ) )
+for alpha in alpha_values if not args.alphaScan else []:
     try:
         filename = os.path.join( user_plot_directory, args.input_directory, args.triggers, args.era, 'a%i'%(100*alpha), 'response_%s_results.pkl' % ("fit" if args.useFit else "mean") )
         response[alpha] = pickle.load( file( filename ))
@@ -249,10 +258,7 @@ def make_kFSR_plot( extrapolation_results, response_values, filename ):
 
     del c1
 
-extrapolation_results = {}
-response_values       = {}
-kFSR                  = {}
-for pt_avg_bin in [
+kFSR_pt_avg_bins = [
     (51, 299),
     (51, 73),
     (73, 95),
@@ -262,32 +268,56 @@ for pt_avg_bin in [
     (299, 365),
     (365, 435),
     (435, 566),
-    ]:
+    ]
+
+kFSR_eta_bins = [
+    (-5.191, -3.489),
+    (-3.489, -3.139),
+    (-3.139, -2.964),
+    (-2.964, -2.5),
+    (-2.5,   -2.172),
+    (-2.172, -1.305),
+    (-1.305, -0.783),
+    (-0.783, -0.261),
+    (-0.261,  0.0 ),
+    (0.0,     0.261),
+    (0.261,   0.783),
+    (0.783,   1.305),
+    (1.305,   2.172),
+    (2.172,   2.5),
+    (2.5,     2.964),
+    (2.964,   3.139),
+    (3.139,   3.489),
+    (3.489,   5.191),
+    ]
+
+# Gaussian fits of all cells in a process pool
+fit_results = {}
+if args.useFit:
+    jobs, fit_cells = [], []
+    for pt_avg_bin, eta_bin, var, sample_name, alpha in itertools.product( kFSR_pt_avg_bins, kFSR_eta_bins, [ "A", "B" ], sample_names, alpha_values ):
+        if not shape.has_key(alpha): continue
+        jobs.append( {
+            'shape'               : makeProjection( shape[alpha][var][sample_name], pt_avg_bin,  eta_bin ),
+            'isData'              : 'Run2016' in sample_name,
+            'var_name'            : "%s-symmetry" % var,
+            'fit_plot_directory'  : os.path.join( plot_directory, 'fit'),
+            'fit_filename'        : "fitresult_%s_a%i_%i_%i_pt_%i_%i_%s" % ( var, 100*alpha, 1000*eta_bin[0], 1000*eta_bin[1], pt_avg_bin[0], pt_avg_bin[1], sample_name ) if args.fitPlots else None,
+            } )
+        fit_cells.append( (pt_avg_bin, eta_bin, var, sample_name, alpha) )
+    fit_results = dict( zip( fit_cells, GaussianFit_pool( jobs, workers = args.workers ) ) )
+
+extrapolation_results = {}
+response_values       = {}
+reference             = {} # responses at alpha_ref_value
+kFSR                  = {}
+for pt_avg_bin in kFSR_pt_avg_bins:
 
     extrapolation_results[ pt_avg_bin ] = {}
     response_values[ pt_avg_bin ]       = {}
     kFSR[ pt_avg_bin ]                  = {}
 
-    for eta_bin in [
-        (-5.191, -3.489),
-        (-3.489, -3.139),
-        (-3.139, -2.964),
-        (-2.964, -2.5),
-        (-2.5,   -2.172),
-        (-2.172, -1.305),
-        (-1.305, -0.783),
-        (-0.783, -0.261),
-        (-0.261,  0.0 ),
-        (0.0,     0.261),
-        (0.261,   0.783),
-        (0.783,   1.305),
-        (1.305,   2.172),
-        (2.172,   2.5),
-        (2.5,     2.964),
-        (2.964,   3.139),
-        (3.139,   3.489),
-        (3.489,   5.191),
-        ]:
+    for eta_bin in kFSR_eta_bins:
 
         extrapolation_results[pt_avg_bin][eta_bin]  = {}
         kFSR[pt_avg_bin][eta_bin]                   = {}
@@ -309,19 +339,12 @@ for pt_avg_bin in [
                         logger.debug( "Could not find alpha %3.2f for var %s sample %s. Available alpha values: %r. All alpha values: %r" % (alpha, var, sample_name, shape.keys(), alpha_values))
                         continue
 
-                    # get projection for pt and eta bin
-                    proj = makeProjection( shape[alpha][var][sample_name], pt_avg_bin,  eta_bin )
-
                     if (args.useFit):
-                        mean_asymmetry, mean_asymmetry_error = GaussianFit(
-                            shape               = proj,
-                            isData              = isData,
-                            var_name            = "%s-symmetry" % var,
-                            fit_plot_directory  = os.path.join( plot_directory, 'fit'),
-                            fit_filename        = "fitresult_%s_a%i_%i_%i_pt_%i_%i_%s" % ( var, 100*alpha, 1000*eta_bin[0], 1000*eta_bin[1], pt_avg_bin[0], pt_avg_bin[1], sample_name )
-                            )
+                        mean_asymmetry, mean_asymmetry_error = fit_results[(pt_avg_bin, eta_bin, var, sample_name, alpha)]
 
                     else:
+                        # get projection for pt and eta bin
+                        proj = makeProjection( shape[alpha][var][sample_name], pt_avg_bin,  eta_bin )
                         mean_asymmetry        = proj.GetMean()
                         mean_asymmetry_error  = proj.GetMeanError()
 
@@ -335,8 +358,29 @@ for pt_avg_bin in [
                         ref_response        = mean_response
                         ref_response_error  = mean_response_error
 
-                # make kFSR fit
-                result = kFSRLinearFit( data = response_values[pt_avg_bin][eta_bin][var][sample_name] )
+                reference[(pt_avg_bin, eta_bin, var, sample_name)] = ( ref_response, ref_response_error )
+
+# linear extrapolations of all cells in one batched least squares solve
+cells = [ (pt_avg_bin, eta_bin, var, sample_name) for pt_avg_bin, eta_bin, var, sample_name in itertools.product( kFSR_pt_avg_bins, kFSR_eta_bins, [ "A", "B" ], sample_names ) ]
+i_cells = { cell:i_cell for i_cell, cell in enumerate( cells ) }
+points  = { alpha:i_alpha for i_alpha, alpha in enumerate( alpha_values ) }
+y_values = np.full( ( len(cells), len(alpha_values) ), np.nan )
+y_errors = np.full( ( len(cells), len(alpha_values) ), np.nan )
+for i_cell, ( pt_avg_bin, eta_bin, var, sample_name ) in enumerate( cells ):
+    for point in response_values[pt_avg_bin][eta_bin][var][sample_name]:
+        y_values[i_cell, points[point['alpha']]] = point['response']
+        y_errors[i_cell, points[point['alpha']]] = point['response_error']
+batch = kFSRLinearFit_batch( alpha_values, y_values, y_errors )
+logger.info( "Extrapolated %i cells to alpha=0", len(cells) )
+
+for pt_avg_bin in kFSR_pt_avg_bins:
+    for eta_bin in kFSR_eta_bins:
+        for var in [ "A", "B" ]:
+            for sample_name in sample_names:
+                cell = (pt_avg_bin, eta_bin, var, sample_name)
+                fit  = { key: value[i_cells[cell]] for key, value in batch.iteritems() }
+                result = kFSRLinearFit( data = response_values[pt_avg_bin][eta_bin][var][sample_name], fit = fit )
+                ref_response, ref_response_error = reference[cell]
                 # store results & reference
                 extrapolation_results[pt_avg_bin][eta_bin][var][sample_name] = result
                 # Interpret linear extrapolation to x=0 -> y=d as extrapolated response and store ref
@@ -28,6 +28,7 @@ argParser.add_argument('--ptBin',              action='store',      default=(163
 argParser.add_argument('--etaSign',            action='store',      default=0             ,  type = int,    choices = [-1,0,+1], help="sign of probe jet eta." )
 argParser.add_argument('--era',                action='store',      default='Run2016H',      nargs='?', choices=['Run2016', 'Run2016BCD', 'Run2016EFearly', 'Run2016FlateG', 'Run2016H', 'Run2016_18Apr', 'Run2016BCD_18Apr', 'Run2016EFearly_18Apr', 'Run2016FlateG_18Apr', 'Run2016H_18Apr', 'Run2016B_07Aug17', 'Run2016C_07Aug17', 'Run2016F_07Aug17', 'Run2016G_07Aug17', 'Run2016H_07Aug17'], help="era" )
 argParser.add_argument('--small',                                   action='store_true',     help='Run only on a small subset of the data?')#, default = True)
+argParser.add_argument('--workers',                                 action='store',      default=1, type=int, help='Number of processes filling (sample, file) pairs in parallel' )
 argParser.add_argument('--cleaned',                                 action='store_true',     help='Apply jet cleaning in data')#, default = True)
 argParser.add_argument('--bad',                                     action='store_true',     help='Cut on phEF*pT>300')#, default = True)
 argParser.add_argument('--plot_directory',     action='store',      default='JEC/L2res_2D_v11',     help="subdirectory for plots")
@@ -212,7 +213,11 @@ weightString   = "met_chsPt*weight*(%s>0)"%probe_jet_eta_string
 
 logger.info( "Get plot with %s, and weight %s", variableString, weightString )
 
-h_data    = data.get2DHistoFromDraw(variableString = variableString, binning = [60, -0.3, 0.3, 60, -0.3, 0.3], weightString=weightString) 
+from JetMET.tools.histoFiller    import makeHisto
+from JetMET.tools.parallelFiller import ParallelFiller
+filler    = ParallelFiller( workers = args.workers )
+h_data    = filler.book( data, makeHisto( [60, -0.3, 0.3, 60, -0.3, 0.3] ), variableString, weightString=weightString) 
+filler.fill()
 
 circles = [ ROOT.TArc(0,0,1./sinh(eta)) for eta in [2.5, 3] ] 
 for c in circles:
@@ -157,21 +157,28 @@ if args.small:
 #draw2DPlots( [plot], 1.)
 
 # minDphi(ETmiss,1,2,3)  vs. probe jet eta
+from JetMET.tools.histoFiller import HistoFiller, makeHisto
+filler = HistoFiller( sample.chain )
+
 weightString   = "weight"
 variableString = "MaxIf$(abs(cos(met_chsPhi - Jet_phi)), Jet_pt>30&&Iteration$<5)"
 binning = [ 40, 0, 1] 
-logger.info( "Get plot with %s, and weight '%s' and sample selection %s", variableString, weightString, sample.selectionString )
-h    = sample.get1DHistoFromDraw(variableString = variableString, binning = binning, weightString=weightString) 
+logger.info( "Book plot with %s, and weight '%s' and sample selection %s", variableString, weightString, sample.selectionString )
+h    = filler.bookSample( sample, makeHisto( binning ), variableString, weightString=weightString )
+
+weightString   = "weight"
+variableString = "MaxIf$(abs(cos(met_chsPhi - Jet_phi)), Jet_pt>30&&Iteration$<5):Jet_eta[probe_jet_index]"
+binning = [52, -5.2, 5.2, 40, 0, 1] 
+logger.info( "Book plot with %s, and weight '%s' and sample selection %s", variableString, weightString, sample.selectionString )
+h2D  = filler.bookSample( sample, makeHisto( binning ), variableString, weightString=weightString )
+
+filler.fill()
+
 plot = Plot.fromHisto( name = ( '1D_pt_%s_maxCosdPhiMETJets'%args.pt ), 
     histos = [[ h ]], texX = "max cos(|#Delta#phi(MET, jets)|)", texY = "Events" 
     )
 draw1DPlots( [plot], 1.)
 
-weightString   = "weight"
-variableString = "MaxIf$(abs(cos(met_chsPhi - Jet_phi)), Jet_pt>30&&Iteration$<5):Jet_eta[probe_jet_index]"
-binning = [52, -5.2, 5.2, 40, 0, 1] 
-logger.info( "Get plot with %s, and weight '%s' and sample selection %s", variableString, weightString, sample.selectionString )
-h2D    = sample.get2DHistoFromDraw(variableString = variableString, binning = binning, weightString=weightString) 
 plot2D = Plot2D.fromHisto( name = ( '2D_pt_%s_maxCosdPhiMETJets_vs_eta_probe_jet'%args.pt ), 
     histos = [[ h2D ]], texY = "max cos(|#Delta#phi(MET, jets)|)", texX = "#eta(probe jet)" 
     )
@@ -15,6 +15,9 @@ pt_avg_thresholds = [51,73,95,163,230,299,365,435,566,1000]
 #pt_avg_thresholds = [50,80,130,170,230,300,370,440,550,1000]
 pt_avg_bins       = [(pt_avg_thresholds[i], pt_avg_thresholds[i+1]) for i in range( len( pt_avg_thresholds ) -1 ) ]
 
+# alpha points of the kFSR extrapolation
+kFSR_alpha_values = [0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]
+
 exclPFJets     = "(HLT_PFJet40&&(pt_avg>=51&&pt_avg<73)||HLT_PFJet60&&(pt_avg>=73&&pt_avg<95)||HLT_PFJet80&&(pt_avg>=95&&pt_avg<163)||HLT_PFJet140&&(pt_avg>=163&&pt_avg<230)||HLT_PFJet200&&(pt_avg>=230&&pt_avg<299)||HLT_PFJet260&&(pt_avg>=299&&pt_avg<365)||HLT_PFJet320&&(pt_avg>=365&&pt_avg<435)||HLT_PFJet400&&(pt_avg>=435&&pt_avg<566)||HLT_PFJet500&&pt_avg>=566)"
 
 exclDiPFJetAve = "(HLT_DiPFJetAve40&&(pt_avg>=51&&pt_avg<73)||HLT_DiPFJetAve60&&(pt_avg>=73&&pt_avg<95)||HLT_DiPFJetAve80&&(pt_avg>=95&&pt_avg<163)||HLT_DiPFJetAve140&&(pt_avg>=163&&pt_avg<230)||HLT_DiPFJetAve200&&(pt_avg>=230&&pt_avg<299)||HLT_DiPFJetAve260&&(pt_avg>=299&&pt_avg<365)||HLT_DiPFJetAve320&&(pt_avg>=365&&pt_avg<435)||HLT_DiPFJetAve400&&(pt_avg>=435&&pt_avg<566)||HLT_DiPFJetAve500&&pt_avg>=566)"
@@ -163,7 +163,11 @@ binning        = [50,-1,1]
 weightString   = "weight"
 
 #h_MC =      mc.get1DHistoFromDraw(variableString = variableString, binning = binning, weightString=weightString+"*%f" % lumi )
-h_data    = {t:data.get1DHistoFromDraw(variableString = variableString, binning = binning, weightString=weightString+"&& %s "% t) for t in triggers }
+# one pass over the data for all triggers
+from JetMET.tools.histoFiller import HistoFiller, makeHisto
+filler    = HistoFiller( data.chain )
+h_data    = {t:filler.bookSample( data, makeHisto( binning ), variableString, weightString=weightString+"&& %s "% t) for t in triggers }
+filler.fill()
 #h_data_ps = {t:data.get1DHistoFromDraw(variableString = variableString, binning = binning, weightString="("+weightString+")*HLT_BIT_%s_v_Prescale * (%s==1) "% (t,t) ) for t in triggers }
 
 #h_MC.style = styles.lineStyle( ROOT.kBlack ) 
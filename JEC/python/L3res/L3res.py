@@ -8,6 +8,7 @@ import ROOT
 ROOT.gROOT.SetBatch(True)
 import itertools
 import os
+import numpy as np
 
 from math                                import sqrt, cos, sin, pi, atan2
 from RootTools.core.standard             import *
@@ -16,6 +17,7 @@ from JetMET.tools.helpers                import deltaPhi, deltaR
 
 # Object selection
 from JetMET.tools.objectSelection        import getFilterCut, getJets, jetVars
+from JetMET.JEC.L3res.L3resObservables  import makeObservables
 
 #
 # Arguments
@@ -34,6 +36,13 @@ argParser.add_argument('--version',            action='store',      default='V2'
 argParser.add_argument('--mode',               action='store',      default='mumu',          choices = ['mumu', 'ee'],      help='Muons or electrons?' )
 argParser.add_argument('--dy',                 action='store',      default='DYnJets',       choices = ['DY_HT_LO', 'DYnJets'],  help='Which DY sample?' )
 argParser.add_argument('--era',                action='store',      default='Run2016FlateG', choices = ['inclusive', 'Run2016BCD', 'Run2016EFearly', 'Run2016FlateG', 'Run2016H'], help="Run era?")
+argParser.add_argument('--jecCache',           action='store',      default=0,               type=int, help="Size of the LRU cache of JEC factors (0: no cache)")
+argParser.add_argument('--jecCacheTolerance',  action='store',      default=1e-4,            type=float, help="Quantization tolerance of the JEC cache (relative for pt, absolute for eta, area, rho)")
+argParser.add_argument('--columnar',                                action='store_true',     help='Compute the L3res observables with numpy for all events of a sample at once (needs root_numpy)')
+argParser.add_argument('--ntupleDirectory',    action='store',      default=None,            help="Store the columnar observables per sample as npz ntuple in this directory and reuse them (implies --columnar)")
+argParser.add_argument('--profilesOnly',                            action='store_true',     help='Only make the binned response profiles from the columnar observables, without event loop (implies --columnar)')
+argParser.add_argument('--noBinnedProfiles',                        action='store_true',     help='Fill the response profiles vs. ptll with one weight function per profile instead of the binned engine.')
+argParser.add_argument('--profileIO',                               action='store_true',     help='Write a branch level I/O profile for data and DY')
 argParser.add_argument('--plot_directory',     action='store',      default='JEC/L3res_new', help="subdirectory for plots")
 args = argParser.parse_args()
 
@@ -45,6 +54,11 @@ import RootTools.core.logger as logger_rt
 logger    = logger.get_logger(   args.logLevel, logFile = None)
 logger_rt = logger_rt.get_logger(args.logLevel, logFile = None)
 
+if args.ntupleDirectory is not None or args.profilesOnly:
+    args.columnar = True
+if args.profilesOnly and args.noBinnedProfiles:
+    raise ValueError( "--profilesOnly needs the binned profiles." )
+
 # decorate plot directory
 if args.noL1:  args.plot_directory += "_noL1"
 if args.noRes: args.plot_directory += "_noRes"
@@ -72,15 +86,9 @@ correction_levels_mc    = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
 #MEx += (pT(raw) * L1RC(ptraw) - pT(L1FJ,L2L3))*cos(phi)
 #MEx += pT(raw) * (L1RC(ptraw) - L1FJ(raw)*L2L3 )*cos(phi)
 
-jetCorrector_data    = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = correction_levels_data )
-jetCorrector_mc      = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = correction_levels_mc )
-
-jetCorrector_RC_data = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = [ 'L1RC'] )
-jetCorrector_RC_mc   = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = [ 'L1RC'] )
-
-if args.noL1:
-    jetCorrector_L1_data = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = [ 'L1FastJet'] )
-    jetCorrector_L1_mc   = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = [ 'L1FastJet'] )
+# One corrector per data/MC: all levels and L1RC are obtained from a single evaluation of the chain
+jetCorrector_data    = JetCorrector.fromTarBalls( Summer16_03Feb2017_DATA, correctionLevels = correction_levels_data, L1RC = True, cache_size = args.jecCache, cache_tolerance = args.jecCacheTolerance )
+jetCorrector_mc      = JetCorrector.fromTarBalls( Summer16_03Feb2017_MC,   correctionLevels = correction_levels_mc,   L1RC = True, cache_size = args.jecCache, cache_tolerance = args.jecCacheTolerance )
 
 #
 # Make samples, will be searched for in the postProcessing directory
@@ -261,97 +269,76 @@ jetMCVars = [ s.split('/')[0] for s in jetMCBranches ]
 jetVars += [ 'rawPt','mcPt' ]
 
 
-null_jet = {key:float('nan') for key in jetVars}
-null_jet['pt']         = 0
-null_jet['pt_corr']    = 0
-null_jet['pt_corr_RC'] = 0
-
 alphas = ["30", "20", "15", "10"]
 
 def makeL3ResObservables( event, sample ):
-    good_jets = getJets( event, jetColl="JetGood", jetVars = jetVars)
-
-    for j in good_jets:
-        # 'Corr' correction level: L1L2L3 L2res
-        if sample.isData:
-            jet_corr_factor    =  jetCorrector_data.   correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run )
-            jet_corr_factor_RC =  jetCorrector_RC_data.correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run )
-        else:
-            jet_corr_factor    =  jetCorrector_mc.     correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run )  
-            jet_corr_factor_RC =  jetCorrector_RC_mc.  correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run )  
-        
-        # corrected jet
-        j['pt_corr']    =  jet_corr_factor * j['rawPt'] 
-
-        # noL1 -> divide out L1FastJet, remove 
-        if args.noL1: 
-            if sample.isData:
-                jet_corr_factor_L1 =  jetCorrector_L1_data.correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run ) 
-            else: 
-                jet_corr_factor_L1 =  jetCorrector_L1_mc.  correction( j['rawPt'], j['eta'], j['area'], event.rho, event.run ) 
-            # noL1 -> divide out L1FastJet, remove 
-            j['pt_corr']    =  j['pt_corr']/jet_corr_factor_L1 
-            # no L1RC if 'noL1'
-            j['pt_corr_RC'] =  j['rawPt'] 
-        else:
-            # L1RC 
-            j['pt_corr_RC'] =  jet_corr_factor_RC * j['rawPt'] 
-
-
-    # compute type-1 MET shifts for chs met L1L2L3 - L1RC (if 'noL1', then L1FastJets is divided out and L1RC is not applied )
-    type1_met_shifts = \
-                {'px' :sum( ( j['pt_corr_RC'] - j['pt_corr'] )*cos(j['phi']) for j in good_jets), 
-                 'py' :sum( ( j['pt_corr_RC'] - j['pt_corr'] )*sin(j['phi']) for j in good_jets) } 
-
-    # leading jet
-    event.leading_jet    = good_jets[0]
-    # subleading jet
-    event.subleading_jet = good_jets[1] if len(good_jets)>=2 else null_jet
-
-    # alpha 
-    event.alpha = event.subleading_jet['pt_corr'] / event.dl_pt
-    # alpha cut flag
-    event.alpha_30_passed = ( event.alpha < 0.3)
-    event.alpha_20_passed = ( event.alpha < 0.2)
-    event.alpha_15_passed = ( event.alpha < 0.15)
-    event.alpha_10_passed = ( event.alpha < 0.1)
-
-    # chs MET 
-    chs_MEx_corr = event.met_chsPt*cos(event.met_chsPhi) + type1_met_shifts['px']
-    chs_MEy_corr = event.met_chsPt*sin(event.met_chsPhi) + type1_met_shifts['py']
-
-    chs_MEt_corr    = sqrt(  chs_MEx_corr**2 + chs_MEy_corr**2 )
-    chs_MEphi_corr  = atan2( chs_MEy_corr, chs_MEx_corr )
-#    if sample.isData: #FIXME
-#        print "evt", event.evt
-#        for i, j in enumerate(good_jets):
-#            print "jet", i, "pt(raw)", j['rawPt'], "pt(L1L2L3)", j['pt_corr'], "pt(L1RC)", j['pt_corr_RC'], "phi", cos(j['phi'])
-#            print "cont. to type1 from jet ", i, ( j['pt_corr_RC'] - j['pt_corr'] )*cos(j['phi']), "py", ( j['pt_corr_RC'] - j['pt_corr'] )*sin(j['phi'])
-#        print "type1 shifts", type1_met_shifts['px'], type1_met_shifts['py'] 
-#        print "raw chs met: pt", event.met_chsPt, 'phi', event.met_chsPhi
-#        print "type1 chs met: px", chs_MEx_corr, 'py', chs_MEy_corr 
-#        print "             : pt",chs_MEt_corr,"phi",chs_MEphi_corr 
-#        print 
-    setattr( event, "met_chsPt_type1",  chs_MEt_corr )
-    setattr( event, "met_chsPhi_type1", chs_MEphi_corr )
-
-    # PT-bal
-    event.r_ptbal      = event.leading_jet['pt_corr'] / event.dl_pt
-    # PT-bal raw
-    event.r_ptbalRaw   = event.leading_jet['rawPt'] / event.dl_pt 
-    # MPF 
-    event.r_mpf        = 1. + chs_MEt_corr * cos(chs_MEphi_corr - event.dl_phi) / event.dl_pt
-    # MPF no type-1 
-    event.r_mpfNoType1 = 1. + event.met_chsPt * cos(event.met_chsPhi - event.dl_phi) / event.dl_pt
-
-    # gen 
-    if not sample.isData and event.leading_jet['mcPt']>0:
-        event.r_gen    = event.leading_jet['pt_corr']/event.leading_jet['mcPt']
-        #event.r_gen    = event.leading_jet['pt']/event.leading_jet['mcPt']
+    makeObservables( event, sample.isData, jetCorrector_data if sample.isData else jetCorrector_mc, jetVars = jetVars, noL1 = args.noL1 )
+
+# Columnar version: the observables of all events of a sample are computed with numpy when its first event is read,
+# the sequence copies them to the event. The binned profiles are filled directly from the columns.
+columns          = {}
+columns_position = {}
+
+def ntupleFilename( sample ):
+    ''' npz ntuple of the observables, named after ( JEC version, mode, era, dy sample ). The hash covers everything else 
+        the observables depend on: a new input file, JEC txt file, alpha list or code version gives a new ntuple.
+    '''
+    import JetMET.JEC.L3res.L3resObservables as L3resObservables
+    import JetMET.JetCorrector.JetCorrector as JetCorrectorModule
+    import JetMET.JetCorrector.JetCorrectorParameters as JetCorrectorParameters
+    from JetMET.tools.resultCache import makeKey, fileStamps, codeVersion
+    jetCorrector = jetCorrector_data if sample.isData else jetCorrector_mc
+    key = makeKey( 
+        version = args.version, mode = args.mode, era = args.era, dy = args.dy, noRes = args.noRes, noL1 = args.noL1, 
+        selectionString = selectionString, sampleSelectionString = sample.selectionString, maxEvents = max_events,
+        alphas = alphas, jetVars = L3resObservables.jet_variables, files = fileStamps( sample.files ),
+        jec_levels = jetCorrector.levels, 
+        jec = [ ( runnumber, fileStamps( txtfiles ) ) for runnumber, txtfiles in jetCorrector.iovs ],
+        jec_RC = [ ( runnumber, fileStamps( txtfiles ) ) for runnumber, txtfiles in jetCorrector.iovs_RC ] if jetCorrector.iovs_RC is not None else None,
+        code = codeVersion( L3resObservables.__file__, JetCorrectorModule.__file__, JetCorrectorParameters.__file__ ),
+        )
+    return os.path.join( args.ntupleDirectory, 'L3res_%s_%s_%s_%s_%s_%s.npz' % ( args.version, args.mode, args.era, args.dy, sample.name, key[:12] ) )
+
+def makeColumns( sample ):
+    from JetMET.JEC.L3res.L3resObservables import readColumns, computeObservables, saveObservables, loadObservables
+    filename = ntupleFilename( sample ) if args.ntupleDirectory is not None else None
+    if filename is not None and os.path.exists( filename ):
+        result = loadObservables( filename )
     else:
-        event.r_gen    = None 
-
-sequence.append( makeL3ResObservables )
+        weight_branches = weight_branches_data if sample.isData else weight_branches_mc
+        arrays = readColumns( sample, selectionString = selectionString, weight_branches = weight_branches, maxEvents = max_events )
+        result = computeObservables( arrays, jetCorrector_data if sample.isData else jetCorrector_mc, sample.isData, alphas, 
+            weight_branches = weight_branches, noL1 = args.noL1 )
+        if filename is not None:
+            saveObservables( filename, result )
+
+    if not args.noBinnedProfiles and sample.name in binned_profile_samples:
+        binned_profiles.fill_batch( sample.name, result['dl_pt'], 
+            values         = [ result[observable] for observable in binned_profiles.observables ],
+            passed         = [ result[cut] for cut in binned_profiles.cuts ],
+            category_value = np.abs( result['leading_jet_eta'] ),
+            weight         = result['weight'],
+        )
+    return result
+
+def makeL3ResObservables_columnar( event, sample ):
+    if sample.name not in columns:
+        columns[sample.name]          = makeColumns( sample )
+        columns_position[sample.name] = 0
+    c = columns[sample.name]
+    i = columns_position[sample.name]
+    columns_position[sample.name] += 1
+
+    if ( c['run'][i], c['evt'][i] ) != ( event.run, event.evt ):
+        raise RuntimeError( "Columnar observables of %s out of sync with the reader at position %i: %r vs. %r" % ( sample.name, i, ( c['run'][i], c['evt'][i] ), ( event.run, event.evt ) ) )
+
+    for name in [ 'leading_jet', 'subleading_jet' ]:
+        setattr( event, name, { key[len(name)+1:]:c[key][i].item() for key in c if key.startswith( name+'_' ) } )
+    for var in [ 'alpha', 'met_chsPt_type1', 'met_chsPhi_type1', 'r_ptbal', 'r_ptbalRaw', 'r_mpf', 'r_mpfNoType1' ] + [ 'alpha_%s_passed'%alpha for alpha in alphas ]:
+        setattr( event, var, c[var][i].item() )
+    event.r_gen = c['r_gen'][i].item() if not np.isnan( c['r_gen'][i] ) else None
+
+sequence.append( makeL3ResObservables_columnar if args.columnar else makeL3ResObservables )
 
 # Functor to retrieve attributes from the event object (Inline defined lambdas are wrongly bound)
 def att_getter( arg, key = None):
@@ -383,6 +370,9 @@ def getLeptonSelection( mode ):
 
 weight_mc   = lambda event, sample: event.weight*event.reweightLeptonSF*event.reweightDilepTriggerBackup*event.reweightPU36fb
 weight_data = lambda event, sample: event.weight
+# the same weights for the columnar observables
+weight_branches_mc   = [ 'weight', 'reweightLeptonSF', 'reweightDilepTriggerBackup', 'reweightPU36fb' ]
+weight_branches_data = [ 'weight' ]
 
 if   args.mode=="mumu": 
     if args.era == 'inclusive':
@@ -490,6 +480,8 @@ if args.small:
     for sample in stack.samples + stack_profile.samples:
         sample.reduceFiles( to = 1 )
 
+max_events = 50000 if args.small else -1
+
 # Use some defaults
 Plot.setDefaults( stack = stack, \
                 weight = lambda event, sample: event.alpha_30_passed,   
@@ -746,6 +738,33 @@ if not args.skipOtherPlots:
     ))
     plots[-1].subdir = "plots"
 
+methods = ['ptbal', 'mpf',  'mpfNoType1']
+if not args.skipOtherPlots: methods += ['ptbalRaw', 'gen']
+
+# The profiles vs dl_pt (method x alpha x eta bin) are filled by one engine: the bins of an event are found once
+# and the sums are incremented in arrays instead of evaluating one weight function per profile.
+if not args.noBinnedProfiles:
+    from JetMET.tools.binnedProfiles import BinnedProfiles
+    binned_profiles = BinnedProfiles( 
+        observables = [ "r_%s"%method for method in methods ] + [ "dl_pt" ],
+        cuts        = [ "alpha_%s_passed"%alpha for alpha in alphas ],
+        categories  = all_abs_eta_bins,
+        thresholds  = ptll_thresholds,
+    )
+    binned_profile_samples = [ s.name for s in stack_profile.samples ]
+
+    def fillBinnedProfiles( event, sample ):
+        if sample.name not in binned_profile_samples: return
+        binned_profiles.fill( sample.name, event.dl_pt,
+            values         = [ getattr( event, observable ) for observable in binned_profiles.observables ],
+            passed         = [ getattr( event, cut ) for cut in binned_profiles.cuts ],
+            category_value = abs( event.leading_jet['eta'] ),
+            weight         = sample.weight( event, sample ) if sample.weight is not None else 1,
+        )
+
+    # the columnar observables fill the binned profiles in makeColumns
+    if not args.columnar: sequence.append( fillBinnedProfiles )
+
 # pt profile vs dl_pt
 for abs_eta_bin in all_abs_eta_bins:
   profiles1D.append(Plot(
@@ -762,6 +781,7 @@ for abs_eta_bin in all_abs_eta_bins:
     weight = make_weight( abs_eta_bin = abs_eta_bin ),
   ))
   profiles1D[-1].drawObjects = [(0.5, 0.76, abs_eta_string(abs_eta_bin))]
+  if not args.noBinnedProfiles: profiles1D[-1].binned = ( "dl_pt", "alpha_30_passed", abs_eta_bin )
 
 profiles1D.append(Plot(
 name = 'dl_mass_profile_pt', texX = 'p_{T}(ll) (GeV)', texY = 'm(ll) (GeV)',
@@ -780,9 +800,6 @@ profiles1D[-1].drawObjects = [(0.2, 0.8, abs_eta_string((0, 1.3))), (0.2,0.75, "
 for_comparison_eta = {abs_eta_bin:{alpha:{} for alpha in alphas } for abs_eta_bin in all_abs_eta_bins}
 for_comparison_pt  = {ptll_bin:   {alpha:{} for alpha in alphas } for ptll_bin    in ptll_bins}
 
-methods = ['ptbal', 'mpf',  'mpfNoType1']
-if not args.skipOtherPlots: methods += ['ptbalRaw', 'gen']
-
 for method in methods: 
 
   stack_profile_ = stack_profile_gen if method=='gen' else stack_profile
@@ -805,6 +822,7 @@ for method in methods:
         weight = make_weight( abs_eta_bin = abs_eta_bin, alpha_passed = "alpha_%s_passed"%alpha,  is_finite = [ "r_%s"%method ] ),
       ))
       profiles1D[-1].drawObjects = [(0.5, 0.76, abs_eta_string(abs_eta_bin)), (0.5, 0.71, "#alpha<%2.1f"% ( float(alpha)/100.)) ]
+      if not args.noBinnedProfiles: profiles1D[-1].binned = ( "r_%s"%method, "alpha_%s_passed"%alpha, abs_eta_bin )
       for_comparison_eta[abs_eta_bin][alpha][method] = profiles1D[-1]
 
     if not args.skipOtherPlots:
@@ -872,7 +890,42 @@ for method in methods:
               plots[-1].subdir = "response_plots"
 
 
-plotting.fill( plots + profiles1D + plots2D , read_variables = read_variables, sequence = sequence, max_events = 50000 if args.small else -1) #FIXME
+if args.profileIO:
+    from JetMET.tools.branchProfiler import profileChain
+    plot_read_variables = [ v for plot in plots + profiles1D + plots2D for v in ( getattr( plot, 'read_variables', None ) or [] ) ]
+    for sample in [ data, DY_sample ]:
+        profileChain( sample.chain, os.path.join( plot_directory, 'io_profile_%s.txt' % sample.name ), 
+            used_variables   = read_variables + sample.read_variables + plot_read_variables, 
+            used_expressions = [ selectionString ] + ( [ sample.selectionString ] if sample.selectionString else [] ) )
+
+if args.profilesOnly:
+    # no event loop: the binned profiles are filled from the columns, the yields are those of the profile stack
+    plots      = []
+    profiles1D = [ p for p in profiles1D if hasattr( p, "binned" ) ]
+    plots2D    = []
+    for sample in stack_profile.samples:
+        columns[sample.name] = makeColumns( sample )
+        c = columns[sample.name]
+        yields[args.mode][sample.name] = np.sum( c['weight'][ c['alpha_30_passed'] ] )*getattr( sample, "scale", 1 )
+    yields[args.mode]["MC"] = yields[args.mode][all_mc_combined.name]
+else:
+    plotting.fill( plots + [ p for p in profiles1D if not hasattr( p, "binned" ) ] + plots2D , read_variables = read_variables, sequence = sequence, max_events = max_events) #FIXME
+
+# TProfiles from the binned engine
+for plot in profiles1D:
+    if not hasattr( plot, "binned" ): continue
+    plot.histos = []
+    for samples in plot.stack:
+        plot.histos.append( [] )
+        for sample in samples:
+            h = binned_profiles.profile( sample.name, *plot.binned, name = "_".join( [ plot.name, sample.name ] ), texX = plot.texX, texY = plot.texY )
+            h.style      = sample.style
+            h.legendText = sample.texName
+            plot.histos[-1].append( h )
+
+if args.jecCache > 0:
+    jetCorrector_data.logCacheStatistics()
+    jetCorrector_mc.logCacheStatistics()
 
 # Get normalization yields from yield histogram
 for plot in plots:
@@ -884,9 +937,28 @@ for plot in plots:
           h.GetXaxis().SetBinLabel(2, "e#mu")
           h.GetXaxis().SetBinLabel(3, "ee")
 
-yields[args.mode]["MC"] = sum(yields[args.mode][s.name] for s in mc)
+if not args.profilesOnly:
+    yields[args.mode]["MC"] = sum(yields[args.mode][s.name] for s in mc)
 dataMCScale        = yields[args.mode]["data"]/yields[args.mode]["MC"] if yields[args.mode]["MC"] != 0 else float('nan')
 
+# All profiles in one file for makeResultFile.py: one directory per sample, the profiles are named after the plot
+# and carry its axis titles, which makeResultFile copies to the TGraphs
+profile_file = os.path.join( plot_directory, args.mode + "_log", selection, "L3res_profiles.root" )
+if not os.path.exists( os.path.dirname( profile_file ) ):
+    os.makedirs( os.path.dirname( profile_file ) )
+f_profiles = ROOT.TFile( profile_file, "recreate" )
+for sample_name in set( sample.name for plot in profiles1D for sample in plot.stack.samples ):
+    f_profiles.mkdir( sample_name )
+for plot in profiles1D:
+    for samples, histos in zip( plot.stack, plot.histos ):
+        for sample, h in zip( samples, histos ):
+            f_profiles.cd( sample.name )
+            if plot.texX is not None: h.GetXaxis().SetTitle( plot.texX )
+            if plot.texY is not None: h.GetYaxis().SetTitle( plot.texY )
+            h.Write( plot.name )
+f_profiles.Close()
+logger.info( "Written %s", profile_file )
+
 draw1DPlots(    plots,      args.mode, dataMCScale )
 draw1DProfiles( profiles1D, args.mode, dataMCScale )
 draw2DPlots(    plots2D,    args.mode, dataMCScale )
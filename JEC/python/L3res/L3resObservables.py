@@ -0,0 +1,210 @@
+''' Columnar L3res observables: JEC, type-1 chs MET, alpha and the responses for all events of a sample at once,
+    computed with numpy on the flat JetGood arrays. Same definitions as the scalar makeObservables for one event.
+    The columns can be stored as npz ntuple, so that replotting doesn't need the trees and the JEC.
+'''
+# Standard imports
+import os
+import tempfile
+import numpy as np
+from math import sqrt, cos, sin, atan2
+
+# JetMET
+from JetMET.tools.objectSelection import getJets, jetVars
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+event_branches = [ 'run', 'evt', 'rho', 'dl_pt', 'dl_phi', 'met_chsPt', 'met_chsPhi' ]
+jet_variables  = [ 'pt', 'eta', 'phi', 'area', 'btagCSV', 'rawPt' ]
+jet_collection = 'JetGood'
+
+# values of a missing ( e.g. subleading ) jet, pt is 0 such that alpha = 0
+null_jet_values = { 'pt':0., 'pt_corr':0., 'pt_corr_RC':0. }
+
+def nullJet( jetVars ):
+    jet = { key:float('nan') for key in jetVars }
+    jet.update( null_jet_values )
+    return jet
+
+def makeObservables( event, isData, jetCorrector, jetVars = jetVars + [ 'mcPt' ], noL1 = False ):
+    ''' Scalar version for one event of the RootTools reader: sets leading_jet, subleading_jet, alpha, the alpha flags, 
+        met_chsPt_type1, met_chsPhi_type1 and the responses on the event.
+    '''
+    good_jets = getJets( event, jetColl="JetGood", jetVars = jetVars)
+
+    for j in good_jets:
+        # 'Corr' correction level: L1L2L3 L2res
+        sub_corrections = jetCorrector.subCorrections( j['rawPt'], j['eta'], j['area'], event.rho, event.run )
+        # total correction is the cumulative factor of the last level
+        jet_corr_factor    = sub_corrections[jetCorrector.levels[-1]]
+        jet_corr_factor_RC = sub_corrections['L1RC']
+        
+        # corrected jet
+        j['pt_corr']    =  jet_corr_factor * j['rawPt'] 
+
+        # noL1 -> divide out L1FastJet, remove 
+        if noL1: 
+            # noL1 -> divide out L1FastJet, remove 
+            j['pt_corr']    =  j['pt_corr']/sub_corrections['L1FastJet'] 
+            # no L1RC if 'noL1'
+            j['pt_corr_RC'] =  j['rawPt'] 
+        else:
+            # L1RC 
+            j['pt_corr_RC'] =  jet_corr_factor_RC * j['rawPt'] 
+
+
+    # compute type-1 MET shifts for chs met L1L2L3 - L1RC (if 'noL1', then L1FastJets is divided out and L1RC is not applied )
+    type1_met_shifts = \
+                {'px' :sum( ( j['pt_corr_RC'] - j['pt_corr'] )*cos(j['phi']) for j in good_jets), 
+                 'py' :sum( ( j['pt_corr_RC'] - j['pt_corr'] )*sin(j['phi']) for j in good_jets) } 
+
+    # leading jet
+    event.leading_jet    = good_jets[0]
+    # subleading jet
+    event.subleading_jet = good_jets[1] if len(good_jets)>=2 else nullJet( jetVars )
+
+    # alpha 
+    event.alpha = event.subleading_jet['pt_corr'] / event.dl_pt
+    # alpha cut flag
+    event.alpha_30_passed = ( event.alpha < 0.3)
+    event.alpha_20_passed = ( event.alpha < 0.2)
+    event.alpha_15_passed = ( event.alpha < 0.15)
+    event.alpha_10_passed = ( event.alpha < 0.1)
+
+    # chs MET 
+    chs_MEx_corr = event.met_chsPt*cos(event.met_chsPhi) + type1_met_shifts['px']
+    chs_MEy_corr = event.met_chsPt*sin(event.met_chsPhi) + type1_met_shifts['py']
+
+    chs_MEt_corr    = sqrt(  chs_MEx_corr**2 + chs_MEy_corr**2 )
+    chs_MEphi_corr  = atan2( chs_MEy_corr, chs_MEx_corr )
+#    if sample.isData: #FIXME
+#        print "evt", event.evt
+#        for i, j in enumerate(good_jets):
+#            print "jet", i, "pt(raw)", j['rawPt'], "pt(L1L2L3)", j['pt_corr'], "pt(L1RC)", j['pt_corr_RC'], "phi", cos(j['phi'])
+#            print "cont. to type1 from jet ", i, ( j['pt_corr_RC'] - j['pt_corr'] )*cos(j['phi']), "py", ( j['pt_corr_RC'] - j['pt_corr'] )*sin(j['phi'])
+#        print "type1 shifts", type1_met_shifts['px'], type1_met_shifts['py'] 
+#        print "raw chs met: pt", event.met_chsPt, 'phi', event.met_chsPhi
+#        print "type1 chs met: px", chs_MEx_corr, 'py', chs_MEy_corr 
+#        print "             : pt",chs_MEt_corr,"phi",chs_MEphi_corr 
+#        print 
+    setattr( event, "met_chsPt_type1",  chs_MEt_corr )
+    setattr( event, "met_chsPhi_type1", chs_MEphi_corr )
+
+    # PT-bal
+    event.r_ptbal      = event.leading_jet['pt_corr'] / event.dl_pt
+    # PT-bal raw
+    event.r_ptbalRaw   = event.leading_jet['rawPt'] / event.dl_pt 
+    # MPF 
+    event.r_mpf        = 1. + chs_MEt_corr * cos(chs_MEphi_corr - event.dl_phi) / event.dl_pt
+    # MPF no type-1 
+    event.r_mpfNoType1 = 1. + event.met_chsPt * cos(event.met_chsPhi - event.dl_phi) / event.dl_pt
+
+    # gen 
+    if not isData and event.leading_jet['mcPt']>0:
+        event.r_gen    = event.leading_jet['pt_corr']/event.leading_jet['mcPt']
+        #event.r_gen    = event.leading_jet['pt']/event.leading_jet['mcPt']
+    else:
+        event.r_gen    = None
+
+
+def readColumns( sample, selectionString = None, weight_branches = [], maxEvents = -1 ):
+    ''' Read the selected events of a RootTools sample as ( jagged ) arrays with root_numpy.
+        The order is the order of the chain, as in the TreeReader. MC samples read also the jet mcPt.
+    '''
+    from root_numpy import tree2array
+    selection = [ s for s in [ selectionString, sample.selectionString ] if s ]
+    branches  = event_branches + list( weight_branches ) + [ '%s_%s'%( jet_collection, var ) for var in jet_variables ]
+    if not sample.isData:
+        branches.append( '%s_mcPt'%jet_collection )
+
+    arrays = tree2array( sample.chain, branches = list( set( branches ) ), selection = "&&".join( "(%s)"%s for s in selection ) if selection else None )
+    if maxEvents >= 0:
+        arrays = arrays[:maxEvents]
+    logger.info( "Read %i events of sample %s.", len( arrays ), sample.name )
+    return arrays
+
+def computeObservables( arrays, jetCorrector, isData, alphas, weight_branches = [], noL1 = False ):
+    ''' Dictionary of arrays with one entry per event: run, evt, weight, dl_pt, leading_jet_<var> and subleading_jet_<var>
+        (incl. pt_corr and pt_corr_RC, values of nullJet if there is no such jet), alpha, alpha_<alpha>_passed, met_chsPt_type1,
+        met_chsPhi_type1 and the responses r_ptbal, r_ptbalRaw, r_mpf, r_mpfNoType1 and r_gen (NaN for data).
+    '''
+    nEvents = len( arrays )
+    nJet    = np.array( [ len( x ) for x in arrays['%s_rawPt'%jet_collection] ], dtype = 'int64' )
+    offsets = np.concatenate( [ [0], np.cumsum( nJet ) ] )
+    i_event = np.repeat( np.arange( nEvents ), nJet )
+
+    def flat( var ):
+        return np.concatenate( list( arrays['%s_%s'%( jet_collection, var )] ) + [ np.zeros( 0 ) ] ).astype( 'float64' )
+
+    run, evt = arrays['run'], arrays['evt']
+    rho, dl_pt, dl_phi, met_chsPt, met_chsPhi = [ arrays[branch].astype( 'float64' ) for branch in [ 'rho', 'dl_pt', 'dl_phi', 'met_chsPt', 'met_chsPhi' ] ]
+
+    jets = { var:flat( var ) for var in jet_variables + ( [] if isData else [ 'mcPt' ] ) }
+
+    # 'Corr' correction level: L1L2L3 L2res
+    sub_corrections = jetCorrector.subCorrections_batch( jets['rawPt'], jets['eta'], jets['area'], rho[i_event], run[i_event] )
+    jets['pt_corr'] = sub_corrections[jetCorrector.levels[-1]]*jets['rawPt']
+    if noL1:
+        # noL1 -> divide out L1FastJet, no L1RC
+        jets['pt_corr']    = jets['pt_corr']/sub_corrections['L1FastJet']
+        jets['pt_corr_RC'] = jets['rawPt']
+    else:
+        jets['pt_corr_RC'] = sub_corrections['L1RC']*jets['rawPt']
+
+    result = { 'run':run, 'evt':evt, 'dl_pt':dl_pt }
+    result['weight'] = np.prod( [ arrays[branch].astype( 'float64' ) for branch in weight_branches ], axis = 0 ) if weight_branches else np.ones( nEvents )
+
+    # leading and subleading jet ( in the order of the collection )
+    for position, name in enumerate( [ 'leading_jet', 'subleading_jet' ] ):
+        exists = ( nJet > position )
+        for var, values in jets.iteritems():
+            column = np.full( nEvents, null_jet_values.get( var, float('nan') ) )
+            column[exists] = values[ offsets[:-1][exists] + position ]
+            result[ '%s_%s'%( name, var ) ] = column
+
+    # type-1 MET shifts for chs met L1L2L3 - L1RC
+    shift = jets['pt_corr_RC'] - jets['pt_corr']
+    chs_MEx_corr = met_chsPt*np.cos( met_chsPhi ) + np.bincount( i_event, weights = shift*np.cos( jets['phi'] ), minlength = nEvents )
+    chs_MEy_corr = met_chsPt*np.sin( met_chsPhi ) + np.bincount( i_event, weights = shift*np.sin( jets['phi'] ), minlength = nEvents )
+    result['met_chsPt_type1']  = np.sqrt( chs_MEx_corr**2 + chs_MEy_corr**2 )
+    result['met_chsPhi_type1'] = np.arctan2( chs_MEy_corr, chs_MEx_corr )
+
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+        result['alpha'] = result['subleading_jet_pt_corr']/dl_pt
+        for alpha in alphas:
+            result['alpha_%s_passed'%alpha] = ( result['alpha'] < float( alpha )/100. )
+
+        result['r_ptbal']      = result['leading_jet_pt_corr']/dl_pt
+        result['r_ptbalRaw']   = result['leading_jet_rawPt']/dl_pt
+        result['r_mpf']        = 1. + result['met_chsPt_type1']*np.cos( result['met_chsPhi_type1'] - dl_phi )/dl_pt
+        result['r_mpfNoType1'] = 1. + met_chsPt*np.cos( met_chsPhi - dl_phi )/dl_pt
+
+        if isData:
+            result['r_gen'] = np.full( nEvents, float('nan') )
+        else:
+            mcPt = result['leading_jet_mcPt']
+            result['r_gen'] = np.where( mcPt > 0, result['leading_jet_pt_corr']/np.where( mcPt > 0, mcPt, 1. ), float('nan') )
+
+    return result
+
+def saveObservables( filename, observables ):
+    ''' Store the columns as a compressed npz file (atomic rename)
+    '''
+    directory = os.path.dirname( filename )
+    if directory and not os.path.exists( directory ):
+        os.makedirs( directory )
+    fd, tmp_file = tempfile.mkstemp( dir = directory or '.', prefix = '.'+os.path.basename( filename ) )
+    with os.fdopen( fd, 'wb' ) as f:
+        np.savez_compressed( f, **observables )
+    os.chmod( tmp_file, 0644 )
+    os.rename( tmp_file, filename )
+    logger.info( "Stored %i observables of %i events in %s.", len( observables ), len( observables['run'] ), filename )
+
+def loadObservables( filename ):
+    ''' Columns stored with saveObservables
+    '''
+    with np.load( filename ) as f:
+        observables = { key:f[key] for key in f.files }
+    logger.info( "Loaded %i observables of %i events from %s.", len( observables ), len( observables['run'] ), filename )
+    return observables
@@ -23,6 +23,7 @@ argParser.add_argument('--logLevel',           action='store',      default='INF
 argParser.add_argument('--version',            action='store',      default='V2',            help='JEC version as postfix to 23Sep2016' )
 argParser.add_argument('--inputDir',           action='store',      default='/afs/hephy.at/user/r/rschoefbeck/www/JEC/L3res_small/V2/DYnJets/Run2016G/mumu_log/ptll30-njet1p/',      help="input directory")
 argParser.add_argument('--outputFile',         action='store',      help="output file. If not present, use <plotDirectory>/L3res.root")
+argParser.add_argument('--profileFile',        action='store',      help="profiles written by L3res.py. If not present, use <inputDir>/L3res_profiles.root. Profiles not found there are taken from the canvas files.")
 argParser.add_argument('--addL2resEtaBins',                         action='store_true',     help='Add L2res eta bins.')#, default = True)
 args = argParser.parse_args()
 
@@ -49,7 +50,38 @@ else:
     if not os.path.exists( directory ):
         os.makedirs( directory )
 
-def getProfiles( fname ):
+if not args.profileFile:
+    args.profileFile = os.path.join( args.inputDir, "L3res_profiles.root" )
+
+# One directory per sample, the profiles are named after the plot
+if os.path.exists( args.profileFile ):
+    logger.info( "Reading profiles from %s", args.profileFile )
+    profile_file = ROOT.TFile( args.profileFile )
+    assert not profile_file.IsZombie()
+else:
+    logger.info( "%s not found. Reading profiles from the canvas files.", args.profileFile )
+    profile_file = None
+
+def getProfiles( name ):
+    ''' ( mc, data ) profiles of the plot 'name', from the profile file or from the canvas file of the plot
+    '''
+    if profile_file is not None:
+        mc, data = profile_file.Get( "all_mc_combined/%s"%name ), profile_file.Get( "data/%s"%name )
+        if mc and data:
+            return mc, data
+        logger.info( "%s not found for %s in %s. Reading the canvas file.", 
+            " and ".join( s for s, p in [ ( 'all_mc_combined', mc ), ( 'data', data ) ] if not p ), name, args.profileFile )
+
+    fname = os.path.join( args.inputDir, name+'.root' )
+    if not os.path.exists( fname ):
+        raise RuntimeError( "Profiles of %s neither in %s nor in a canvas file %s." % ( name, args.profileFile, fname ) )
+    mc, data = getProfilesFromCanvas( fname )
+    missing  = [ s for s, p in [ ( 'all_mc_combined', mc ), ( 'data', data ) ] if not p ]
+    if missing:
+        raise RuntimeError( "Could not find the %s profile of %s in %s." % ( " and ".join( missing ), name, fname ) )
+    return mc, data
+
+def getProfilesFromCanvas( fname ):
     f = ROOT.TFile(fname)
     assert not f.IsZombie()
     f.cd()
@@ -109,14 +141,10 @@ stuff = []
 
 # Eta binned TGraphs vs. pt
 for abs_eta_bin in all_abs_eta_bins:
-    ptll_vs_ptll_file = os.path.join( args.inputDir, ( 'ptll_profile_ptll_for_eta_%4.3f_%4.3f'%( abs_eta_bin ) ).replace( '.','')+'.root' )
-   
-    ptll_mc, ptll_data = getProfiles(ptll_vs_ptll_file)
+    ptll_mc, ptll_data = getProfiles( ( 'ptll_profile_ptll_for_eta_%4.3f_%4.3f'%( abs_eta_bin ) ).replace( '.','') )
     for method in ['mpf', 'ptbal', 'mpfNoType1']:
         for alpha in ['10', '15', '20', '30']:
-            response_file = os.path.join( args.inputDir, ('r_%s_%s_a%s_profile_ptll_for_eta_%4.3f_%4.3f'%( ( method, args.version, alpha ) + abs_eta_bin )).replace( '.','')+'.root' ) 
-
-            r_mc, r_data    = getProfiles(response_file)
+            r_mc, r_data    = getProfiles( ('r_%s_%s_a%s_profile_ptll_for_eta_%4.3f_%4.3f'%( ( method, args.version, alpha ) + abs_eta_bin )).replace( '.','') )
             n_bins = r_mc.GetNbinsX()
 
             mc    = ROOT.TGraphErrors(n_bins)
@@ -136,11 +164,8 @@ for abs_eta_bin in all_abs_eta_bins:
             stuff.append( ratio )
 
 #Mass plots
-ptll_vs_ptll_file  = os.path.join( args.inputDir, 'ptll_profile_ptll_for_eta_0000_1300.root')
-ptll_mc, ptll_data = getProfiles(ptll_vs_ptll_file)
-
-dl_mass_file       = os.path.join( args.inputDir, 'dl_mass_profile_pt.root' )
-mass_mc, mass_data = getProfiles(dl_mass_file)
+ptll_mc, ptll_data = getProfiles( 'ptll_profile_ptll_for_eta_0000_1300' )
+mass_mc, mass_data = getProfiles( 'dl_mass_profile_pt' )
 
 mc    = ROOT.TGraphErrors(n_bins)
 mc.   SetName("MC_ZMass_L1L2L3")
@@ -164,4 +189,5 @@ for o in stuff:
     o.Write()
 
 f_out.Close()
+if profile_file is not None: profile_file.Close()
 logger.info( "Written %s", args.outputFile ) 
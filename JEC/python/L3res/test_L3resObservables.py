@@ -0,0 +1,91 @@
+''' Columnar L3res observables (computeObservables) vs. the scalar makeObservables on synthetic events,
+    including events with a single jet. Runs without ROOT and CMSSW (also with pytest).
+'''
+import numpy as np
+from JetMET.JEC.L3res.L3resObservables import computeObservables, makeObservables, jet_collection
+
+alphas      = [ "30", "20", "15", "10" ]
+jet_fields  = [ 'pt', 'eta', 'phi', 'area', 'btagCSV', 'rawPt', 'mcPt' ]
+observables = [ 'alpha', 'met_chsPt_type1', 'met_chsPhi_type1', 'r_ptbal', 'r_ptbalRaw', 'r_mpf', 'r_mpfNoType1' ]
+
+class SyntheticCorrector:
+    ''' Smooth synthetic JEC with the interface of JetCorrector
+    '''
+    levels = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
+
+    @staticmethod
+    def _factors( rawPt, eta, area, rho ):
+        L1 = 1. - 0.5*area*rho/rawPt
+        L2 = L1*( 1.05 + 0.02*eta**2 )
+        return { 'L1FastJet':L1, 'L2Relative':L2, 'L3Absolute':1.01*L2, 'L1RC':1. - 0.4*area*rho/rawPt }
+
+    def subCorrections( self, rawPt, eta, area, rho, run ):
+        return self._factors( rawPt, eta, area, rho )
+
+    def subCorrections_batch( self, rawPt, eta, area, rho, run ):
+        return self._factors( *[ np.asarray( v, dtype = 'float64' ) for v in ( rawPt, eta, area, rho ) ] )
+
+class Event:
+    pass
+
+def makeEvents( nJets, seed = 1 ):
+    ''' Events with the given jet multiplicities as reader events and as structured array ( as from tree2array )
+    '''
+    random = np.random.RandomState( seed )
+    dtype  = [ ( 'run', 'i4' ), ( 'evt', 'i8' ) ] + [ ( branch, 'f4' ) for branch in [ 'rho', 'dl_pt', 'dl_phi', 'met_chsPt', 'met_chsPhi' ] ] \
+           + [ ( '%s_%s'%( jet_collection, var ), 'O' ) for var in jet_fields ]
+    arrays = np.zeros( len( nJets ), dtype = dtype )
+    events = []
+    for i_event, n in enumerate( nJets ):
+        values = { 'run':1, 'evt':i_event, 'rho':random.uniform( 0, 30 ), 'dl_pt':random.uniform( 30, 300 ), 'dl_phi':random.uniform( -3, 3 ),
+                   'met_chsPt':random.uniform( 0, 50 ), 'met_chsPhi':random.uniform( -3, 3 ) }
+        rawPt = np.sort( random.uniform( 15, 200, n ) )[::-1]
+        jets  = { 'rawPt':rawPt, 'pt':1.1*rawPt, 'eta':random.uniform( -4.7, 4.7, n ), 'phi':random.uniform( -3, 3, n ),
+                  'area':random.uniform( 0.4, 0.6, n ), 'btagCSV':random.uniform( 0, 1, n ), 'mcPt':random.uniform( -10, 200, n ) }
+        event = Event()
+        for key, value in values.iteritems():
+            arrays[i_event][key] = value
+            setattr( event, key, arrays[i_event][key].item() )
+        event.nJetGood = n
+        for var in jet_fields:
+            column = np.array( jets[var], dtype = 'float32' )
+            arrays[i_event]['%s_%s'%( jet_collection, var )] = column
+            setattr( event, '%s_%s'%( jet_collection, var ), column.tolist() )
+        events.append( event )
+    return events, arrays
+
+def compare( isData, noL1 ):
+    nJets = [ 1, 2, 3, 1, 5, 2, 1, 4 ]
+    events, arrays = makeEvents( nJets )
+    corrector = SyntheticCorrector()
+    columns   = computeObservables( arrays, corrector, isData, alphas, noL1 = noL1 )
+
+    for i_event, event in enumerate( events ):
+        makeObservables( event, isData, corrector, jetVars = jet_fields, noL1 = noL1 )
+        for var in observables + [ 'alpha_%s_passed'%alpha for alpha in alphas ]:
+            assert np.isclose( columns[var][i_event], getattr( event, var ), rtol = 1e-9, equal_nan = True ), ( i_event, var, columns[var][i_event], getattr( event, var ) )
+        for name in [ 'leading_jet', 'subleading_jet' ]:
+            for var in [ 'pt', 'eta', 'rawPt', 'pt_corr', 'pt_corr_RC' ]:
+                assert np.isclose( columns['%s_%s'%( name, var )][i_event], getattr( event, name )[var], rtol = 1e-9, equal_nan = True ), ( i_event, name, var )
+        r_gen = getattr( event, 'r_gen' )
+        assert ( np.isnan( columns['r_gen'][i_event] ) and r_gen is None ) or np.isclose( columns['r_gen'][i_event], r_gen, rtol = 1e-9 ), ( i_event, 'r_gen' )
+
+    # events with a single jet have alpha = 0 and pass all alpha cuts
+    single = np.array( nJets ) == 1
+    assert ( columns['alpha'][single] == 0 ).all()
+    assert all( columns['alpha_%s_passed'%alpha][single].all() for alpha in alphas )
+
+def test_mc():
+    compare( isData = False, noL1 = False )
+
+def test_data():
+    compare( isData = True, noL1 = False )
+
+def test_noL1():
+    compare( isData = False, noL1 = True )
+
+if __name__ == "__main__":
+    test_mc()
+    test_data()
+    test_noL1()
+    print "All checks passed."
@@ -2,15 +2,26 @@
 '''
 # Standard imports
 import os
+import math
+import shutil
 import tarfile
-import ROOT
+import bisect
+import numpy as np
+from collections import OrderedDict
 
 # Logging
 
 import logging
 logger = logging.getLogger(__name__)
 
-from JetMET.tools.helpers import wget
+# ROOT is only needed for the CMSSW FactorizedJetCorrector
+try:
+    import ROOT
+except ImportError:
+    ROOT = None
+
+# Native (numpy) JEC evaluation
+import JetMET.JetCorrector.JetCorrectorParameters as native_jec
 
 correction_levels_data  = [ 'L1FastJet', 'L2Relative', 'L3Absolute', 'L2L3Residual' ]
 correction_levels_mc    = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
@@ -20,31 +31,117 @@ class JetCorrector:
     data_directory   = "$CMSSW_BASE/src/JetMET/JetCorrector/data/"
     extension        = "tar.gz"
 
-    def __init__( self, iovs ):
+    def __init__( self, iovs, native = False, iovs_RC = None, cache_size = 0, cache_tolerance = 1e-4 ):
 
         self.iovs = iovs
+        # Optional L1RC txt files ( runnumber, txtfiles ), evaluated in the same call as the factorized levels
+        self.iovs_RC = iovs_RC
+        # Optional LRU cache of the scalar corrections. Inputs are quantized with cache_tolerance, 
+        # relative for rawPt and absolute for eta, area and rho. The key contains also the record index of every table, 
+        # such that jets on either side of a bin edge never share an entry. Within a record the correction of the first jet 
+        # in a quantization cell is returned, the results differ by at most cache_tolerance times the derivative of the correction. 
+        # Tables binned in JetPt are evaluated without the cache. cache_size = 0 disables the cache.
+        self.cache_size      = cache_size
+        self.cache_tolerance = cache_tolerance
+        self.cache_hits      = 0
+        self.cache_misses    = 0
+        # Use the numpy evaluation instead of the CMSSW FactorizedJetCorrector
+        self.native = native or ( ROOT is None )
+        if self.native and not native:
+            logger.info( "ROOT not available. Using native JEC evaluation." )
         self.makeNewCorrectors()
     
-    def makeNewCorrectors( self, require = None ):
-        self.jetCorrectors = []
-        for runnumber, txtfiles in self.iovs:
-            params = ROOT.vector(ROOT.JetCorrectorParameters)()
-            for txtfile in txtfiles:
+    def makeCorrector( self, txtfiles, require = None ):
+        ''' Returns the levels, the corrector and the native tables ( None for CMSSW correctors without cache ).
+        '''
+        params = [] if self.native else ROOT.vector(ROOT.JetCorrectorParameters)()
+        levels = []
+        # native tables for the record indices in the cache key
+        binParameters = [] if self.native or self.cache_size > 0 else None
+        for txtfile in txtfiles:
 
-                # Skip the file if not any of elements of require is found
-                if require is not None:
-                    if not any( r in txtfile for r in require):
-                        logger.debug( "Could not find any of %s in txt file %s. Skip.", ",".join(require), txtfile)
-                        continue 
+            # Skip the file if not any of elements of require is found
+            if require is not None:
+                if not any( r in txtfile for r in require):
+                    logger.debug( "Could not find any of %s in txt file %s. Skip.", ",".join(require), txtfile)
+                    continue 
 
-                logger.debug( "Including %s in corrector.", txtfile )
+            logger.debug( "Including %s in corrector.", txtfile )
 
+            if self.native:
+                params.append( native_jec.JetCorrectorParameters.fromCompiled( txtfile ) )
+            else:
                 params.push_back( ROOT.JetCorrectorParameters( txtfile, "" ) )
+                if binParameters is not None:
+                    binParameters.append( native_jec.JetCorrectorParameters.fromCompiled( txtfile ) )
+
+            # <filename>_<level>_<jetflavour>.txt
+            levels.append( os.path.basename( txtfile ).split('_')[-2] )
+
+        if self.native:
+            return levels, native_jec.FactorizedJetCorrector( params ), params
+        else:
+            return levels, ROOT.FactorizedJetCorrector( params ), binParameters
 
-            self.jetCorrectors.append( ( runnumber,  ROOT.FactorizedJetCorrector( params )) )
+    def makeNewCorrectors( self, require = None ):
+        jetCorrectors = []
+        binParameters = []
+        for runnumber, txtfiles in self.iovs:
+            self.levels, corrector, parameters = self.makeCorrector( txtfiles, require = require )
+            jetCorrectors.append( ( runnumber, corrector ) )
+            binParameters.append( ( runnumber, parameters ) )
+
+        jetCorrectors_RC = None
+        if self.iovs_RC is not None:
+            jetCorrectors_RC = []
+            for i_iov, ( runnumber, txtfiles ) in enumerate( self.iovs_RC ):
+                levels, corrector, parameters = self.makeCorrector( txtfiles )
+                jetCorrectors_RC.append( ( runnumber, corrector ) )
+                binParameters[i_iov] = ( binParameters[i_iov][0], binParameters[i_iov][1] + parameters if parameters is not None else None )
 
+        self.setCorrectors( jetCorrectors, jetCorrectors_RC = jetCorrectors_RC, binParameters = binParameters )
+
+    def setCorrectors( self, jetCorrectors, jetCorrectors_RC = None, binParameters = None ):
+        ''' Set the list of ( first run, corrector ) and reset the IOV lookup.
+            The optional L1RC correctors must have the same IOVs. binParameters, a list of ( first run, [ native tables ] ), 
+            provides the record indices for the cache key. Without it, the tables of native correctors are used.
+        '''
         # Sort wrt IOVs
-        self.jetCorrectors.sort( key = lambda p: p[0] )
+        self.jetCorrectors = sorted( jetCorrectors, key = lambda p: p[0] )
+        self.jetCorrectors_RC = sorted( jetCorrectors_RC, key = lambda p: p[0] ) if jetCorrectors_RC is not None else None
+        if self.jetCorrectors_RC is not None and [ p[0] for p in self.jetCorrectors_RC ] != [ p[0] for p in self.jetCorrectors ]:
+            raise ValueError( "IOVs of L1RC correctors differ from the IOVs of the factorized correctors." )
+        self.iov_runnumbers = np.array( [ runnumber for runnumber, corrector in self.jetCorrectors ] )
+        self.__iov_runnumbers_list = [ runnumber for runnumber, corrector in self.jetCorrectors ]
+        # Memoized IOV index for each run number seen so far
+        self.__iov_for_run = {}
+        # Native tables per IOV for the cache key, None if the IOV can't be cached
+        if binParameters is None:
+            binParameters = []
+            for i_iov, ( runnumber, corrector ) in enumerate( self.jetCorrectors ):
+                correctors = [ corrector ] + ( [ self.jetCorrectors_RC[i_iov][1] ] if self.jetCorrectors_RC is not None else [] )
+                parameters = sum( [ c.parameters for c in correctors ], [] ) if all( hasattr( c, 'parameters' ) for c in correctors ) else None
+                binParameters.append( ( runnumber, parameters ) )
+        self.__binParameters = [ parameters if parameters is not None and not any( 'JetPt' in p.binVars for p in parameters ) else None 
+            for runnumber, parameters in sorted( binParameters, key = lambda p: p[0] ) ]
+        # Cached corrections refer to the old correctors
+        self.clearCache()
+
+    def getIOVIndex( self, run ):
+        ''' Index of the IOV of run (bisect on the sorted IOVs, memoized per run). -1 if before the first IOV.
+        '''
+        try:
+            return self.__iov_for_run[run]
+        except KeyError:
+            i_iov = bisect.bisect_right( self.__iov_runnumbers_list, run ) - 1
+            self.__iov_for_run[run] = i_iov
+            return i_iov
+
+    def getCorrector( self, run ):
+        ''' Corrector for the IOV of run. None if before the first IOV.
+        '''
+        i_iov = self.getIOVIndex( run )
+        return self.jetCorrectors[i_iov][1] if i_iov >= 0 else None
 
     @classmethod        
     def fromTarBalls( cls, 
@@ -52,27 +149,35 @@ class JetCorrector:
             correctionLevels, 
             baseurl     = "https://github.com/cms-jet/JECDatabase/raw/master/tarballs/",
             jetflavour  = 'AK4PFchs',
+            native      = False,
+            L1RC        = False,
+            cache_size      = 0,
+            cache_tolerance = 1e-4,
             ):
 
-        _iovs = []
+        _iovs    = []
+        _iovs_RC = [] if L1RC else None
+        extracted = set()
         for runnumber, filename in iovs:
 
             txtfiles = []
+            txtfiles_RC = []
 
             # Download file
             source = os.path.join( baseurl, "%s.%s"%(filename, JetCorrector.extension) )
             target = os.path.join( os.path.expandvars( JetCorrector.data_directory ), "%s.%s"%(filename, JetCorrector.extension) )
 
-            for level in correctionLevels:
+            for level in correctionLevels + ( [ 'L1RC' ] if L1RC else [] ):
                 txtfile = os.path.join( os.path.expandvars( JetCorrector.data_directory ), "%s_%s_%s.txt"%( filename, level, jetflavour)  )
 
-                # Do we have the txt file?
-                if not os.path.exists( txtfile ):
+                # Do we have the txt file? (Extract each tarball only once)
+                if not os.path.exists( txtfile ) and target not in extracted:
                     logger.info( "txt file %s not found.", txtfile )
 
                     # Do we actually have the tar.gz?
                     if not os.path.exists( target ):
                         logger.info( "%s not found. Downloading from %s.", target, source )
+                        from JetMET.tools.helpers import wget
                         wget( source, target )
 
                     # Extract txt files that match the bill
@@ -83,26 +188,187 @@ class JetCorrector:
                             member_filename = os.path.basename( member.name )
                             logger.debug( "Found file %s in %s", member_filename, target )
                             with file( os.path.join( os.path.expandvars( JetCorrector.data_directory ), member_filename), 'w') as f_out:
-                                f_out.writelines( tar.extractfile( member ).readlines() )
+                                shutil.copyfileobj( tar.extractfile( member ), f_out )
+                    extracted.add( target )
 
                 logger.debug( "Adding txtfile %s", txtfile )
-                txtfiles.append( txtfile )
+                if level == 'L1RC' and L1RC:
+                    txtfiles_RC.append( txtfile )
+                else:
+                    txtfiles.append( txtfile )
 
             _iovs.append( ( runnumber, txtfiles ) )
+            if L1RC: _iovs_RC.append( ( runnumber, txtfiles_RC ) )
 
-        return cls( _iovs )
+        return cls( _iovs, native = native, iovs_RC = _iovs_RC, cache_size = cache_size, cache_tolerance = cache_tolerance )
 
     def reduceLevels( self, correctionLevels ):
         self.makeNewCorrectors( require = correctionLevels )
         return self 
 
+    def clearCache( self ):
+        self.__cache = OrderedDict()
+
+    def logCacheStatistics( self ):
+        n_calls = self.cache_hits + self.cache_misses
+        logger.info( "JEC cache: %i calls, %i hits, %i misses, hit rate %3.1f%%, %i entries (max. %i).", 
+            n_calls, self.cache_hits, self.cache_misses, 100.*self.cache_hits/n_calls if n_calls>0 else 0., len(self.__cache), self.cache_size )
+
+    def binKey( self, i_iov, eta, area, rho ):
+        ''' Record index of every table of the IOV, None if the IOV can't be cached.
+        '''
+        parameters = self.__binParameters[i_iov]
+        if parameters is None: return
+        values = { 'JetEta':eta, 'JetA':area, 'Rho':rho }
+        return tuple( int( p.binIndex( *[ values[var] for var in p.binVars ] ) ) for p in parameters )
+
+    def __cached( self, method, rawPt, eta, area, rho, run ):
+        ''' Look up ( method, IOV, record indices, quantized inputs ) in the LRU cache, evaluate and store if not found.
+            Returns a copy of cached dictionaries.
+        '''
+        i_iov = self.getIOVIndex( run )
+        if i_iov < 0: return
+
+        bins = self.binKey( i_iov, eta, area, rho )
+        # rawPt is quantized in log for a relative tolerance
+        if rawPt <= 0 or bins is None: return method( rawPt, eta, area, rho, i_iov )
+        tolerance = self.cache_tolerance
+        key = ( method.__name__, i_iov, bins, int( round( math.log( rawPt )/tolerance ) ), int( round( eta/tolerance ) ), int( round( area/tolerance ) ), int( round( rho/tolerance ) ) )
+
+        try:
+            result = self.__cache.pop( key )
+            self.cache_hits += 1
+        except KeyError:
+            result = method( rawPt, eta, area, rho, i_iov )
+            self.cache_misses += 1
+            if len( self.__cache ) >= self.cache_size:
+                self.__cache.popitem( last = False )
+        # (re-)insert as most recently used
+        self.__cache[key] = result
+        # the dictionary of subCorrections is copied, such that callers can't modify the cached entry
+        return dict( result ) if isinstance( result, dict ) else result
+
     def correction(self, rawPt, eta, area, rho, run ):
 
-        for runnumber, corrector in reversed( self.jetCorrectors ):
-            if run >= runnumber:
-                # logger.debug( "Using IOV %i", runnumber)
-                corrector.setJetPt( rawPt )
-                corrector.setJetEta( eta )
-                corrector.setJetA( area )
-                corrector.setRho( rho )
-                return corrector.getCorrection()
+        if self.cache_size > 0:
+            return self.__cached( self._correction, rawPt, eta, area, rho, run )
+
+        i_iov = self.getIOVIndex( run )
+        if i_iov < 0: return
+        return self._correction( rawPt, eta, area, rho, i_iov )
+
+    def _correction( self, rawPt, eta, area, rho, i_iov ):
+
+        corrector = self.jetCorrectors[i_iov][1]
+        corrector.setJetPt( rawPt )
+        corrector.setJetEta( eta )
+        corrector.setJetA( area )
+        corrector.setRho( rho )
+        return corrector.getCorrection()
+
+    def correction_batch(self, rawPt, eta, area, rho, run ):
+        ''' Vectorized correction. Takes arrays with one element per jet (flattened across events, scalars are broadcasted)
+            and returns an array of correction factors. Jets are grouped by IOV, jets before the first IOV get NaN.
+        '''
+        rawPt, eta, area, rho, run = np.broadcast_arrays( 
+            np.asarray( rawPt, dtype = 'float64' ), np.asarray( eta, dtype = 'float64' ), np.asarray( area, dtype = 'float64' ), 
+            np.asarray( rho, dtype = 'float64' ),   np.asarray( run ) )
+
+        result = np.full( rawPt.shape, float('nan') )
+
+        # index of the IOV for each jet
+        i_iovs = np.searchsorted( self.iov_runnumbers, run, side = 'right' ) - 1
+        for i_iov in np.unique( i_iovs ):
+            if i_iov < 0: continue
+            mask = ( i_iovs == i_iov )
+            result[mask] = self._evaluate_batch( self.jetCorrectors[i_iov][1], rawPt[mask], eta[mask], area[mask], rho[mask] )
+
+        return result
+
+    def subCorrections( self, rawPt, eta, area, rho, run ):
+        ''' Evaluate the chain once and return the cumulative factor after every level, e.g.
+            {'L1FastJet':L1, 'L2Relative':L1L2, 'L3Absolute':L1L2L3, 'L2L3Residual':L1L2L3Res}.
+            Contains also 'L1RC' if the L1RC correctors were loaded.
+        '''
+        if self.cache_size > 0:
+            return self.__cached( self._subCorrections, rawPt, eta, area, rho, run )
+
+        i_iov = self.getIOVIndex( run )
+        if i_iov < 0: return
+        return self._subCorrections( rawPt, eta, area, rho, i_iov )
+
+    def _subCorrections( self, rawPt, eta, area, rho, i_iov ):
+
+        corrector = self.jetCorrectors[i_iov][1]
+        corrector.setJetPt( rawPt )
+        corrector.setJetEta( eta )
+        corrector.setJetA( area )
+        corrector.setRho( rho )
+        result = dict( zip( self.levels, corrector.getSubCorrections() ) )
+
+        if self.jetCorrectors_RC is not None:
+            corrector_RC = self.jetCorrectors_RC[i_iov][1]
+            corrector_RC.setJetPt( rawPt )
+            corrector_RC.setJetEta( eta )
+            corrector_RC.setJetA( area )
+            corrector_RC.setRho( rho )
+            result['L1RC'] = corrector_RC.getCorrection()
+
+        return result
+
+    def subCorrections_batch( self, rawPt, eta, area, rho, run ):
+        ''' Vectorized subCorrections. Returns a dictionary of arrays of cumulative factors (and 'L1RC').
+        '''
+        rawPt, eta, area, rho, run = np.broadcast_arrays( 
+            np.asarray( rawPt, dtype = 'float64' ), np.asarray( eta, dtype = 'float64' ), np.asarray( area, dtype = 'float64' ), 
+            np.asarray( rho, dtype = 'float64' ),   np.asarray( run ) )
+
+        result    = np.full( rawPt.shape + ( len(self.levels), ), float('nan') )
+        result_RC = np.full( rawPt.shape, float('nan') )
+
+        i_iovs = np.searchsorted( self.iov_runnumbers, run, side = 'right' ) - 1
+        for i_iov in np.unique( i_iovs ):
+            if i_iov < 0: continue
+            mask = ( i_iovs == i_iov )
+            result[mask] = self._evaluate_sub_batch( self.jetCorrectors[i_iov][1], rawPt[mask], eta[mask], area[mask], rho[mask] )
+            if self.jetCorrectors_RC is not None:
+                result_RC[mask] = self._evaluate_batch( self.jetCorrectors_RC[i_iov][1], rawPt[mask], eta[mask], area[mask], rho[mask] )
+
+        result = { level:result[..., i_level] for i_level, level in enumerate( self.levels ) }
+        if self.jetCorrectors_RC is not None:
+            result['L1RC'] = result_RC
+        return result
+
+    @staticmethod
+    def _evaluate_sub_batch( corrector, rawPt, eta, area, rho ):
+        ''' Cumulative factors of a single corrector on arrays, shape ( nJets, nLevels ).
+        '''
+        if hasattr( corrector, 'subCorrections_batch' ):
+            return corrector.subCorrections_batch( rawPt, eta, area, rho )
+
+        result = []
+        for i in xrange( len(rawPt) ):
+            corrector.setJetPt( rawPt[i] )
+            corrector.setJetEta( eta[i] )
+            corrector.setJetA( area[i] )
+            corrector.setRho( rho[i] )
+            result.append( list( corrector.getSubCorrections() ) )
+        return np.array( result ).reshape( len(rawPt), -1 )
+
+    @staticmethod
+    def _evaluate_batch( corrector, rawPt, eta, area, rho ):
+        ''' Evaluate a single corrector on arrays. 
+        '''
+        # Use the vectorized evaluation if the corrector provides it
+        if hasattr( corrector, 'correction_batch' ):
+            return corrector.correction_batch( rawPt, eta, area, rho )
+
+        # Fall back to one call per jet (FactorizedJetCorrector)
+        result = np.empty( len(rawPt) )
+        for i in xrange( len(rawPt) ):
+            corrector.setJetPt( rawPt[i] )
+            corrector.setJetEta( eta[i] )
+            corrector.setJetA( area[i] )
+            corrector.setRho( rho[i] )
+            result[i] = corrector.getCorrection()
+        return result
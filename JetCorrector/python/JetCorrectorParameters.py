@@ -0,0 +1,365 @@
+''' Native (numpy) evaluation of JEC txt files without ROOT/CMSSW.
+    Mirrors JetCorrectorParameters/FactorizedJetCorrector from CondFormats/JetMETObjects.
+'''
+# Standard imports
+import os
+import re
+import math
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+# TFormula functions and their numpy counterparts
+formula_functions = {
+    'log':      np.log,
+    'log10':    np.log10,
+    'exp':      np.exp,
+    'pow':      np.power,
+    'sqrt':     np.sqrt,
+    'max':      np.maximum,
+    'min':      np.minimum,
+    'abs':      np.abs,
+    'fabs':     np.abs,
+    'atan':     np.arctan,
+    'cosh':     np.cosh,
+    'sinh':     np.sinh,
+    'tanh':     np.tanh,
+    'erf':      np.vectorize( math.erf, otypes = ['float64'] ),
+}
+for name in formula_functions.keys():
+    formula_functions['TMath::'+name.capitalize()] = formula_functions[name]
+formula_functions['TMath::Power'] = np.power
+formula_functions['TMath::Log10'] = np.log10
+formula_functions['TMath::ATan'] = np.arctan
+
+# formula variables in the order of the parametrization
+formula_variables = [ 'x', 'y', 'z', 't' ]
+
+def compileFormula( formula ):
+    ''' Translate a TFormula string (e.g. "max(0.0001,pow(x,[0]))") to a compiled python expression
+        that is evaluated with numpy arrays for x,y,z,t and the parameter matrix p (one row per jet).
+    '''
+    expression = formula.replace( '^', '**' )
+    # parameters [i] -> p[:,i]
+    expression = re.sub( r'\[(\d+)\]', lambda m: 'p[:,%s]'%m.group(1), expression )
+    # function names
+    def _replace( m ):
+        name = m.group(0)
+        if name in formula_functions:
+            return "functions['%s']" % name
+        elif name in formula_variables or name == 'p':
+            return name
+        else:
+            raise NotImplementedError( "Don't know how to evaluate '%s' in formula '%s'" % ( name, formula ) )
+    expression = re.sub( r'(?<![0-9.])[A-Za-z_][A-Za-z_0-9]*(::[A-Za-z_0-9]+)?', _replace, expression )
+    logger.debug( "Compiled formula '%s' to '%s'", formula, expression )
+    return compile( expression, formula, 'eval' )
+
+class JetCorrectorParameters:
+    ''' Parser for the JEC txt format (L1FastJet, L2Relative, L3Absolute, L2L3Residual, L1RC, ...).
+        Header:  {nBinVar binVar1 ... nParVar parVar1 ... formula [Correction level]}
+        Records: binMin1 binMax1 ... nValues parMin1 parMax1 ... p0 p1 ...
+    '''
+
+    # Compiled binary tables, one subdirectory per content hash of the txt file. 
+    # $JETMET_JEC_COMPILED overrides it, without CMSSW ( $CMSSW_BASE not set ) the user's cache directory is used.
+    compile_directory = "$CMSSW_BASE/src/JetMET/JetCorrector/data/compiled/"
+    compile_directory_env = "JETMET_JEC_COMPILED"
+    arrays            = [ 'binMin', 'binMax', 'parMin', 'parMax', 'params' ]
+
+    def __init__( self, txtfile = None ):
+
+        self.txtfile = txtfile
+        if txtfile is None: return
+
+        with open( os.path.expandvars( txtfile ) ) as f:
+            lines = [ l.strip() for l in f.readlines() ]
+        lines = [ l for l in lines if l and not l.startswith('#') ]
+
+        if not ( lines[0].startswith('{') and lines[0].endswith('}') ):
+            raise ValueError( "Could not find definition in first line of %s: '%s'" % ( txtfile, lines[0] ) )
+
+        self.parseDefinition( lines[0][1:-1] )
+        self.parseRecords( lines[1:] )
+
+        logger.debug( "Loaded %i records from %s with binning %r, parametrization %r and formula '%s'",
+            len(self.params), txtfile, self.binVars, self.parVars, self.formula_string )
+
+    @staticmethod
+    def contentHash( txtfile ):
+        ''' sha1 of the content of the txt file
+        '''
+        sha1 = hashlib.sha1()
+        with open( os.path.expandvars( txtfile ), 'rb' ) as f:
+            for block in iter( lambda: f.read( 1<<20 ), b'' ):
+                sha1.update( block )
+        return sha1.hexdigest()
+
+    @classmethod
+    def compileDirectory( cls ):
+        ''' $JETMET_JEC_COMPILED, compile_directory or, if its variables are not set, the fallback in the user's cache directory
+        '''
+        if os.environ.get( cls.compile_directory_env ):
+            return os.path.expanduser( os.path.expandvars( os.environ[cls.compile_directory_env] ) )
+        directory = os.path.expandvars( cls.compile_directory )
+        if '$' not in directory:
+            return directory
+        fallback = os.path.join( os.environ.get( 'XDG_CACHE_HOME' ) or os.path.expanduser( '~/.cache' ), 'JetMET', 'JetCorrector', 'compiled' )
+        logger.debug( "Could not expand %s. Using %s for the compiled tables.", cls.compile_directory, fallback )
+        return fallback
+
+    @classmethod
+    def fromCompiled( cls, txtfile, compile_directory = None ):
+        ''' Load the memory mapped binary table of a txt file. Compile it first if it is not found.
+        '''
+        compile_directory = os.path.expandvars( compile_directory ) if compile_directory is not None else cls.compileDirectory()
+        directory = os.path.join( compile_directory, cls.contentHash( txtfile ) )
+
+        if not os.path.exists( os.path.join( directory, 'definition.json' ) ):
+            logger.info( "Compiling %s to %s", txtfile, directory )
+            cls( txtfile ).save( directory )
+
+        result = cls.load( directory )
+        result.txtfile = txtfile
+        return result
+
+    def save( self, directory ):
+        ''' Write the definition and the tables (npy) to directory. Writes to a temporary directory that is renamed 
+            such that simultaneous jobs never see a partially written table.
+        '''
+        parent = os.path.dirname( os.path.abspath( directory ) )
+        if not os.path.exists( parent ):
+            try:
+                os.makedirs( parent )
+            except OSError: # race condition with other jobs
+                pass
+
+        tmp_directory = tempfile.mkdtemp( dir = parent )
+        for name in self.arrays:
+            np.save( os.path.join( tmp_directory, name+'.npy' ), getattr( self, name ) )
+        with open( os.path.join( tmp_directory, 'definition.json' ), 'w' ) as f:
+            json.dump( {'definition':self.definition, 'txtfile':self.txtfile}, f )
+        # mkdtemp makes the directory readable only by the owner, the tables are shared with the other users of the node
+        os.chmod( tmp_directory, 0755 )
+
+        try:
+            os.rename( tmp_directory, directory )
+            logger.debug( "Written compiled table %s", directory )
+        except OSError: # Another job was faster
+            shutil.rmtree( tmp_directory )
+
+    @classmethod
+    def load( cls, directory, mmap_mode = 'r' ):
+        ''' Load a compiled table. By default the arrays are memory mapped and shared by all processes on the node.
+        '''
+        result = cls()
+        with open( os.path.join( directory, 'definition.json' ) ) as f:
+            definition = json.load( f )
+        result.txtfile = definition['txtfile']
+        result.parseDefinition( str( definition['definition'] ) )
+        for name in cls.arrays:
+            setattr( result, name, np.load( os.path.join( directory, name+'.npy' ), mmap_mode = mmap_mode ) )
+        result.makeLookup()
+        return result
+
+    def parseDefinition( self, definition ):
+        self.definition = definition
+        tokens = definition.split()
+
+        nBinVar        = int( tokens[0] )
+        self.binVars   = tokens[1:1+nBinVar]
+        nParVar        = int( tokens[1+nBinVar] )
+        self.parVars   = tokens[2+nBinVar:2+nBinVar+nParVar]
+        rest           = tokens[2+nBinVar+nParVar:]
+
+        self.formula_string = rest[0] if len(rest)>0 else None
+        self.level          = rest[2] if len(rest)>2 and rest[1] == 'Correction' else ( rest[-1] if len(rest)>1 else None )
+
+        # 'None' is used for formula-less files (e.g. JER scale factors)
+        self.formula = compileFormula( self.formula_string ) if ( nParVar > 0 and self.formula_string is not None ) else None
+
+    def parseRecords( self, lines ):
+        nBinVar, nParVar = len(self.binVars), len(self.parVars)
+
+        records = [ map( float, l.split() ) for l in lines ]
+
+        self.binMin = np.array( [ r[0:2*nBinVar:2] for r in records ] ).reshape( len(records), nBinVar )
+        self.binMax = np.array( [ r[1:2*nBinVar:2] for r in records ] ).reshape( len(records), nBinVar )
+
+        offset = 2*nBinVar+1
+        self.parMin = np.array( [ r[offset:offset+2*nParVar:2] for r in records ] ).reshape( len(records), nParVar )
+        self.parMax = np.array( [ r[offset+1:offset+2*nParVar:2] for r in records ] ).reshape( len(records), nParVar )
+
+        # Pad with zeros in case the number of parameters varies
+        params = [ r[offset+2*nParVar:] for r in records ]
+        nParams = max( map( len, params ) )
+        self.params = np.zeros( ( len(records), nParams ) )
+        for i_record, p in enumerate( params ):
+            self.params[i_record, :len(p)] = p
+
+        self.makeLookup()
+
+    def makeLookup( self ):
+        # Sorted lower bin boundaries for the searchsorted lookup in case of a single binning variable
+        if len(self.binVars) == 1:
+            self.__order    = np.argsort( self.binMin[:,0], kind = 'mergesort' )
+            self.__sortedMin = self.binMin[self.__order, 0]
+        # Two binning variables (e.g. JetEta, Rho of the JER resolution): grid of the second variable per bin of the first
+        self.__grid = self.makeGrid() if len(self.binVars) == 2 else None
+
+    def makeGrid( self ):
+        ''' Bins of the first variable and, for each of them, the records sorted in the second variable.
+            None if the bins of the first variable overlap or the bins of the second variable overlap within one of them.
+        '''
+        binMin, binMax = np.asarray( self.binMin ), np.asarray( self.binMax )
+        bins = sorted( set( zip( binMin[:,0], binMax[:,0] ) ) )
+        if any( low < previous_high for ( previous_low, previous_high ), ( low, high ) in zip( bins[:-1], bins[1:] ) ):
+            logger.debug( "Irregular binning in %s in %s. Using the scan over records.", self.binVars[0], self.txtfile )
+            return None
+
+        order, start = [], []
+        for low, high in bins:
+            records = np.where( ( binMin[:,0] == low ) & ( binMax[:,0] == high ) )[0]
+            records = records[ np.argsort( binMin[records, 1], kind = 'mergesort' ) ]
+            if ( binMin[records[1:], 1] < binMax[records[:-1], 1] ).any():
+                logger.debug( "Irregular binning in %s in %s. Using the scan over records.", self.binVars[1], self.txtfile )
+                return None
+            start.append( len( order ) )
+            order.extend( records )
+        start.append( len( order ) )
+
+        order = np.array( order, dtype = 'int64' )
+        return {
+            'min':   np.array( [ b[0] for b in bins ] ),
+            'max':   np.array( [ b[1] for b in bins ] ),
+            'start': np.array( start, dtype = 'int64' ),
+            'order': order,
+            'min2':  binMin[order, 1],
+        }
+
+    def binIndex( self, *binValues ):
+        ''' Record index for each jet ( -1 if outside the binning ), binMin <= x < binMax.
+        '''
+        binValues = [ np.asarray( v, dtype = 'float64' ) for v in binValues ]
+        if len(binValues) != len(self.binVars):
+            raise ValueError( "Need %i binning variables %r, got %i." % ( len(self.binVars), self.binVars, len(binValues) ) )
+
+        if len( self.binVars ) == 1:
+            i_sorted = np.searchsorted( self.__sortedMin, binValues[0], side = 'right' ) - 1
+            index    = self.__order[ np.maximum( i_sorted, 0 ) ]
+            inside   = ( i_sorted >= 0 ) & ( binValues[0] < self.binMax[index, 0] )
+            return np.where( inside, index, -1 )
+
+        if self.__grid is not None:
+            return self.__gridIndex( *binValues )
+
+        # Irregular binning: first matching record
+        index = np.full( binValues[0].shape, -1, dtype = 'int64' )
+        for i_record in reversed( xrange( len(self.params) ) ):
+            inside = np.ones( binValues[0].shape, dtype = 'bool' )
+            for i_var, v in enumerate( binValues ):
+                inside &= ( v >= self.binMin[i_record, i_var] ) & ( v < self.binMax[i_record, i_var] )
+            index[inside] = i_record
+        return index
+
+    def __gridIndex( self, v1, v2 ):
+        ''' searchsorted in the first variable, then a vectorized bisection in the second variable 
+            within the records of the bin of the first variable
+        '''
+        grid   = self.__grid
+        v1, v2 = np.broadcast_arrays( v1, v2 )
+        i_bin  = np.searchsorted( grid['min'], v1, side = 'right' ) - 1
+        i_bin_ = np.maximum( i_bin, 0 )
+        inside = ( i_bin >= 0 ) & ( v1 < grid['max'][i_bin_] )
+
+        # rightmost record with binMin <= v2 in [ start, stop )
+        first  = grid['start'][i_bin_]
+        lo, hi = first.copy(), grid['start'][i_bin_+1].copy()
+        last   = len( grid['min2'] ) - 1
+        while True:
+            active = lo < hi
+            if not active.any(): break
+            mid    = ( lo + hi )//2
+            right  = grid['min2'][ np.minimum( mid, last ) ] <= v2
+            lo     = np.where( active & right,  mid + 1, lo )
+            hi     = np.where( active & ~right, mid, hi )
+
+        position = lo - 1
+        index    = grid['order'][ np.clip( position, 0, last ) ]
+        inside  &= ( position >= first ) & ( v2 < self.binMax[index, 1] )
+        return np.where( inside, index, -1 )
+
+    def evaluate( self, binValues, parValues, default = 1. ):
+        ''' Evaluate the formula for arrays of binning and parametrization variables.
+            Parametrization variables are clipped to the range of the record. Returns 'default' outside the binning.
+        '''
+        index  = self.binIndex( *binValues )
+        found  = ( index >= 0 )
+        index_ = np.where( found, index, 0 )
+
+        variables = {'functions':formula_functions, 'p':self.params[index_]}
+        for i_var, v in enumerate( parValues ):
+            variables[formula_variables[i_var]] = np.clip( np.asarray( v, dtype = 'float64' ), self.parMin[index_, i_var], self.parMax[index_, i_var] )
+
+        with np.errstate( all = 'ignore' ):
+            result = eval( self.formula, {}, variables ) * np.ones( index.shape )
+
+        return np.where( found, result, default )
+
+class FactorizedJetCorrector:
+    ''' Native replacement for ROOT.FactorizedJetCorrector. The jet pt is updated after each level.
+        Provides the scalar setter interface as well as vectorized evaluation.
+    '''
+
+    supported_variables = [ 'JetPt', 'JetEta', 'JetA', 'Rho' ]
+
+    def __init__( self, parameters ):
+        self.parameters = list(parameters)
+        for p in self.parameters:
+            for var in p.binVars + p.parVars:
+                if var not in self.supported_variables:
+                    raise NotImplementedError( "Variable %s in %s not supported. Supported: %r" % ( var, p.txtfile, self.supported_variables ) )
+
+    def subCorrections_batch( self, rawPt, eta, area, rho ):
+        ''' Cumulative correction factors after each level, shape ( nJets, nLevels ).
+        '''
+        values = {
+            'JetPt':  np.array( rawPt, dtype = 'float64' ),
+            'JetEta': np.asarray( eta, dtype = 'float64' ),
+            'JetA':   np.asarray( area, dtype = 'float64' ),
+            'Rho':    np.asarray( rho, dtype = 'float64' ),
+        }
+        result = np.ones( ( len(values['JetPt']), len(self.parameters) ) )
+        factor = np.ones( len(values['JetPt']) )
+        for i_level, p in enumerate( self.parameters ):
+            scale = p.evaluate( [ values[var] for var in p.binVars ], [ values[var] for var in p.parVars ] )
+            values['JetPt'] = values['JetPt']*scale
+            factor = factor*scale
+            result[:, i_level] = factor
+        return result
+
+    def correction_batch( self, rawPt, eta, area, rho ):
+        if len( self.parameters ) == 0: return np.ones( len(rawPt) )
+        return self.subCorrections_batch( rawPt, eta, area, rho )[:, -1]
+
+    # ROOT.FactorizedJetCorrector interface
+    def setJetPt( self, pt ):
+        self.pt = pt
+    def setJetEta( self, eta ):
+        self.eta = eta
+    def setJetA( self, area ):
+        self.area = area
+    def setRho( self, rho ):
+        self.rho = rho
+
+    def getSubCorrections( self ):
+        return list( self.subCorrections_batch( [self.pt], [self.eta], [self.area], [self.rho] )[0] )
+
+    def getCorrection( self ):
+        return float( self.correction_batch( [self.pt], [self.eta], [self.area], [self.rho] )[0] )
@@ -1,19 +1,20 @@
-''' JEC on the fly
+''' JER on the fly. Resolution and SF txt files are parsed and evaluated natively (numpy), no ROOT needed.
 '''
 # Standard imports
 import os
-import tarfile
-import ROOT
-import bisect
 import random 
 from math import sqrt
+import numpy as np
 
 # Logging
 
 import logging
 logger = logging.getLogger(__name__)
 
-from JetMET.tools.helpers import wget
+import JetMET.tools.counterRandom as counterRandom
+
+# The JER txt files have the JEC txt file format
+from JetMET.JetCorrector.JetCorrectorParameters import JetCorrectorParameters
 
 class JetSmearer:
 
@@ -22,6 +23,11 @@ class JetSmearer:
 
     parametrization = "{1 JetEta 0 None ScaleFactor}"
 
+    supported_variables = [ 'JetPt', 'JetEta', 'Rho' ]
+
+    # seed of the counter-based random numbers for the stochastic smearing
+    random_seed     = 0
+
     def __init__( self, era, flavor ):
 
         # Resolution
@@ -33,6 +39,9 @@ class JetSmearer:
         sf_txtfile  = os.path.expandvars( os.path.join( self.data_directory, sf_filename ) )
 
         # Do we have the txt files?
+        if not ( os.path.exists( res_txtfile ) and os.path.exists( sf_txtfile ) ):
+            # helpers imports ROOT
+            from JetMET.tools.helpers import wget
         if not os.path.exists( res_txtfile ):
             logger.info( "Resolution txt file %s not found.", res_txtfile )
             source = self.downloadurl+'/%s/%s' % ( era, res_filename )
@@ -44,54 +53,46 @@ class JetSmearer:
             logger.info( "Downloading from %s.", source )
             wget( source, sf_txtfile )
 
-        self.sf_data = []
-
         # read the SF file. 
         self.read_SF_txtfile(   sf_txtfile )
-        # load resolution file and make jet resolution object
-        self.make_resolution_object( res_txtfile )
+        # load resolution file
+        self.read_resolution_txtfile( res_txtfile )
     
-    def make_resolution_object( self, txtfile ):
-        try:
-            self.resolution_object = ROOT.JME.JetResolutionObject( txtfile )
-        except TypeError:
-            logger.warning( "Problem with %s", txtfile )
-            raise TypeError
-
-        self.p                 = ROOT.JME.JetParameters()
+    def read_resolution_txtfile( self, txtfile ):
+        ''' Binned table of the resolution parameters with compiled formula
+        '''
+        self.resolution_parameters = JetCorrectorParameters.fromCompiled( txtfile )
+        for var in self.resolution_parameters.binVars + self.resolution_parameters.parVars:
+            if var not in self.supported_variables:
+                raise NotImplementedError( "Variable %s in %s not supported. Supported: %r" % ( var, txtfile, self.supported_variables ) )
 
     def get_jet_resolution( self, pt, eta, rho ):
         ''' Evaluate JER for a jet. Return None if outside the boundaries defined by the txt file
         '''
-        self.p.setJetPt( pt )
-        self.p.setJetEta( eta )
-        self.p.setRho( rho )
-        record = self.resolution_object.getRecord(self.p)
-        if record: return self.resolution_object.evaluateFormula( record, self.p )
+        jer = float( self.get_jet_resolution_batch( [pt], [eta], [rho] )[0] )
+        if not np.isnan( jer ): return jer
 
     def read_SF_txtfile( self, txtfile ):
-        ''' Read manually the txt file for SF. Didn't work with the JetResolutionObject
+        ''' Read the txt file for SF with the same parser as the resolution.
             Only supports ( & checks) single variable eta binning. 
             Returns boundary value if outside boundary.
         '''
+        sf_parameters = JetCorrectorParameters.fromCompiled( txtfile )
+        if not "{%s}" % " ".join( sf_parameters.definition.split() ) == self.parametrization:
+            raise NotImplementedError( "JER SF file %s does not start with '%s' but with '{%s}'" % ( txtfile, self.parametrization, sf_parameters.definition ) )
 
-        with open( txtfile ) as f:
-            content = [l.strip() for l in f.readlines()]
-            if not content[0] == self.parametrization:
-                raise NotImplementedError( "JER SF file %s does not start with '%s' but with '%s'" % ( txtfile, self.parametrization, content[0] ) )
-            for line in content[1:]:
-                eta_min, eta_max, nn , sf, sf_low, sf_high = map( float, line.split() )  
-                self.sf_data.append( [ eta_min, eta_max, sf, sf_low, sf_high] )
+        logger.debug( "Loaded %i SF from file %s", len(sf_parameters.params), txtfile )
 
-            logger.debug( "Loaded %i SF from file %s", len(self.sf_data), txtfile )
+        order = np.argsort( sf_parameters.binMin[:,0], kind = 'mergesort' )
+        self.eta_thresholds = sf_parameters.binMin[order[1:], 0]
 
-            self.eta_thresholds = [ c[0] for c in self.sf_data[1:] ] 
+        # ( nominal, low, high )
+        self.sf_array = np.array( sf_parameters.params[order, :3] )
     
     def get_SF(self, eta):
         ''' Evaluate the JER SF
         '''
-        n = bisect.bisect_left( self.eta_thresholds, eta )
-        return self.sf_data[n][2:]
+        return list( self.sf_array[ np.searchsorted( self.eta_thresholds, eta, side = 'left' ) ] )
 
     def scaling_correction( self, pt, mcPt, eta, rho):
         ''' Get JER varied pt values according to the scaling recipe
@@ -107,22 +108,29 @@ class JetSmearer:
     def __scaling_correction( pt, mcPt, sf) :
         return [ max(0, 1 + (s - 1)*(1 - mcPt/(1.0*pt))) for s in sf ]
 
-    def stochastic_correction( self, pt, eta, rho ):
-        ''' Get JER varied pt values according to the stochastic recipe
+    def stochastic_correction( self, pt, eta, rho, counters = None ):
+        ''' Get JER varied pt values according to the stochastic recipe.
+            If counters = ( run, lumi, event, jet index ) are given, the smearing is reproducible (counter-based random numbers),
+            otherwise the global 'random' is used.
         '''
         jer  = self.get_jet_resolution( pt, eta, rho )
         sf   = self.get_SF( eta )
-        return self.__stochastic_correction( pt, jer, sf )
+        return self.__stochastic_correction( pt, jer, sf, counters )
 
-    @staticmethod
-    def __stochastic_correction( pt, jer, sf ):
+    @classmethod
+    def __gauss( cls, counters ):
+        return counterRandom.gauss( *counters, seed = cls.random_seed )
+
+    @classmethod
+    def __stochastic_correction( cls, pt, jer, sf, counters = None ):
         if jer is not None: 
-            rand = random.gauss(0, jer)
+            # size-1 arrays, such that scalar and vectorized smearing are identical
+            rand = jer*float( cls.__gauss( counters )[0] ) if counters is not None else random.gauss(0, jer)
             return [ max( 0, (1 + rand*sqrt(max(0, s**2 - 1)))) for s in sf ] 
         else:
             return [ 1 for s in sf ]
 
-    def hybrid_correction( self, pt, mcPt, eta, rho ):
+    def hybrid_correction( self, pt, mcPt, eta, rho, counters = None ):
         ''' Get JER varied pt values according to the hybrid recipe
         '''
         jer  = self.get_jet_resolution( pt, eta, rho )
@@ -135,34 +143,80 @@ class JetSmearer:
                 return self.__scaling_correction( pt, mcPt, sf )
             else:
                 #logger.debug( "Doing stochastic")
-                return self.__stochastic_correction( pt, jer, sf )
+                return self.__stochastic_correction( pt, jer, sf, counters )
         else:
             return [ 1 for s in sf ]
 
+    # Vectorized versions. Take arrays with one element per jet (scalars are broadcasted) and return ( nJets, 3 ) arrays 
+    # of ( nominal, down, up ) factors, i.e. in the order of the SF columns in the txt file.
+
+    def get_jet_resolution_batch( self, pt, eta, rho ):
+        ''' Evaluate JER for arrays of jets. NaN if outside the boundaries defined by the txt file
+        '''
+        values = { 'JetPt':pt, 'JetEta':eta, 'Rho':rho }
+        try:
+            return self.resolution_parameters.evaluate( 
+                [ values[var] for var in self.resolution_parameters.binVars ], 
+                [ values[var] for var in self.resolution_parameters.parVars ], 
+                default = float('nan') )
+        except KeyError as e:
+            raise NotImplementedError( "Variable %s in %s not supported." % ( e, self.resolution_parameters.txtfile ) )
+
+    def get_SF_batch( self, eta ):
+        ''' Evaluate the JER SF, shape ( nJets, 3 )
+        '''
+        return self.sf_array[ np.searchsorted( self.eta_thresholds, eta, side = 'left' ) ]
+
+    @staticmethod
+    def __broadcast( *args ):
+        return np.broadcast_arrays( *[ np.atleast_1d( np.asarray( a, dtype = 'float64' ) ) for a in args ] )
+
+    def scaling_correction_batch( self, pt, mcPt, eta, rho ):
+        ''' Vectorized scaling_correction
+        '''
+        pt, mcPt, eta, rho = self.__broadcast( pt, mcPt, eta, rho )
+        jer = self.get_jet_resolution_batch( pt, eta, rho )
+        sf  = self.get_SF_batch( eta )
+        with np.errstate( invalid = 'ignore' ):
+            matched = ( ~np.isnan( jer ) ) & ( mcPt > 0 ) & ( np.abs( pt - mcPt ) < 3*pt*jer )
+        return np.where( matched[:,np.newaxis], self.__scaling_correction_batch( pt, mcPt, sf ), 1. )
+
+    @staticmethod
+    def __scaling_correction_batch( pt, mcPt, sf ):
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            return np.maximum( 0, 1 + ( sf - 1 )*( 1 - mcPt/pt )[:,np.newaxis] )
+
+    def stochastic_correction_batch( self, pt, eta, rho, counters = None ):
+        ''' Vectorized stochastic_correction. counters = ( run, lumi, event, jet index ) arrays (or scalars).
+        '''
+        pt, eta, rho = self.__broadcast( pt, eta, rho )
+        jer = self.get_jet_resolution_batch( pt, eta, rho )
+        sf  = self.get_SF_batch( eta )
+        return self.__stochastic_correction_batch( jer, sf, counters )
+
+    @classmethod
+    def __stochastic_correction_batch( cls, jer, sf, counters = None ):
+        # one random number per jet, shared by the SF variations
+        if counters is not None:
+            gauss = np.broadcast_to( cls.__gauss( counters ), jer.shape )
+        else:
+            gauss = np.random.normal( 0, 1, len(jer) )
+        rand = gauss*np.nan_to_num( jer )
+        result = np.maximum( 0, 1 + rand[:,np.newaxis]*np.sqrt( np.maximum( 0, sf**2 - 1 ) ) )
+        return np.where( np.isnan( jer )[:,np.newaxis], 1., result )
+
+    def hybrid_correction_batch( self, pt, mcPt, eta, rho, counters = None ):
+        ''' Vectorized hybrid_correction. counters = ( run, lumi, event, jet index ) arrays (or scalars).
+        '''
+        pt, mcPt, eta, rho = self.__broadcast( pt, mcPt, eta, rho )
+        jer = self.get_jet_resolution_batch( pt, eta, rho )
+        sf  = self.get_SF_batch( eta )
+
+        with np.errstate( invalid = 'ignore' ):
+            matched = ( ~np.isnan( jer ) ) & ( mcPt > 0 ) & ( np.abs( pt - mcPt ) < 3*pt*jer )
+        return np.where( matched[:,np.newaxis], self.__scaling_correction_batch( pt, mcPt, sf ), self.__stochastic_correction_batch( jer, sf, counters ) )
+
     def delete( self ):
-        ''' I don't know why this is needed and why it needs to be called before exit.
-            Destructur segfaults on exit. Doing nothing segfaults on exit
-            in call of JME::JetResolutionObject::Definition::~Definition()
+        ''' Kept for compatibility. Was needed to avoid the segfault in the destructor of JME::JetResolutionObject at exit.
         '''
-        if self.resolution_object: self.resolution_object.__destruct__()
-
-#5  0x0000000009f7dcc0 in ?? ()
-#6  0x00007fbaf3913c9c in std::__shared_count<(__gnu_cxx::_Lock_policy)2>::~__shared_count() () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/cms/cmssw/CMSSW_8_0_26/lib/slc6_amd64_gcc530/libDataFormatsProvena
-#7  0x00007fbaf314b9c5 in JME::JetResolutionObject::Definition::~Definition() () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/cms/cmssw/CMSSW_8_0_26/lib/slc6_amd64_gcc530/libCondFormatsJetMETObjects.so
-#8  0x00007fbaf314a85f in ROOT::delete_JMEcLcLJetResolutionObject(void*) () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/cms/cmssw/CMSSW_8_0_26/lib/slc6_amd64_gcc530/libCondFormatsJetMETObjects.so
-#9  0x00007fbafef12891 in TClass::Destructor(void*, bool) () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/cms/cmssw-patch/CMSSW_8_0_26_patch1/external/slc6_amd64_gcc530/lib/libCore.so
-#10 0x00007fbaff6d57af in PyROOT::op_dealloc_nofree(PyROOT::ObjectProxy*) () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/lcg/root/6.06.00-ikhhed6/lib/libPyROOT.so
-#11 0x00007fbaff6d5869 in PyROOT::(anonymous namespace)::op_dealloc(PyROOT::ObjectProxy*) () from /cvmfs/cms.cern.ch/slc6_amd64_gcc530/lcg/root/6.06.00-ikhhed6/lib/libPyROOT.so
-#12 0x00007fbb0591b802 in subtype_dealloc (self=0x7fbaf2f262f0) at Objects/typeobject.c:1030
-#13 0x00007fbb058fadcb in dict_dealloc (mp=0x7fbaf32aac58) at Objects/dictobject.c:1010
-#14 0x00007fbb058c7a4a in instance_dealloc (inst=0x7fbaf2f1e2d8) at Objects/classobject.c:681
-#15 0x00007fbb058fb7b7 in insertdict_by_entry (value=0x7fbb05a31a80 <_Py_NoneStruct>, ep=0x9a0ec30, hash=-4239209804666570030, key=0x7fbaff74e1b0, mp=0x7fbb057cf168) at Objects/dictobject.c:519
-#16 insertdict (mp=0x7fbb057cf168, key=0x7fbaff74e1b0, hash=-4239209804666570030, value=0x7fbb05a31a80 <_Py_NoneStruct>) at Objects/dictobject.c:556
-#17 0x00007fbb058fd147 in dict_set_item_by_hash_or_entry (ep=0x0, value=0x7fbb05a31a80 <_Py_NoneStruct>, hash=<optimized out>, key=<optimized out>, op=0x7fbb057cf168) at Objects/dictobject.c:765
-#18 PyDict_SetItem (op=opentry=0x7fbb057cf168, key=<optimized out>, value=valueentry=0x7fbb05a31a80 <_Py_NoneStruct>) at Objects/dictobject.c:818
-#19 0x00007fbb05901324 in _PyModule_Clear (m=<optimized out>) at Objects/moduleobject.c:139
-#20 0x00007fbb05982263 in PyImport_Cleanup () at Python/import.c:477
-#21 0x00007fbb05993bfe in Py_Finalize () at Python/pythonrun.c:458
-#22 0x00007fbb059aa01f in Py_Main (argc=<optimized out>, argv=<optimized out>) at Modules/main.c:665
-#23 0x00000036f181ed1d in __libc_start_main () from /lib64/libc.so.6
-#24 0x00000000004006b1 in _start ()
+        pass
@@ -0,0 +1,53 @@
+''' Micro-benchmark of the per-jet IOV resolution overhead in JetCorrector.correction 
+    (bisect + per-run memoization vs. the linear reversed scan) for 1, 4 and 20 IOVs.
+    Uses dummy correctors such that only the IOV lookup is measured.
+'''
+import timeit
+import random
+
+from JetMET.JetCorrector.JetCorrector import JetCorrector
+
+class DummyCorrector:
+    def setJetPt( self, pt ):
+        pass
+    def setJetEta( self, eta ):
+        pass
+    def setJetA( self, area ):
+        pass
+    def setRho( self, rho ):
+        pass
+    def getCorrection( self ):
+        return 1.
+
+def linear_scan_correction( jetCorrectors, rawPt, eta, area, rho, run ):
+    ''' The IOV lookup as it was before: reversed linear scan for every jet
+    '''
+    for runnumber, corrector in reversed( jetCorrectors ):
+        if run >= runnumber:
+            corrector.setJetPt( rawPt )
+            corrector.setJetEta( eta )
+            corrector.setJetA( area )
+            corrector.setRho( rho )
+            return corrector.getCorrection()
+
+if __name__ == "__main__":
+    # Logging
+    import JetMET.tools.logger as logger
+    logger  = logger.get_logger('INFO', logFile = None)
+
+    first_run, last_run = 273150, 284044
+    nJets               = 100000
+    jets_per_run        = 500 # consecutive jets from the same run
+
+    random.seed(1)
+    runs = sorted( random.randint( first_run, last_run ) for i in xrange( nJets/jets_per_run ) )
+    jets = [ ( 50., 1.2, 0.5, 20., run ) for run in runs for i in xrange( jets_per_run ) ]
+
+    for nIOVs in [ 1, 4, 20 ]:
+        jetCorrector = JetCorrector( [], native = True )
+        jetCorrector.setCorrectors( [ ( 1 if i == 0 else first_run + i*( last_run - first_run )/nIOVs, DummyCorrector() ) for i in xrange( nIOVs ) ] )
+
+        t_scan    = min( timeit.repeat( lambda: [ linear_scan_correction( jetCorrector.jetCorrectors, *jet ) for jet in jets ], number = 1, repeat = 3 ) )
+        t_bisect  = min( timeit.repeat( lambda: [ jetCorrector.correction( *jet ) for jet in jets ], number = 1, repeat = 3 ) )
+
+        logger.info( "%2i IOVs: %4.3f us/jet (reversed scan) %4.3f us/jet (bisect+memo)", nIOVs, 1e6*t_scan/nJets, 1e6*t_bisect/nJets )
@@ -0,0 +1,250 @@
+''' Checks of the native (numpy) JEC evaluation.
+    The self contained checks use a synthetic txt file with hand computed values and run without CMSSW (also with pytest).
+    test_reference compares to the CMSSW FactorizedJetCorrector values stored in data/reference, together with the records 
+    of the real txt files they need. With --makeReference these reference files are (re-)made (needs ROOT and the JEC tarballs).
+    With --cmssw the native evaluation is compared to the CMSSW FactorizedJetCorrector on a large grid.
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+import JetMET.JetCorrector.JetCorrectorParameters as native_jec
+
+# config
+Summer16_03Feb2017_DATA = \
+[(1,      'Summer16_03Feb2017BCD_V6_DATA'),
+ (276831, 'Summer16_03Feb2017EF_V6_DATA' ),
+ (278802, 'Summer16_03Feb2017G_V6_DATA' ),
+ (280919, 'Summer16_03Feb2017H_V6_DATA')]
+
+Summer16_03Feb2017_MC = [(1, 'Summer16_03Feb2017_V1_MC') ]
+
+correction_levels_data  = [ 'L1FastJet', 'L2Relative', 'L3Absolute', 'L2L3Residual' ]
+correction_levels_mc    = [ 'L1FastJet', 'L2Relative', 'L3Absolute' ]
+
+# maximum relative deviation native vs. CMSSW
+tolerance = 1e-5
+
+# CMSSW reference values of one IOV per data/MC, all levels and L1RC
+reference_directory = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), '..', 'data', 'reference' )
+reference_iovs      = [ ( 'Summer16_03Feb2017H_V6_DATA', correction_levels_data ), ( 'Summer16_03Feb2017_V1_MC', correction_levels_mc ) ]
+reference_jetflavour = 'AK4PFchs'
+
+# Synthetic L2Relative file: two eta bins, pt clipped to [10, 100]
+synthetic_txt = """\
+{1 JetEta 1 JetPt max(0.0001,pow(x,[0]))*[1]+[2]*log10(x) Correction L2Relative}
+-5.0 0.0 5 10 100 0.5 2.0 1.0
+0.0 5.0 5 10 100 1.0 1.0 0.0
+"""
+
+def test_compileFormula():
+    p = np.array( [ [ 1., 2. ], [ 3., 0.5 ] ] )
+    x = np.array( [ 3., 100. ] )
+    f = native_jec.compileFormula( "[0]+[1]*x^2" )
+    assert np.allclose( eval( f, {}, {'functions':native_jec.formula_functions, 'p':p, 'x':x} ), [ 1.+2.*9., 3.+0.5*1e4 ] )
+    f = native_jec.compileFormula( "max(0.0001,pow(x,[0]))*[1]+TMath::Log10(x)" )
+    assert np.allclose( eval( f, {}, {'functions':native_jec.formula_functions, 'p':p, 'x':x} ), [ 3.**1*2.+np.log10(3.), 100.**3*0.5+2. ] )
+
+def test_evaluate():
+    directory = tempfile.mkdtemp()
+    try:
+        txtfile = os.path.join( directory, 'Synthetic_L2Relative_AK4PFchs.txt' )
+        with open( txtfile, 'w' ) as f:
+            f.write( synthetic_txt )
+        parameters = native_jec.JetCorrectorParameters( txtfile )
+        eta = np.array( [ -1.,   -1.,  1.,  1.,  7. ] )
+        pt  = np.array( [ 16.,  400., 30.,  5., 30. ] )
+        # hand computed: sqrt(16)*2+log10(16), clipped to pt=100: sqrt(100)*2+2, 30, clipped to pt=10: 10, outside: default
+        reference = np.array( [ 8.+np.log10(16.), 22., 30., 10., 1. ] )
+        assert np.allclose( parameters.evaluate( [ eta ], [ pt ] ), reference )
+        assert list( parameters.binIndex( eta ) ) == [ 0, 0, 1, 1, -1 ]
+    finally:
+        shutil.rmtree( directory )
+
+def writeTable( directory, definition, records ):
+    txtfile = os.path.join( directory, 'Synthetic_AK4PFchs.txt' )
+    with open( txtfile, 'w' ) as f:
+        f.write( "{%s}\n" % definition )
+        for r in records:
+            f.write( " ".join( map( str, r ) ) + "\n" )
+    return txtfile
+
+def test_binIndex_grid():
+    # ( JetEta, Rho ) binning as in the JER resolution files, with a gap in eta and different rho bins per eta bin
+    records = []
+    for eta_bin, rho_thresholds in [ ( (-5., -2.5), [0, 10, 20, 40] ), ( (-2.5, 0.), [0, 5, 40] ), ( (0., 2.5), [5, 15, 25] ), ( (3., 5.), [0, 40] ) ]:
+        for rho_bin in zip( rho_thresholds[:-1], rho_thresholds[1:] ):
+            records.append( [ eta_bin[0], eta_bin[1], rho_bin[0], rho_bin[1], 3, 10, 100, len( records ) ] )
+    # irregular: overlapping eta bins, the first matching record is used
+    irregular = records + [ [ -1., 1., 0, 40, 3, 10, 100, 99 ] ]
+
+    eta = np.concatenate( [ np.random.uniform( -6, 6, 5000 ), [ -5., -2.5, 0., 2.5, 3., 5., float('nan') ] ] )
+    rho = np.concatenate( [ np.random.uniform( -5, 45, 5000 ), [ 0., 10., 5., 15., 40., 25., 10. ] ] )
+
+    directory = tempfile.mkdtemp()
+    try:
+        for table in [ records, irregular ]:
+            parameters = native_jec.JetCorrectorParameters( writeTable( directory, "2 JetEta Rho 1 JetPt [0] Resolution", table ) )
+            # first matching record
+            reference = np.full( len( eta ), -1 )
+            for i_record, r in reversed( list( enumerate( table ) ) ):
+                reference[ ( eta >= r[0] ) & ( eta < r[1] ) & ( rho >= r[2] ) & ( rho < r[3] ) ] = i_record
+            assert ( parameters.binIndex( eta, rho ) == reference ).all()
+    finally:
+        shutil.rmtree( directory )
+
+def test_cache_bin_edge():
+    # eta bin edge at 1.305 with a 10% step in the correction
+    from JetMET.JetCorrector.JetCorrector import JetCorrector
+    directory = tempfile.mkdtemp()
+    compile_directory = native_jec.JetCorrectorParameters.compile_directory
+    try:
+        native_jec.JetCorrectorParameters.compile_directory = os.path.join( directory, 'compiled' )
+        txtfile = os.path.join( directory, 'Synthetic_L2Relative_AK4PFchs.txt' )
+        with open( txtfile, 'w' ) as f:
+            f.write( "{1 JetEta 1 JetPt [0] Correction L2Relative}\n-5.0 1.305 3 10 100 1.0\n1.305 5.0 3 10 100 1.1\n" )
+        cached   = JetCorrector( [ ( 1, [ txtfile ] ) ], native = True, cache_size = 100, cache_tolerance = 1e-3 )
+        uncached = JetCorrector( [ ( 1, [ txtfile ] ) ], native = True )
+        # same quantization cell, different records
+        for eta in [ 1.3049, 1.3051, 1.3049, 1.3051 ]:
+            assert cached.correction( 30., eta, 0.5, 10., 1 ) == uncached.correction( 30., eta, 0.5, 10., 1 )
+            assert cached.subCorrections( 30., eta, 0.5, 10., 1 ) == uncached.subCorrections( 30., eta, 0.5, 10., 1 )
+        assert cached.cache_hits == 4 and cached.cache_misses == 4
+    finally:
+        native_jec.JetCorrectorParameters.compile_directory = compile_directory
+        shutil.rmtree( directory )
+
+def referenceInputs():
+    rawPt, eta, rho = np.meshgrid( [ 12., 30., 75., 250., 1500. ], [ -4.9, -3.1, -2.6, -1.4, -0.3, 0., 0.8, 1.7, 2.9, 4.2 ], [ 3., 18., 42. ] )
+    rawPt, eta, rho = rawPt.flatten(), eta.flatten(), rho.flatten()
+    return { 'rawPt':rawPt, 'eta':eta, 'area':0.49*np.ones( len(rawPt) ), 'rho':rho }
+
+def tableExcerpt( txtfile, inputs ):
+    ''' Definition and the records of a txt file that are used for the inputs
+    '''
+    parameters = native_jec.JetCorrectorParameters( txtfile )
+    values     = { 'JetEta':inputs['eta'], 'JetA':inputs['area'], 'Rho':inputs['rho'], 'JetPt':inputs['rawPt'] }
+    used       = set( parameters.binIndex( *[ values[var] for var in parameters.binVars ] ) ) - set( [ -1 ] )
+    with open( os.path.expandvars( txtfile ) ) as f:
+        lines = [ l.strip() for l in f.readlines() ]
+    lines = [ l for l in lines if l and not l.startswith('#') ]
+    return "\n".join( [ lines[0] ] + [ lines[1+i_record] for i_record in sorted( used ) ] ) + "\n"
+
+def makeReference( logger, name, levels ):
+    ''' Evaluate the CMSSW FactorizedJetCorrector of one IOV and store the values with the used records of the txt files
+    '''
+    from JetMET.JetCorrector.JetCorrector import JetCorrector
+    cmssw  = JetCorrector.fromTarBalls( [ ( 1, name ) ], correctionLevels = levels, L1RC = True, jetflavour = reference_jetflavour )
+    inputs = referenceInputs()
+    run    = np.ones( len( inputs['rawPt'] ), dtype = 'int64' )
+    result = [ cmssw.subCorrections( inputs['rawPt'][i], inputs['eta'][i], inputs['area'][i], inputs['rho'][i], run[i] ) for i in xrange( len(run) ) ]
+
+    txtfiles = cmssw.iovs[0][1] + cmssw.iovs_RC[0][1]
+    reference = {
+        'iov':         name,
+        'jetflavour':  reference_jetflavour,
+        'levels':      cmssw.levels,
+        'inputs':      { key:list( value ) for key, value in inputs.iteritems() },
+        'tables':      { os.path.basename( txtfile ).split('_')[-2]:tableExcerpt( txtfile, inputs ) for txtfile in txtfiles },
+        'reference':   { level:[ r[level] for r in result ] for level in cmssw.levels + [ 'L1RC' ] },
+    }
+    if not os.path.exists( reference_directory ):
+        os.makedirs( reference_directory )
+    filename = os.path.join( reference_directory, name+'.json' )
+    with open( filename, 'w' ) as f:
+        json.dump( reference, f, indent = 1, sort_keys = True )
+    logger.info( "Written %s with %i jets", filename, len( run ) )
+
+def referenceFiles():
+    if not os.path.exists( reference_directory ): return []
+    return sorted( os.path.join( reference_directory, f ) for f in os.listdir( reference_directory ) if f.endswith( '.json' ) )
+
+def checkReference( filename ):
+    ''' Native evaluation of the stored records vs. the stored CMSSW values. Returns the maximum relative deviation.
+    '''
+    from JetMET.JetCorrector.JetCorrector import JetCorrector
+    with open( filename ) as f:
+        reference = json.load( f )
+    directory = tempfile.mkdtemp()
+    compile_directory = native_jec.JetCorrectorParameters.compile_directory
+    try:
+        native_jec.JetCorrectorParameters.compile_directory = os.path.join( directory, 'compiled' )
+        txtfiles = {}
+        for level, table in reference['tables'].iteritems():
+            txtfiles[level] = os.path.join( directory, '%s_%s_%s.txt' % ( reference['iov'], level, reference['jetflavour'] ) )
+            with open( txtfiles[level], 'w' ) as f:
+                f.write( table )
+        native = JetCorrector( [ ( 1, [ txtfiles[level] for level in reference['levels'] ] ) ], native = True, iovs_RC = [ ( 1, [ txtfiles['L1RC'] ] ) ] )
+        inputs = { key:np.array( value ) for key, value in reference['inputs'].iteritems() }
+        result = native.subCorrections_batch( inputs['rawPt'], inputs['eta'], inputs['area'], inputs['rho'], 1 )
+    finally:
+        native_jec.JetCorrectorParameters.compile_directory = compile_directory
+        shutil.rmtree( directory )
+    return max( np.max( np.abs( result[level] - np.array( values ) )/np.array( values ) ) for level, values in reference['reference'].iteritems() )
+
+def test_reference():
+    files = referenceFiles()
+    if not files:
+        print "No reference files in %s. Make them with --makeReference in a CMSSW area." % os.path.abspath( reference_directory )
+    for filename in files:
+        max_deviation = checkReference( filename )
+        assert max_deviation <= tolerance, ( filename, max_deviation )
+
+def compareToCMSSW( logger ):
+    ''' Returns the number of corrector sets that deviate by more than the tolerance
+    '''
+    from JetMET.JetCorrector.JetCorrector import JetCorrector
+
+    # Grid of reference values
+    rawPt, eta, rho, run = np.meshgrid( [8, 15, 30, 60, 120, 500, 2000, 7000], np.linspace(-5.3, 5.3, 107), [0, 5, 20, 40, 80], [1, 276831, 278802, 280919] )
+    rawPt, eta, rho, run = rawPt.flatten(), eta.flatten(), rho.flatten(), run.flatten()
+    area = 0.5*np.ones( len(rawPt) )
+
+    failed = 0
+    for name, iovs, levels in [
+            ( 'data',    Summer16_03Feb2017_DATA, correction_levels_data ),
+            ( 'mc',      Summer16_03Feb2017_MC,   correction_levels_mc ),
+            ( 'L1RC_data', Summer16_03Feb2017_DATA, [ 'L1RC' ] ),
+        ]:
+        cmssw  = JetCorrector.fromTarBalls( iovs, correctionLevels = levels )
+        native = JetCorrector.fromTarBalls( iovs, correctionLevels = levels, native = True )
+
+        reference = np.array( [ cmssw.correction( rawPt[i], eta[i], area[i], rho[i], run[i] ) for i in xrange( len(rawPt) ) ] )
+        result    = native.correction_batch( rawPt, eta, area, rho, run )
+
+        max_deviation = np.max( np.abs( result - reference )/reference )
+        logger.info( "%s: %i jets, maximum relative deviation native vs. CMSSW: %3.2e", name, len(rawPt), max_deviation )
+        if not max_deviation <= tolerance:
+            i_max = np.argmax( np.abs( result - reference )/reference )
+            logger.error( "Largest deviation for rawPt %3.2f eta %3.2f rho %3.2f run %i: native %f CMSSW %f",
+                rawPt[i_max], eta[i_max], rho[i_max], run[i_max], result[i_max], reference[i_max] )
+            failed += 1
+    return failed
+
+if __name__ == "__main__":
+    # Logging
+    import JetMET.tools.logger as logger
+    logger  = logger.get_logger('INFO', logFile = None)
+
+    test_compileFormula()
+    test_evaluate()
+    test_binIndex_grid()
+    test_cache_bin_edge()
+    logger.info( "Self contained checks passed." )
+
+    if '--makeReference' in sys.argv:
+        for name, levels in reference_iovs:
+            makeReference( logger, name, levels )
+
+    for filename in referenceFiles():
+        logger.info( "%s: maximum relative deviation native vs. CMSSW reference: %3.2e", os.path.basename( filename ), checkReference( filename ) )
+    test_reference()
+    if referenceFiles(): logger.info( "Reference checks passed." )
+
+    if '--cmssw' in sys.argv:
+        failed = compareToCMSSW( logger )
+        if failed > 0:
+            logger.error( "%i corrector set(s) deviate by more than %3.2e.", failed, tolerance )
+            sys.exit( 1 )
@@ -14,6 +14,3 @@ if __name__ == "__main__":
     logger.info( "Resolution '%r' -> '%r'" , args, smearer_mc.get_jet_resolution(*args) )
     args = (50, 2.5, 0 )
     logger.info( "Resolution '%r' -> '%r'" , args, smearer_mc.get_jet_resolution(*args) )
-
-    # Segfault otherwise (no, destructor doesn't work)
-    smearer_mc.delete()
@@ -0,0 +1,125 @@
+''' Many TProfiles from one event loop. The profiles are declared by their axes:
+    observables x cuts x categories (possibly overlapping bins, e.g. |eta| bins) x thresholds of the profiled variable.
+    Per event the bin indices are computed once and the sums are incremented in arrays,
+    instead of calling one weight function per profile.
+'''
+# Standard imports
+import ROOT
+import array
+import bisect
+import uuid
+import numpy as np
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+class IntervalIndex:
+    ''' Lookup of all (possibly overlapping) half-open intervals [low, high) that contain a value, by bisection
+    '''
+    def __init__( self, intervals ):
+        self.intervals = list( intervals )
+        self.edges     = sorted( set( [ i[0] for i in self.intervals ] + [ i[1] for i in self.intervals ] ) )
+        # indices of the intervals covering each elementary interval [edges[k], edges[k+1])
+        self.covering  = [ [ i for i, ( low, high ) in enumerate( self.intervals ) if low <= self.edges[k] and self.edges[k+1] <= high ]
+                           for k in range( len( self.edges ) - 1 ) ]
+
+    def find( self, value ):
+        k = bisect.bisect_right( self.edges, value ) - 1
+        if k < 0 or k >= len( self.covering ): return []
+        return self.covering[k]
+
+class BinnedProfiles:
+
+    def __init__( self, observables, cuts, categories, thresholds ):
+        ''' observables: names of the profiled quantities (e.g. responses),
+            cuts:        names of the event flags (e.g. alpha cuts),
+            categories:  list of (low, high) bins of the category variable (e.g. |eta| of the leading jet),
+            thresholds:  bin thresholds of the x variable of the profiles (e.g. ptll).
+        '''
+        self.observables = list( observables )
+        self.cuts        = list( cuts )
+        self.categories  = list( categories )
+        self.thresholds  = list( thresholds )
+        self.index       = IntervalIndex( self.categories )
+        self.shape       = ( len( self.observables ), len( self.cuts ), len( self.categories ), len( self.thresholds ) + 1 )
+        # sample name -> arrays of sum w, sum w*y, sum w*y^2, sum w^2 and the number of entries
+        self.sums        = {}
+
+    def _arrays( self, sample_name ):
+        if sample_name not in self.sums:
+            self.sums[sample_name] = { key: np.zeros( self.shape ) for key in [ 'w', 'wy', 'wy2', 'w2', 'n' ] }
+        return self.sums[sample_name]
+
+    def fill( self, sample_name, x, values, passed, category_value, weight = 1 ):
+        ''' values: one value per observable (None or non-finite values are not filled),
+            passed: one boolean per cut. The x bin includes under- (0) and overflow (len(thresholds)).
+        '''
+        categories = self.index.find( category_value )
+        if not categories or not weight: return
+        cuts = [ i for i, p in enumerate( passed ) if p ]
+        if not cuts: return
+        obs  = [ i for i, v in enumerate( values ) if v is not None and np.isfinite( v ) ]
+        if not obs: return
+
+        i_x  = bisect.bisect_right( self.thresholds, x )
+        y    = np.array( [ values[i] for i in obs ] )[:, np.newaxis, np.newaxis, np.newaxis]
+        idx  = np.ix_( obs, cuts, categories, [ i_x ] )
+
+        a = self._arrays( sample_name )
+        a['w'][idx]   += weight
+        a['wy'][idx]  += weight*y
+        a['wy2'][idx] += weight*y**2
+        a['w2'][idx]  += weight**2
+        a['n'][idx]   += 1
+
+    def fill_batch( self, sample_name, x, values, passed, category_value, weight = None ):
+        ''' Vectorized fill for arrays of events: values has shape (observables, events) with NaN for missing values,
+            passed has shape (cuts, events). Same result as fill for every event.
+        '''
+        x              = np.asarray( x, dtype = 'float64' )
+        values         = np.asarray( values, dtype = 'float64' )
+        passed         = np.asarray( passed, dtype = 'bool' )
+        category_value = np.asarray( category_value, dtype = 'float64' )
+        weight         = np.ones( len( x ) ) if weight is None else np.asarray( weight, dtype = 'float64' )
+
+        i_x    = np.searchsorted( self.thresholds, x, side = 'right' )
+        finite = np.isfinite( values ) & ( weight != 0 )
+        n_x    = len( self.thresholds ) + 1
+
+        a = self._arrays( sample_name )
+        for i_category, ( low, high ) in enumerate( self.categories ):
+            in_category = ( category_value >= low ) & ( category_value < high )
+            for i_cut in range( len( self.cuts ) ):
+                selected = in_category & passed[i_cut]
+                for i_obs in range( len( self.observables ) ):
+                    mask = selected & finite[i_obs]
+                    if not mask.any(): continue
+                    i, w, y = i_x[mask], weight[mask], values[i_obs][mask]
+                    a['w'][i_obs, i_cut, i_category]   += np.bincount( i, weights = w,      minlength = n_x )
+                    a['wy'][i_obs, i_cut, i_category]  += np.bincount( i, weights = w*y,    minlength = n_x )
+                    a['wy2'][i_obs, i_cut, i_category] += np.bincount( i, weights = w*y**2, minlength = n_x )
+                    a['w2'][i_obs, i_cut, i_category]  += np.bincount( i, weights = w**2,   minlength = n_x )
+                    a['n'][i_obs, i_cut, i_category]   += np.bincount( i, minlength = n_x )
+
+    def profile( self, sample_name, observable, cut, category, name = None, texX = None, texY = None ):
+        ''' TProfile vs. the x thresholds for one observable, cut and category, with optional axis titles
+        '''
+        name = name if name is not None else str( uuid.uuid1() )
+        p = ROOT.TProfile( name, name, len( self.thresholds ) - 1, array.array( 'd', self.thresholds ) )
+        p.Sumw2()
+        if texX is not None: p.GetXaxis().SetTitle( texX )
+        if texY is not None: p.GetYaxis().SetTitle( texY )
+        if sample_name not in self.sums: return p
+
+        i = ( self.observables.index( observable ), self.cuts.index( cut ), self.categories.index( category ) )
+        a = self.sums[sample_name]
+        sumw2, binSumw2 = p.GetSumw2(), p.GetBinSumw2()
+        for i_bin in range( len( self.thresholds ) + 1 ):
+            # TProfile stores sum w*y in the bin content, sum w*y^2 in Sumw2, sum w in the bin entries, sum w^2 in BinSumw2
+            p.SetBinEntries( i_bin, a['w'][i][i_bin] )
+            p.SetBinContent( i_bin, a['wy'][i][i_bin] )
+            sumw2.SetAt( a['wy2'][i][i_bin], i_bin )
+            binSumw2.SetAt( a['w2'][i][i_bin], i_bin )
+        p.SetEntries( a['n'][i].sum() )
+        return p
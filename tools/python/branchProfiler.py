@@ -0,0 +1,121 @@
+''' Branch level I/O profile of a TChain: bytes read, time spent in TBranch::GetEntry (incl. decompression)
+    and number of baskets loaded (cache misses) per branch. Compares with the branches a script actually uses
+    and suggests a minimal list of branches to read or keep.
+'''
+# Standard imports
+import ROOT
+import os
+import time
+import fnmatch
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+def formulaBranches( tree, expressions ):
+    ''' Branches used in TTreeFormula expressions (selection strings, Draw strings, weights), including leaf counters
+    '''
+    branches = set()
+    for i_expr, expression in enumerate( expressions ):
+        # Draw strings may contain several ':' separated expressions and a '>>histo' target
+        for expr in expression.split('>>')[0].split(':'):
+            if expr.strip() == '': continue
+            formula = ROOT.TTreeFormula( "branchProfiler_%i" % i_expr, expr, tree )
+            for i_code in range( formula.GetNcodes() ):
+                leaf = formula.GetLeaf( i_code )
+                if not leaf: continue
+                branches.add( leaf.GetBranch().GetName() )
+                if leaf.GetLeafCount():
+                    branches.add( leaf.GetLeafCount().GetBranch().GetName() )
+            formula.Delete()
+    return branches
+
+def variableBranches( variables ):
+    ''' Branches of RootTools TreeVariables or of variable strings like 'rho/F' or 'Jet[pt/F,eta/F]'
+    '''
+    branches = set()
+    for variable in variables:
+        if not isinstance( variable, str ):
+            variable = variable.name + ( '[%s]' % ','.join( c.name for c in variable.components ) if hasattr( variable, 'components' ) else '' )
+        if '[' in variable:
+            name, components = variable.rstrip(']').split('[')
+            branches.add( 'n'+name )
+            branches.update( name + '_' + c.split('/')[0] for c in components.split(',') )
+        else:
+            branches.add( variable.split('/')[0] )
+    return branches
+
+def expandPatterns( tree, patterns ):
+    ''' Branches matching wildcard keep strings such as 'HLT_*'
+    '''
+    names = [ b.GetName() for b in tree.GetListOfBranches() ]
+    return sorted( set( n for n in names for p in patterns if fnmatch.fnmatchcase( n, p ) ) )
+
+class BranchProfiler:
+
+    def __init__( self, chain, maxEvents = 10000 ):
+        self.chain     = chain
+        self.maxEvents = maxEvents
+
+    def profile( self, branches ):
+        ''' Read each branch for the first maxEvents entries. Returns a dictionary branch -> statistics.
+        '''
+        stats = { name:{'bytes':0, 'zipBytes':0, 'time':0., 'baskets':0} for name in branches }
+        nEntries = self.chain.GetEntries() if self.maxEvents < 0 else min( self.maxEvents, self.chain.GetEntries() )
+
+        i_tree = -1
+        for entry in xrange( nEntries ):
+            local_entry = self.chain.LoadTree( entry )
+            if self.chain.GetTreeNumber() != i_tree:
+                i_tree   = self.chain.GetTreeNumber()
+                tree     = self.chain.GetTree()
+                tbranches = [ ( name, tree.GetBranch( name ) ) for name in branches ]
+                baskets  = { name:-1 for name in branches }
+            for name, branch in tbranches:
+                if not branch: continue
+                t0 = time.time()
+                nbytes = branch.GetEntry( local_entry )
+                stats[name]['time']  += time.time() - t0
+                stats[name]['bytes'] += max( nbytes, 0 )
+                basket = branch.GetReadBasket()
+                if basket != baskets[name]:
+                    baskets[name] = basket
+                    stats[name]['baskets']  += 1
+                    stats[name]['zipBytes'] += branch.GetBasketBytes()[basket] if branch.GetBasketBytes() else 0
+
+        self.nEntries = nEntries
+        return stats
+
+    def report( self, filename, stats, used = None ):
+        ''' Write the profile sorted by time. Branches in 'used' are the ones the script needs.
+            Returns the suggested minimal branch list.
+        '''
+        used = set( used ) if used is not None else set( stats.keys() )
+        total_time  = sum( s['time'] for s in stats.values() )
+        unused_time = sum( s['time'] for name, s in stats.iteritems() if name not in used )
+
+        if not os.path.exists( os.path.dirname( os.path.abspath( filename ) ) ):
+            os.makedirs( os.path.dirname( os.path.abspath( filename ) ) )
+        with open( filename, 'w' ) as f:
+            f.write( "# I/O profile of %i entries, %i branches, %i used\n" % ( self.nEntries, len(stats), len( used & set( stats.keys() ) ) ) )
+            f.write( "# total read time %6.3f s, %4.1f%% in unused branches\n" % ( total_time, 100.*unused_time/total_time if total_time>0 else 0. ) )
+            f.write( "# %-40s %4s %12s %12s %10s %8s\n" % ( "branch", "used", "bytes", "zipBytes", "time[ms]", "baskets" ) )
+            for name, s in sorted( stats.iteritems(), key = lambda p: -p[1]['time'] ):
+                f.write( "  %-40s %4s %12i %12i %10.2f %8i\n" % ( name, 'yes' if name in used else 'no', s['bytes'], s['zipBytes'], 1000*s['time'], s['baskets'] ) )
+            suggested = sorted( used & set( stats.keys() ) )
+            f.write( "# suggested branch list:\n" )
+            f.write( "%r\n" % suggested )
+
+        logger.info( "Written I/O profile to %s. %4.1f%% of the read time is spent in %i unused branches.",
+            filename, 100.*unused_time/total_time if total_time>0 else 0., len( set( stats.keys() ) - used ) )
+        return suggested
+
+def profileChain( chain, filename, patterns = ['*'], used_variables = [], used_expressions = [], maxEvents = 10000 ):
+    ''' Profile all branches matching 'patterns' and report against the branches of the used variables and expressions.
+    '''
+    chain.GetEntry( 0 )
+    tree = chain.GetTree()
+    used = variableBranches( used_variables ) | formulaBranches( tree, used_expressions )
+    profiler = BranchProfiler( chain, maxEvents = maxEvents )
+    stats = profiler.profile( expandPatterns( tree, patterns ) )
+    return profiler.report( filename, stats, used = used )
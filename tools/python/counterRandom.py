@@ -0,0 +1,48 @@
+''' Counter-based random numbers: the random number is a hash of its counters (e.g. run, lumi, event, jet index)
+    instead of the state of a global generator. Results do not depend on the event order or on the job splitting.
+    All functions take scalars or arrays (broadcasted) and return arrays.
+'''
+# Standard imports
+import numpy as np
+
+# splitmix64 constants
+_golden = np.uint64(0x9E3779B97F4A7C15)
+_mult1  = np.uint64(0xBF58476D1CE4E5B9)
+_mult2  = np.uint64(0x94D049BB133111EB)
+
+def splitmix64( x ):
+    ''' splitmix64 finalizer on uint64 arrays (arithmetic modulo 2^64)
+    '''
+    with np.errstate( over = 'ignore' ):
+        z = x + _golden
+        z = ( z ^ ( z >> np.uint64(30) ) ) * _mult1
+        z = ( z ^ ( z >> np.uint64(27) ) ) * _mult2
+        return z ^ ( z >> np.uint64(31) )
+
+def hash_counters( *counters, **kwargs ):
+    ''' Combine the counters into one uint64 hash. 'seed' distinguishes independent streams.
+    '''
+    seed = kwargs.get( 'seed', 0 )
+    counters = np.broadcast_arrays( *[ np.atleast_1d( np.asarray( c ) ).astype( 'int64' ).view( 'uint64' ) for c in counters ] )
+    h = splitmix64( np.full( counters[0].shape, seed, dtype = 'uint64' ) )
+    for c in counters:
+        h = splitmix64( h ^ c )
+    return h
+
+def _to_unit( h ):
+    ''' uint64 -> float in (0,1], using the upper 53 bits
+    '''
+    return ( ( h >> np.uint64(11) ).astype( 'float64' ) + 1. ) * 2.**-53
+
+def uniform( *counters, **kwargs ):
+    ''' Uniform random numbers in (0,1]
+    '''
+    return _to_unit( hash_counters( *counters, **kwargs ) )
+
+def gauss( *counters, **kwargs ):
+    ''' Standard normal random numbers (Box-Muller)
+    '''
+    h  = hash_counters( *counters, **kwargs )
+    u1 = _to_unit( h )
+    u2 = _to_unit( splitmix64( h ) )
+    return np.sqrt( -2.*np.log( u1 ) )*np.cos( 2*np.pi*u2 )
@@ -0,0 +1,52 @@
+''' NumPy views of ROOT histograms: bin contents and sum of squared weights as arrays,
+    bin lookup and vectorized moments with the conventions of TH1::GetMean, GetRMS and GetMeanError.
+'''
+# Standard imports
+import numpy as np
+
+def _toArray( buf, n ):
+    buf.SetSize( n )
+    return np.array( buf, dtype = 'float64' )
+
+def th3ToArrays( h ):
+    ''' content and sum of squared weights of a TH3 as arrays indexed [x, y, z] including under- and overflow bins
+        (index 0 is the underflow, as in ROOT). Without Sumw2 the squared weights are the contents.
+    '''
+    shape = ( h.GetNbinsZ() + 2, h.GetNbinsY() + 2, h.GetNbinsX() + 2 )
+    n     = shape[0]*shape[1]*shape[2]
+    # global bin = x + (nx+2)*( y + (ny+2)*z )
+    content = _toArray( h.GetArray(), n ).reshape( shape ).transpose( 2, 1, 0 )
+    if h.GetSumw2N() > 0:
+        sumw2 = _toArray( h.GetSumw2().GetArray(), n ).reshape( shape ).transpose( 2, 1, 0 )
+    else:
+        sumw2 = content.copy()
+    return content, sumw2
+
+def axisEdges( axis ):
+    ''' Bin edges of a TAxis as an array
+    '''
+    return np.array( [ axis.GetBinLowEdge( i ) for i in range( 1, axis.GetNbins() + 2 ) ] )
+
+def findBins( edges, values ):
+    ''' Vectorized TAxis::FindBin: 0 is the underflow, len(edges) the overflow
+    '''
+    return np.searchsorted( edges, values, side = 'right' )
+
+def moments( content, sumw2, centers ):
+    ''' Mean, RMS and error of the mean along the first axis of content, e.g. for all x-projections of a TH3 at once.
+        content and sumw2 must not contain the x under- and overflow (like TH1::GetMean). Empty cells give 0.
+    '''
+    centers = np.asarray( centers, dtype = 'float64' ).reshape( (-1,) + (1,)*( content.ndim - 1 ) )
+    sumw    = content.sum( axis = 0 )
+    sumw2_  = sumw2.sum( axis = 0 )
+    sumwx   = ( content*centers ).sum( axis = 0 )
+    sumwx2  = ( content*centers**2 ).sum( axis = 0 )
+
+    filled  = sumw != 0
+    safe    = np.where( filled, sumw, 1. )
+    mean    = np.where( filled, sumwx/safe, 0. )
+    rms     = np.where( filled, np.sqrt( np.maximum( sumwx2/safe - mean**2, 0. ) ), 0. )
+    # effective entries (sum w)^2/(sum w^2)
+    neff    = np.where( sumw2_ > 0, sumw**2/np.where( sumw2_ > 0, sumw2_, 1. ), 0. )
+    error   = np.where( neff > 0, rms/np.sqrt( np.where( neff > 0, neff, 1. ) ), 0. )
+    return mean, rms, error
@@ -0,0 +1,112 @@
+''' Book many TH1/TH2/TH3 with Draw-style expressions, weights and selections and fill all of them
+    in a single pass over the chain instead of one TTree::Draw per histogram.
+'''
+# Standard imports
+import ROOT
+import os
+import uuid
+import fcntl
+import tempfile
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+# ACLiC writes the library to a per-user build directory: the CMSSW area may be read-only and jobs of other users 
+# don't touch it. $JETMET_ACLIC_BUILD_DIR overrides it.
+build_directory = os.environ.get( 'JETMET_ACLIC_BUILD_DIR' ) or os.path.join( tempfile.gettempdir(), 'JetMET_aclic_%i' % os.getuid() )
+
+def loadMacro( macro, build_directory = build_directory ):
+    ''' Compile and load a macro with ACLiC. Jobs sharing the build directory build one after the other (file lock),
+        such that no job loads a library that is being written.
+    '''
+    if not os.path.exists( build_directory ):
+        try:
+            os.makedirs( build_directory )
+        except OSError: # race condition with other jobs
+            pass
+    ROOT.gSystem.SetBuildDir( build_directory )
+    with open( os.path.join( build_directory, '.lock' ), 'w' ) as lock:
+        fcntl.flock( lock, fcntl.LOCK_EX )
+        try:
+            result = ROOT.gROOT.LoadMacro( macro )
+        finally:
+            fcntl.flock( lock, fcntl.LOCK_UN )
+    if result != 0:
+        raise RuntimeError( "Could not compile and load %s (LoadMacro returned %i, build directory %s)." % ( macro, result, build_directory ) )
+
+loadMacro( "$CMSSW_BASE/src/JetMET/tools/scripts/HistoFiller.C+" )
+if not hasattr( ROOT, 'fillHistos' ):
+    raise RuntimeError( "fillHistos not found after loading HistoFiller.C (build directory %s)." % build_directory )
+
+def makeHisto( binning, name = None ):
+    ''' TH1D, TH2D or TH3D with equidistant binning [nx, x_low, x_high(, ny, y_low, y_high(, nz, z_low, z_high))]
+    '''
+    name = name if name is not None else str( uuid.uuid4() ).replace('-','_')
+    if len( binning ) == 3:
+        h = ROOT.TH1D( name, name, *binning )
+    elif len( binning ) == 6:
+        h = ROOT.TH2D( name, name, *binning )
+    elif len( binning ) == 9:
+        h = ROOT.TH3D( name, name, *binning )
+    else:
+        raise ValueError( "Don't know what to do with binning %r" % ( binning, ) )
+    h.Sumw2()
+    return h
+
+def sampleWeightString( sample, weightString = "1", selectionString = None ):
+    ''' Weight expression with the selection string and the sample weight of a RootTools Sample
+    '''
+    selection = "("+sample.selectionString+")" if sample.selectionString else None
+    if selectionString is not None:
+        selection = "(%s)&&(%s)" % ( selection, selectionString ) if selection is not None else selectionString
+    weight = sample.combineWithSampleWeight( weightString )
+    return "(%s)*(%s)" % ( selection, weight ) if selection is not None else weight
+
+class HistoFiller:
+
+    def __init__( self, chain ):
+        self.chain    = chain
+        self.histos   = []
+        self.varexps  = []
+        self.weights  = []
+
+    def book( self, histo, varexp, weightString = "1", selectionString = None ):
+        ''' Book a histogram. varexp follows TTree::Draw ('x', 'y:x' or 'z:y:x'), the selection is multiplied to the weight.
+            Returns the histogram which is filled when fill() is called.
+        '''
+        if histo.GetSumw2N() == 0: histo.Sumw2()
+        weight = "(%s)*(%s)" % ( selectionString, weightString ) if selectionString is not None else weightString
+        self.histos.append( histo )
+        self.varexps.append( varexp )
+        self.weights.append( weight )
+        logger.debug( "Booked %s with '%s' and weight '%s'", histo.GetName(), varexp, weight )
+        return histo
+
+    def bookSample( self, sample, histo, varexp, weightString = "1", selectionString = None ):
+        ''' Book with the selection string and the sample weight of a RootTools Sample, as in sample.get1DHistoFromDraw.
+        '''
+        return self.book( histo, varexp, weightString = sampleWeightString( sample, weightString, selectionString ) )
+
+    def expressions( self ):
+        ''' All booked expressions, e.g. for the I/O profile
+        '''
+        return self.varexps + self.weights
+
+    def fill( self, maxEntries = -1 ):
+        ''' Read the chain once and fill all booked histograms.
+        '''
+        if len( self.histos ) == 0: return 0
+        histos  = ROOT.std.vector('TH1*')()
+        varexps = ROOT.std.vector('string')()
+        weights = ROOT.std.vector('string')()
+        for h, v, w in zip( self.histos, self.varexps, self.weights ):
+            histos.push_back( h )
+            varexps.push_back( v )
+            weights.push_back( w )
+        logger.info( "Filling %i histograms in one pass over %s", len( self.histos ), self.chain.GetName() )
+        nRead = ROOT.fillHistos( self.chain, histos, varexps, weights, maxEntries )
+        if nRead < 0:
+            raise RuntimeError( "Could not fill histograms. Check the booked expressions." )
+        logger.info( "Read %i entries.", nRead )
+        return nRead
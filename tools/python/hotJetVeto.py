@@ -4,6 +4,7 @@
 import ROOT
 import os
 from math import pi
+import numpy as np
 
 # helpers
 from JetMET.tools.helpers import getObjFromFile
@@ -23,3 +24,19 @@ class hotJetVeto:
         if abs(eta)>5.2 or abs(phi)>pi: return True
 
         return self.hotmap.GetBinContent( self.hotmap.FindBin( eta, phi ) ) < self.threshold 
+
+    def __makeArrays( self ):
+        ''' Bin edges and contents ( including under/overflow ) of the hot jet map for the vectorized lookup
+        '''
+        axes = [ self.hotmap.GetXaxis(), self.hotmap.GetYaxis() ]
+        self.__edges   = [ np.array( [ a.GetBinLowEdge( i ) for i in range( 1, a.GetNbins()+2 ) ] ) for a in axes ]
+        self.__content = np.array( [ [ self.hotmap.GetBinContent( ix, iy ) for iy in range( axes[1].GetNbins()+2 ) ] for ix in range( axes[0].GetNbins()+2 ) ] )
+
+    def passVeto_batch( self, eta, phi ):
+        ''' Vectorized passVeto, same bin convention as TH2::FindBin
+        '''
+        if not hasattr( self, '_hotJetVeto__content' ): self.__makeArrays()
+        eta, phi = np.broadcast_arrays( np.asarray( eta, dtype = 'float64' ), np.asarray( phi, dtype = 'float64' ) )
+        ix = np.searchsorted( self.__edges[0], eta, side = 'right' )
+        iy = np.searchsorted( self.__edges[1], phi, side = 'right' )
+        return ( np.abs( eta )>5.2 ) | ( np.abs( phi )>pi ) | ( self.__content[ix, iy] < self.threshold )
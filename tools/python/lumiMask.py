@@ -0,0 +1,105 @@
+''' Compact golden JSON index: per run sorted arrays of lumi section intervals.
+    Scalar lookup with bisect, vectorized lookup with searchsorted. Drop-in for LumiList.contains.
+'''
+# Standard imports
+import os
+import json
+import bisect
+import numpy as np
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+class LumiMask:
+
+    def __init__( self, filename = None, runsAndLumis = None ):
+        ''' Load the golden json file or take a dictionary { run: [ [first, last], ... ] }
+        '''
+        if filename is not None:
+            with open( os.path.expandvars( filename ) ) as f:
+                runsAndLumis = json.load( f )
+        elif runsAndLumis is None:
+            runsAndLumis = {}
+
+        # run -> ( first lumis, last lumis ) of the merged, sorted intervals
+        self.intervals = {}
+        for run, ranges in runsAndLumis.iteritems():
+            merged = []
+            for first, last in sorted( ranges ):
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1][1] = max( merged[-1][1], last )
+                else:
+                    merged.append( [ first, last ] )
+            self.intervals[int(run)] = ( [ m[0] for m in merged ], [ m[1] for m in merged ] )
+
+        # Array version for the vectorized lookup
+        self.__arrays = { run: ( np.array( first ), np.array( last ) ) for run, ( first, last ) in self.intervals.iteritems() }
+
+        logger.debug( "Loaded lumi mask with %i runs and %i intervals.", len(self.intervals), sum( len( i[0] ) for i in self.intervals.values() ) )
+
+    def contains( self, run, lumi ):
+        try:
+            first, last = self.intervals[run]
+        except KeyError:
+            return False
+        i = bisect.bisect_right( first, lumi ) - 1
+        return i >= 0 and lumi <= last[i]
+
+    def contains_batch( self, runs, lumis ):
+        ''' Boolean array for arrays of runs and lumis
+        '''
+        runs, lumis = np.broadcast_arrays( np.asarray( runs ), np.asarray( lumis ) )
+        result = np.zeros( runs.shape, dtype = 'bool' )
+        for run in np.unique( runs ):
+            if run not in self.__arrays: continue
+            first, last = self.__arrays[run]
+            mask = ( runs == run )
+            i = np.searchsorted( first, lumis[mask], side = 'right' ) - 1
+            result[mask] = ( i >= 0 ) & ( lumis[mask] <= last[ np.maximum( i, 0 ) ] )
+        return result
+
+    def getRuns( self ):
+        return sorted( self.intervals.keys() )
+
+class LumiAccumulator:
+    ''' Set of processed lumi sections per run, written as compact golden-JSON style ranges
+    '''
+    def __init__( self ):
+        self.runsAndLumis = {}
+
+    def add( self, run, lumi ):
+        try:
+            self.runsAndLumis[run].add( lumi )
+        except KeyError:
+            self.runsAndLumis[run] = set( [ lumi ] )
+
+    def add_batch( self, runs, lumis ):
+        runs, lumis = np.broadcast_arrays( np.asarray( runs ), np.asarray( lumis ) )
+        for run in np.unique( runs ):
+            self.runsAndLumis.setdefault( int(run), set() ).update( np.unique( lumis[ runs == run ] ).tolist() )
+
+    def update( self, other ):
+        ''' Merge another accumulator or a dictionary { run: lumis }
+        '''
+        runsAndLumis = other.runsAndLumis if isinstance( other, LumiAccumulator ) else other
+        for run, lumis in runsAndLumis.iteritems():
+            self.runsAndLumis.setdefault( int(run), set() ).update( lumis )
+
+    def compactList( self ):
+        ''' { 'run': [ [first, last], ... ] } as in the golden json
+        '''
+        result = {}
+        for run, lumis in self.runsAndLumis.iteritems():
+            ranges = []
+            for lumi in sorted( lumis ):
+                if ranges and lumi == ranges[-1][1] + 1:
+                    ranges[-1][1] = lumi
+                else:
+                    ranges.append( [ lumi, lumi ] )
+            result[str(run)] = ranges
+        return result
+
+    def writeJSON( self, filename ):
+        with open( filename, 'w' ) as f:
+            json.dump( self.compactList(), f, sort_keys = True )
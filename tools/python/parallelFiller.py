@@ -0,0 +1,79 @@
+''' Fill booked histograms of several samples in parallel. Every (sample, file) pair is a job of a process pool,
+    each worker reads its file once with HistoFiller and the partial histograms are added (incl. Sumw2) in the parent.
+'''
+# Standard imports
+import ROOT
+
+# JetMET
+from JetMET.tools.histoFiller import HistoFiller, sampleWeightString
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+def _fillFile( job ):
+    ''' Worker: fill clones of the templates from one file. Returns [ ( booking index, histo ), ... ]
+    '''
+    treeName, filename, bookings, maxEntries = job
+    ROOT.TH1.AddDirectory( False )
+    chain  = ROOT.TChain( treeName )
+    chain.Add( filename )
+    filler = HistoFiller( chain )
+    result = []
+    for i_booking, template, varexp, weight in bookings:
+        h = template.Clone()
+        h.Reset()
+        filler.book( h, varexp, weightString = weight )
+        result.append( ( i_booking, h ) )
+    filler.fill( maxEntries = maxEntries )
+    logger.debug( "Filled %i histograms from %s", len( result ), filename )
+    return result
+
+class ParallelFiller:
+
+    def __init__( self, workers = 1 ):
+        self.workers  = workers
+        # booking index -> ( sample, histo, varexp, weight )
+        self.bookings = []
+
+    def book( self, sample, histo, varexp, weightString = "1", selectionString = None ):
+        ''' Book a histogram for a RootTools Sample. The sample selection and weight are applied as in sample.get1DHistoFromDraw.
+            Returns the histogram which contains the merged result after fill().
+        '''
+        if histo.GetSumw2N() == 0: histo.Sumw2()
+        weight = sampleWeightString( sample, weightString, selectionString )
+        self.bookings.append( ( sample, histo, varexp, weight ) )
+        return histo
+
+    def jobs( self, maxEntries = -1 ):
+        ''' One job per (sample, file) with all bookings of the sample
+        '''
+        jobs = []
+        samples = []
+        for sample, histo, varexp, weight in self.bookings:
+            if sample not in samples: samples.append( sample )
+        for sample in samples:
+            bookings = [ ( i_booking, b[1], b[2], b[3] ) for i_booking, b in enumerate( self.bookings ) if b[0] is sample ]
+            for filename in sample.files:
+                jobs.append( ( sample.treeName, filename, bookings, maxEntries ) )
+        return jobs
+
+    def fill( self, maxEntries = -1 ):
+        ''' Run all (sample, file) jobs and add the partial histograms to the booked ones.
+            maxEntries is applied per file.
+        '''
+        jobs = self.jobs( maxEntries = maxEntries )
+        logger.info( "Filling %i histograms from %i files with %i workers", len( self.bookings ), len( jobs ), self.workers )
+
+        if self.workers > 1:
+            from multiprocessing import Pool
+            pool = Pool( processes = self.workers )
+            results = pool.map( _fillFile, jobs )
+            pool.close()
+            pool.join()
+        else:
+            results = map( _fillFile, jobs )
+
+        for result in results:
+            for i_booking, h in result:
+                self.bookings[i_booking][1].Add( h )
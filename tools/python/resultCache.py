@@ -0,0 +1,107 @@
+''' Content addressed cache of intermediate results (histograms, response dictionaries).
+    The key is the sha1 of everything the result depends on: input files with size and mtime, selection, weight,
+    binning and the version of the code. Entries are zlib compressed binary pickles (ROOT objects are streamed),
+    the total size is limited and the least recently used entries are evicted.
+'''
+# Standard imports
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+import cPickle
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+suffix = '.pkl.z'
+
+def fileStamps( files ):
+    ''' [ ( filename, size, mtime ), ... ]. Remote files (e.g. root://) can't be stat'ed and enter with their name only.
+    '''
+    stamps = []
+    for filename in files:
+        try:
+            stat = os.stat( filename )
+            stamps.append( ( filename, stat.st_size, stat.st_mtime ) )
+        except OSError:
+            stamps.append( ( filename, None, None ) )
+    return stamps
+
+def codeVersion( *filenames ):
+    ''' sha1 of the source of the given files, e.g. codeVersion( __file__ ) in a script
+    '''
+    h = hashlib.sha1()
+    for filename in filenames:
+        # hash the source, not the compiled file
+        if filename.endswith('.pyc'): filename = filename[:-1]
+        with open( filename, 'rb' ) as f:
+            h.update( f.read() )
+    return h.hexdigest()
+
+def makeKey( **components ):
+    ''' sha1 of the json serialized components. Tuples and lists are equivalent.
+    '''
+    return hashlib.sha1( json.dumps( components, sort_keys = True ) ).hexdigest()
+
+class ResultCache:
+
+    def __init__( self, directory, maxSize = 2*1024**3 ):
+        ''' maxSize in bytes
+        '''
+        self.directory = directory
+        self.maxSize   = maxSize
+        if not os.path.exists( directory ):
+            os.makedirs( directory )
+
+    def _filename( self, key ):
+        return os.path.join( self.directory, key + suffix )
+
+    def contains( self, key ):
+        return os.path.exists( self._filename( key ) )
+
+    def get( self, key, default = None ):
+        ''' Cached object or default. A hit updates the mtime which is the LRU time stamp.
+        '''
+        filename = self._filename( key )
+        try:
+            with open( filename, 'rb' ) as f:
+                result = cPickle.loads( zlib.decompress( f.read() ) )
+        except IOError:
+            logger.debug( "Cache miss for %s", key )
+            return default
+        except ( zlib.error, cPickle.UnpicklingError, EOFError ):
+            logger.warning( "Could not read cache entry %s. Removing it.", filename )
+            os.remove( filename )
+            return default
+        os.utime( filename, None )
+        logger.info( "Cache hit for %s", key )
+        return result
+
+    def put( self, key, obj ):
+        ''' Store the object (atomic rename) and evict old entries if the cache is too large
+        '''
+        fd, tmp_file = tempfile.mkstemp( dir = self.directory, prefix = '.'+key )
+        with os.fdopen( fd, 'wb' ) as f:
+            f.write( zlib.compress( cPickle.dumps( obj, cPickle.HIGHEST_PROTOCOL ) ) )
+        os.chmod( tmp_file, 0644 )
+        os.rename( tmp_file, self._filename( key ) )
+        logger.info( "Stored %s in cache %s", key, self.directory )
+        self.evict( keep = key )
+
+    def evict( self, keep = None ):
+        ''' Remove least recently used entries until the total size is below maxSize. Never removes 'keep'.
+        '''
+        entries = []
+        for filename in os.listdir( self.directory ):
+            if not filename.endswith( suffix ): continue
+            stat = os.stat( os.path.join( self.directory, filename ) )
+            entries.append( ( stat.st_mtime, stat.st_size, filename ) )
+        total = sum( e[1] for e in entries )
+        for mtime, size, filename in sorted( entries ):
+            if total <= self.maxSize: break
+            if keep is not None and filename == keep + suffix: continue
+            os.remove( os.path.join( self.directory, filename ) )
+            total -= size
+            logger.info( "Evicted %s from cache %s", filename, self.directory )
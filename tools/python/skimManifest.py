@@ -0,0 +1,86 @@
+''' Checkpoint manifest of a skim output directory. For every event range it records the input files (with size and mtime), the event range,
+    the hash of the configuration and size, mtime and adler32 checksum of the output.
+    A range needs to be reprocessed if any of these changed or the output is missing.
+'''
+# Standard imports
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+
+# JetMET
+from JetMET.tools.resultCache import fileStamps
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+manifest_filename = 'manifest.json'
+
+def configHash( config ):
+    ''' sha1 of a json serializable configuration (e.g. JEC versions and skim conditions)
+    '''
+    return hashlib.sha1( json.dumps( config, sort_keys = True ) ).hexdigest()
+
+def adler32( filename, blocksize = 1024**2 ):
+    checksum = 1
+    with open( filename, 'rb' ) as f:
+        for block in iter( lambda: f.read( blocksize ), b'' ):
+            checksum = zlib.adler32( block, checksum )
+    return "%08x" % ( checksum & 0xffffffff )
+
+def load( directory ):
+    ''' Manifest of the directory, { range index (str): record }. Empty if not found or not readable.
+    '''
+    manifest_file = os.path.join( directory, manifest_filename )
+    if not os.path.exists( manifest_file ): return {}
+    try:
+        with open( manifest_file ) as f:
+            return json.load( f )
+    except ValueError:
+        logger.warning( "Could not read manifest %s. Ignoring.", manifest_file )
+        return {}
+
+def update( directory, records ):
+    ''' Merge the records into the manifest of the directory. Re-reads the manifest and renames atomically such that
+        concurrent jobs writing different ranges only lose records in the short window between reading and renaming.
+    '''
+    manifest = load( directory )
+    manifest.update( records )
+    fd, tmp_file = tempfile.mkstemp( dir = directory, prefix = '.'+manifest_filename )
+    with os.fdopen( fd, 'w' ) as f:
+        json.dump( manifest, f, indent = 1, sort_keys = True )
+    os.chmod( tmp_file, 0644 )
+    os.rename( tmp_file, os.path.join( directory, manifest_filename ) )
+    logger.debug( "Updated %i ranges in manifest %s", len( records ), os.path.join( directory, manifest_filename ) )
+
+def makeRecord( outfilename, files, eventRange, config_hash, **kwargs ):
+    ''' Record of a finished range. Additional information (e.g. processed lumis) can be stored with kwargs.
+    '''
+    stat = os.stat( outfilename )
+    record = {
+        'output':     os.path.basename( outfilename ),
+        'files':      list( files ),
+        'fileStamps': [ list( stamp ) for stamp in fileStamps( files ) ],
+        'eventRange': list( eventRange ),
+        'config':     config_hash,
+        'size':       stat.st_size,
+        'mtime':      stat.st_mtime,
+        'adler32':    adler32( outfilename ),
+    }
+    record.update( kwargs )
+    return record
+
+def isUpToDate( record, outfilename, files, eventRange, config_hash ):
+    ''' Compare with the record. Input and output files are checked with size and mtime, the checksum is for validation downstream.
+    '''
+    if record is None: return False
+    if record['files'] != list( files ) or record['eventRange'] != list( eventRange ) or record['config'] != config_hash:
+        return False
+    # an input file that changed in place
+    if record.get( 'fileStamps' ) != [ list( stamp ) for stamp in fileStamps( files ) ]:
+        return False
+    if not os.path.exists( outfilename ): return False
+    stat = os.stat( outfilename )
+    return stat.st_size == record['size'] and stat.st_mtime == record['mtime']